@@ -1,16 +1,21 @@
 import os
+import atexit
+import copy
+import threading
+import time
 import pickle
 import sys
 from datetime import datetime, timedelta
-from flask import Flask, render_template, redirect, url_for, request, jsonify, session, flash
+from flask import Flask, render_template, redirect, url_for, request, jsonify, session, flash, g, has_request_context
 from collections import defaultdict
 from functools import wraps
 import math
 import random
+import heapq
 import re
 import json
 import hashlib
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 from typing import List, Optional, Dict, Any, Tuple
 from io import BytesIO
 from PIL import Image
@@ -20,16 +25,23 @@ import uuid
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 # 导入配置
-from config import DATA_DIR, CARD_STATES_FILE, USERS_FILE, SECRET_KEY, DEBUG, USE_DATABASE
+from config import (
+    DATA_DIR, CARD_STATES_FILE, USERS_FILE, SECRET_KEY, DEBUG, USE_DATABASE,
+    WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_FLUSH_INTERVAL, WRITE_BEHIND_PENDING_TIMEOUT,
+    USER_CACHE_MAX_USERS, USER_CACHE_MAX_CARD_STATES, USER_CACHE_IDLE_SECONDS,
+    OPTIMIZER_REVIEW_THRESHOLD, OPTIMIZER_WORKERS, OPTIMIZER_MAX_PENDING, OPTIMIZER_ITERATIONS,
+    FORECAST_REPLICAS, FORECAST_MAX_DAYS, RETENTION_SEARCH_REPLICAS, RETENTION_SEARCH_DAYS,
+    LOAD_BALANCE_SCHEDULING, BACKLOG_DAILY_CAPACITY, BACKLOG_DAYS
+)
 
 # 尝试导入FSRS模块
 try:
     # 首先尝试从models目录导入
-    from fsrs_web.models.fsrs import FSRS, Card, ReviewLog as FsrsReviewLog
+    from fsrs_web.models.fsrs import FSRS, Card, MemoryState, ReviewLog as FsrsReviewLog
 except ImportError:
     try:
         # 如果上面失败，尝试从相对路径导入
-        from models.fsrs import FSRS, Card, ReviewLog as FsrsReviewLog
+        from models.fsrs import FSRS, Card, MemoryState, ReviewLog as FsrsReviewLog
     except ImportError:
         # 如果仍然无法导入，直接从文件导入
         import importlib.util
@@ -102,13 +114,16 @@ except ImportError:
             INIT_STABILITY = 1.0
             INIT_DIFFICULTY = 5.0
             
-            def __init__(self, desired_retention=0.9, maximum_interval=36500, params=None):
+            def __init__(self, desired_retention=0.9, maximum_interval=36500, params=None, enable_adaptive_params=False):
                 self.desired_retention = desired_retention
                 self.maximum_interval = maximum_interval
                 self.w = params if params is not None else self.DEFAULT_PARAMS
             
-            def next_interval(self, stability, learning_factor=1.0):
+            def next_interval(self, stability, learning_factor=1.0, load_balancer=None):
                 interval = stability * math.log(self.desired_retention) * -1.0 * learning_factor
+                if load_balancer is not None:
+                    low, preferred, high = (max(1, round(min(interval * fuzz, self.maximum_interval))) for fuzz in (0.95, 1.0, 1.05))
+                    return load_balancer(low, high, preferred)
                 fuzz = random.uniform(0.95, 1.05)
                 interval *= fuzz
                 interval = min(interval, self.maximum_interval)
@@ -231,6 +246,8 @@ def save_users(users):
     else:
         with open(users_file, 'w') as f:
             json.dump(users, f, indent=4)
+    # 整体保存后丢弃本进程缓存的全部用户记录
+    invalidate_user_record()
 
 # 密码哈希函数
 def hash_password(password):
@@ -260,11 +277,8 @@ def register():
         password = request.form['password']
         confirm_password = request.form['confirm_password']
         
-        # 加载现有用户
-        users = load_users()
-        
         # 验证输入
-        if username in users:
+        if get_user(username) is not None:
             error = '用户名已存在，请选择其他用户名'
         elif password != confirm_password:
             error = '两次输入的密码不一致'
@@ -274,15 +288,16 @@ def register():
             error = '密码必须包含字母和数字'
         else:
             # 创建新用户
-            users[username] = {
+            created = create_user_record(username, {
                 'password': hash_password(password),
                 'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
                 'last_login': None,
                 'study_mode': 'medium'  # 设置默认学习模式为中等模式
-            }
+            })
             
-            # 保存用户数据
-            save_users(users)
+            if not created:
+                error = '用户名已存在，请选择其他用户名'
+                return render_template('register.html', error=error)
             
             # 为新用户创建所有系统卡片的默认状态
             if USE_DATABASE and StorageAdapter is not None:
@@ -318,11 +333,8 @@ def register():
                         
                         session_db.commit()
                         print(f"为新用户 {username} 创建了 {len(db_system_cards)} 张系统卡片的默认状态")
-                        # 刷新内存中的系统卡片与用户卡片状态，确保新注册用户立即可见
-                        try:
-                            load_cards()
-                        except Exception as refresh_err:
-                            print(f"刷新卡片数据失败: {refresh_err}")
+                        # 丢弃可能缓存的旧数据，新用户的卡片状态在首次访问时加载
+                        invalidate_user_state(username)
                     except Exception as e:
                         session_db.rollback()
                         print(f"为新用户创建卡片状态失败: {e}")
@@ -332,12 +344,14 @@ def register():
                     print(f"导入数据库模块失败: {e}")
             else:
                 # 文件存储模式：为新用户创建默认卡片状态
-                if username not in user_card_states:
-                    user_card_states[username] = {}
+                states = user_card_states.get(username)
+                if states is None:
+                    states = {}
+                    user_card_states[username] = states
                 
                 # 为所有系统卡片创建默认状态
                 for card_id, card in system_cards.items():
-                    user_card_states[username][card_id] = CardState(
+                    states[card_id] = CardState(
                         card_id=card_id,
                         is_viewed=False,
                         due_date=card.created_at,
@@ -345,7 +359,7 @@ def register():
                         is_user_card=False
                     )
                 
-                save_cards()
+                save_card_states(username, states, list(system_cards.keys()))
                 print(f"为新用户 {username} 创建了 {len(system_cards)} 张系统卡片的默认状态")
             
             # 自动登录
@@ -376,18 +390,17 @@ def login():
             session['is_admin'] = True
             return redirect(url_for('admin'))
         
-        # 加载用户数据
-        users = load_users()
+        # 只查询要登录的用户
+        user = get_user(username)
         
         # 验证用户名和密码
-        if username in users and users[username]['password'] == hash_password(password):
+        if user is not None and user['password'] == hash_password(password):
             session['logged_in'] = True
             session['username'] = username
             session['is_admin'] = False
             
             # 更新最后登录时间
-            users[username]['last_login'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            save_users(users)
+            update_user_record(username, last_login=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
             
             # 获取登录后要重定向的页面
             next_page = request.args.get('next')
@@ -415,7 +428,22 @@ def admin():
     # 加载所有用户数据
     users = load_users()
     
-    return render_template('admin.html', users=users)
+    pool_stats = StorageAdapter.get_pool_stats() if StorageAdapter is not None else None
+    return render_template('admin.html', users=users, cache_stats=get_cache_stats(), pool_stats=pool_stats)
+
+@app.route('/admin/cache_stats')
+def admin_cache_stats():
+    """用户数据缓存的命中、未命中和淘汰统计"""
+    if not session.get('is_admin'):
+        return jsonify({'status': 'error', 'message': '权限不足'})
+    return jsonify(get_cache_stats())
+
+@app.route('/admin/pool_stats')
+def admin_pool_stats():
+    """数据库连接池的检出、等待和溢出统计"""
+    if not session.get('is_admin'):
+        return jsonify({'status': 'error', 'message': '权限不足'})
+    return jsonify(StorageAdapter.get_pool_stats() if StorageAdapter is not None else None)
 
 @app.route('/admin/add_user', methods=['POST'])
 def admin_add_user():
@@ -428,20 +456,16 @@ def admin_add_user():
     if not username or not password:
         return jsonify({'status': 'error', 'message': '用户名和密码不能为空'})
     
-    users = load_users()
-    
-    if username in users:
-        return jsonify({'status': 'error', 'message': '用户名已存在'})
-    
     # 添加新用户
-    users[username] = {
+    created = create_user_record(username, {
         'password': hash_password(password),
         'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
         'last_login': None,
         'study_mode': 'medium'  # 设置默认学习模式为中等模式
-    }
+    })
+    if not created:
+        return jsonify({'status': 'error', 'message': '用户名已存在'})
     
-    save_users(users)
     return jsonify({'status': 'success', 'message': '用户添加成功'})
 
 @app.route('/admin/delete_user', methods=['POST'])
@@ -457,14 +481,9 @@ def admin_delete_user():
     if username == 'S1f':
         return jsonify({'status': 'error', 'message': '不能删除管理员账号'})
     
-    users = load_users()
-    
-    if username not in users:
-        return jsonify({'status': 'error', 'message': '用户不存在'})
-    
     # 删除用户
-    del users[username]
-    save_users(users)
+    if not delete_user_record(username):
+        return jsonify({'status': 'error', 'message': '用户不存在'})
     
     return jsonify({'status': 'success', 'message': '用户删除成功'})
 
@@ -473,15 +492,13 @@ def admin_delete_user():
 def profile():
     """个人资料页面"""
     # 获取用户信息
-    users = load_users()
     username = session.get('username')
+    user_data = get_user(username)
     
-    if username not in users:
+    if user_data is None:
         flash('用户不存在', 'error')
         return redirect(url_for('logout'))
     
-    user_data = users[username]
-    
     # 处理表单提交
     if request.method == 'POST':
         # 验证当前密码
@@ -491,36 +508,33 @@ def profile():
                 flash('当前密码不正确', 'error')
                 return redirect(url_for('profile'))
             
+            # 需要更新的字段
+            updates = {}
+            
             # 更新用户名
             new_username = request.form.get('username')
             if new_username and new_username != username:
                 # 检查用户名是否已存在
-                if new_username in users and new_username != username:
+                if get_user(new_username) is not None:
                     flash('用户名已存在', 'error')
                     return redirect(url_for('profile'))
                 
                 # 更新用户名 - 同时更新卡片数据
-                user_data_copy = user_data.copy()
-                users.pop(username)
-                users[new_username] = user_data_copy
-                
-                # 更新卡片所有权
-                if username in user_card_states:
-                    user_card_states[new_username] = user_card_states[username]
-                    del user_card_states[username]
-                    save_cards()
+                if not rename_user_record(username, new_username):
+                    flash('用户名已存在', 'error')
+                    return redirect(url_for('profile'))
                 
                 session['username'] = new_username
             
             # 更新密码
             new_password = request.form.get('new_password')
             if new_password:
-                users[new_username if new_username else username]['password'] = hash_password(new_password)
+                updates['password'] = hash_password(new_password)
             
             # 更新学习模式
             study_mode = request.form.get('study_mode')
             if study_mode:
-                users[new_username if new_username else username]['study_mode'] = study_mode
+                updates['study_mode'] = study_mode
             
             # 处理头像上传
             if 'avatar' in request.files:
@@ -554,13 +568,14 @@ def profile():
                         img.save(avatar_path, "JPEG", quality=95)
                         
                         # 更新用户数据
-                        users[new_username if new_username else username]['avatar'] = f"avatars/{filename}"
+                        updates['avatar'] = f"avatars/{filename}"
                     except Exception as e:
                         print(f"处理头像出错: {e}")
                         flash('头像处理失败，请尝试其他图片', 'error')
             
-            # 保存用户数据
-            save_users(users)
+            # 只更新修改过的字段
+            if updates:
+                update_user_record(new_username if new_username else username, **updates)
             flash('个人资料已更新', 'success')
             return redirect(url_for('profile'))
     
@@ -588,14 +603,7 @@ def profile():
             stats['avg_retention'] = round(retention_sum / max(1, len(viewed_cards)) * 100)
         
         # 获取连续学习天数
-        # 从review_data函数获取
-        review_stats = {}
-        for card_id, card in cards.items():
-            if hasattr(card, 'review_logs') and card.review_logs:
-                for log in card.review_logs:
-                    timestamp = int(log.timestamp.timestamp())
-                    date_key = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
-                    review_stats[date_key] = review_stats.get(date_key, 0) + 1
+        review_stats = get_daily_review_counts(session.get('username'))
         
         # 计算连续天数
         if review_stats:
@@ -621,7 +629,8 @@ def profile():
     return render_template('profile.html', stats=stats, avatar_url=avatar_url, user_mode=user_mode)
 
 # 初始化FSRS
-fsrs = FSRS()
+# 参数优化由后台调度器按用户进行，请求中使用的FSRS实例不收集复习记录、不在线优化
+fsrs = FSRS(enable_adaptive_params=False)
 
 # 存储文件路径
 # 尝试多个可能的位置
@@ -642,20 +651,45 @@ print(f"使用数据文件路径: {storage_file}")
 
 # 导入存储适配器
 try:
-    from models.storage import StorageAdapter
+    from models.storage import StorageAdapter, DatabaseJobStore
 except ImportError:
     try:
-        from fsrs_web.models.storage import StorageAdapter
+        from fsrs_web.models.storage import StorageAdapter, DatabaseJobStore
     except ImportError:
         print("无法导入StorageAdapter，将使用默认文件存储")
         StorageAdapter = None
+        DatabaseJobStore = None
+
+# 导入写后队列和用户数据缓存
+try:
+    from models.write_behind import WriteBehindQueue
+    from models.user_cache import UserStateCache
+    from models.param_scheduler import OptimizationScheduler
+    from models.replay import replay_logs, apply_replay, is_rescheduled, last_review_time
+    from models.simulator import WorkloadSimulator, rating_probabilities, new_cards_rate
+    from models.due_histogram import DueHistogram
+    from models.due_index import DueIndex
+    from models.backlog import plan_backlog
+    from models.card_view import UserCardViews
+    from models.search_index import SearchIndex, PrefixIndex, extract_word
+except ImportError:
+    from fsrs_web.models.write_behind import WriteBehindQueue
+    from fsrs_web.models.user_cache import UserStateCache
+    from fsrs_web.models.param_scheduler import OptimizationScheduler
+    from fsrs_web.models.replay import replay_logs, apply_replay, is_rescheduled, last_review_time
+    from fsrs_web.models.simulator import WorkloadSimulator, rating_probabilities, new_cards_rate
+    from fsrs_web.models.due_histogram import DueHistogram
+    from fsrs_web.models.due_index import DueIndex
+    from fsrs_web.models.backlog import plan_backlog
+    from fsrs_web.models.card_view import UserCardViews
+    from fsrs_web.models.search_index import SearchIndex, PrefixIndex, extract_word
 
 # 卡片数据结构改进
 # 系统将维护两种卡片：
 # 1. 系统基础卡片(system_cards): 所有用户共享的基础单词库
 # 2. 用户卡片状态(user_card_states): 用户对卡片的学习状态，以及用户自己添加的卡片
 system_cards = {}  # 格式: {card_id: Card}
-user_card_states = {}  # 格式: {username: {card_id: CardState}}
+user_card_states = UserStateCache()  # 格式: {username: {card_id: CardState}}
 
 @dataclass
 class CardState:
@@ -677,22 +711,460 @@ class CardState:
         good_ratings = sum(1 for log in self.review_logs if log.rating >= 3)
         return good_ratings / len(self.review_logs)
 
+def copy_card_state(state):
+    """复制卡片状态供写后队列保存，记忆状态、复习记录列表和用户卡片数据都复制一份"""
+    return replace(
+        state,
+        memory_state=copy.copy(state.memory_state),
+        review_logs=list(state.review_logs),
+        user_card_data=dict(state.user_card_data) if state.user_card_data is not None else None
+    )
+
 # 添加用户FSRS参数
 class UserFSRSParams:
     """用户独立的FSRS参数"""
-    def __init__(self, params=None):
+    # 问卷设置的期望保留率和最大间隔，为None时按学习模式(旧快照中的对象没有这两个属性)
+    desired_retention = None
+    maximum_interval = None
+    
+    def __init__(self, params=None, last_updated=None, optimization_count=0,
+                 desired_retention=None, maximum_interval=None):
         self.params = params if params is not None else FSRS.DEFAULT_PARAMS
-        self.last_updated = datetime.now()
-        self.optimization_count = 0
+        self.last_updated = last_updated or datetime.now()
+        self.optimization_count = optimization_count
+        self.desired_retention = desired_retention
+        self.maximum_interval = maximum_interval
+    
+    @property
+    def version(self):
+        """参数版本：参数或设置被替换(优化、问卷)后变化"""
+        return (self.last_updated, self.optimization_count)
 
 # 在load_users函数后添加用户FSRS参数存储
-user_fsrs_params = {}  # 格式: {username: UserFSRSParams}
+user_fsrs_params = UserStateCache()  # 格式: {username: UserFSRSParams}
+
+# 各学习模式对应的 (期望保留率, 最大间隔天数)
+STUDY_MODE_SETTINGS = {
+    'long_term': (0.95, 36500),
+    'medium': (0.90, 365),
+    'cram': (0.80, 30)
+}
+
+# 用户FSRS实例缓存 {username: ((学习模式, 参数版本), FSRS)}
+# 学习模式或参数版本变化时重新创建，其余情况下各请求复用同一个实例
+user_fsrs_instances = UserStateCache(
+    max_entries=USER_CACHE_MAX_USERS,
+    idle_seconds=USER_CACHE_IDLE_SECONDS or None
+)
+
+# 用户最优期望保留率的计算结果缓存 {username: (参数版本, 结果)}
+user_retention_curves = UserStateCache(
+    max_entries=USER_CACHE_MAX_USERS,
+    idle_seconds=USER_CACHE_IDLE_SECONDS or None
+)
+
+def _load_due_histogram(username):
+    """遍历一次用户的卡片状态，统计每天到期的卡片数"""
+    states = user_card_states.get(username)
+    return DueHistogram.from_states(states) if states is not None else DueHistogram()
+
+# 用户每天到期卡片数的直方图，第一次使用时构建，之后随卡片排期增量更新
+user_due_histograms = UserStateCache(
+    loader=_load_due_histogram,
+    max_entries=USER_CACHE_MAX_USERS,
+    idle_seconds=USER_CACHE_IDLE_SECONDS or None
+)
+
+def _load_due_index(username):
+    """按到期时间排列用户可见的已查看卡片"""
+    states = user_card_states.get(username) or {}
+    return DueIndex.from_states({
+        card_id: state for card_id, state in states.items()
+        if card_id in system_cards or (state.is_user_card and state.user_card_data)
+    })
+
+# 用户到期卡片的有序索引，第一次使用时构建，之后随卡片的查看、评分和排期增量更新
+user_due_indexes = UserStateCache(
+    loader=_load_due_index,
+    max_entries=USER_CACHE_MAX_USERS,
+    idle_seconds=USER_CACHE_IDLE_SECONDS or None
+)
+
+def _load_card_views(username):
+    """用系统卡片和用户的卡片状态构建用户可见的卡片视图"""
+    return UserCardViews(system_cards, user_card_states.get(username) or {})
+
+# 用户可见卡片的视图，第一次使用时构建，之后随卡片状态的增删增量更新
+user_card_views = UserStateCache(
+    loader=_load_card_views,
+    max_entries=USER_CACHE_MAX_USERS,
+    idle_seconds=USER_CACHE_IDLE_SECONDS or None
+)
+
+# 系统卡片的搜索索引和自动补全索引，所有用户共享，构建后只读 (系统卡片字典, 搜索索引, 自动补全索引)
+system_search_indexes = (None, None, None)
+
+# 多个工作进程之间的缓存一致性
+# 数据库模式：记录本进程缓存的每个用户数据对应的版本号 {username: version}
+# 文件存储模式：本进程已应用到的卡片状态日志位置由存储适配器记录(本进程压缩日志后随之更新)，
+# 读取和应用其他进程的日志记录时加锁，保证按日志顺序应用
+user_state_versions = {}
+journal_apply_lock = threading.Lock()
+
+# 每个用户一把锁：请求从开始到结束持有当前用户的锁，后台线程修改或读取用户数据时也要先获取，
+# 保证卡片状态、到期索引等内存数据只被一个线程修改
+user_locks = {}
+user_locks_guard = threading.Lock()
+
+def get_user_lock(username):
+    """获取用户的锁，不存在时创建"""
+    with user_locks_guard:
+        lock = user_locks.get(username)
+        if lock is None:
+            lock = user_locks[username] = threading.RLock()
+        return lock
+
+def _remember_user_version(username, version):
+    """记录加载用户数据时的版本号；卡片状态和参数分别加载时保留较早的版本，保证过期时能被发现"""
+    if version is not None:
+        user_state_versions.setdefault(username, version)
+
+def _load_user_card_states(username):
+    """按需加载单个用户的卡片状态"""
+    # 写后队列中还有该用户未落库的修改时先写入，避免加载到旧数据
+    if card_write_queue.pending_for(username):
+        card_write_queue.flush()
+    # 先读取版本号再加载，加载期间其他进程的写入会在下次检查时被发现
+    version = StorageAdapter.get_user_version(username)
+    states = StorageAdapter.load_user_card_states(username, Card, CardState)
+    # 没有数据的结果也会被缓存，同样记录版本号，其他进程为该用户创建数据后能被发现
+    _remember_user_version(username, version)
+    return states
+
+def _load_user_fsrs_params(username):
+    """按需加载单个用户的FSRS参数"""
+    version = StorageAdapter.get_user_version(username)
+    params = StorageAdapter.load_user_fsrs_params(username, UserFSRSParams)
+    _remember_user_version(username, version)
+    return params
+
+def _load_user_record(username):
+    """按需加载单个用户的记录(数据库模式下按主键查询一行)"""
+    if StorageAdapter is None:
+        return load_users().get(username)
+    version = StorageAdapter.get_user_version(username)
+    record = StorageAdapter.load_user(username)
+    _remember_user_version(username, version)
+    return record
+
+# 用户记录缓存：{username: 用户数据字典}，文件存储模式下记录用户文件的修改时间
+user_records = UserStateCache(
+    loader=_load_user_record,
+    max_entries=USER_CACHE_MAX_USERS,
+    idle_seconds=USER_CACHE_IDLE_SECONDS or None
+)
+users_file_version = None
+
+def get_user(username):
+    """获取单个用户的记录(只读)，同一请求内只查询一次
+    
+    Returns:
+        用户数据字典；用户不存在时返回None
+    """
+    if not username:
+        return None
+    if not has_request_context():
+        return user_records.get(username)
+    memo = g.setdefault('user_records', {})
+    if username not in memo:
+        memo[username] = user_records.get(username)
+    return memo[username]
+
+def invalidate_user_record(username=None):
+    """丢弃缓存的用户记录；username为None时丢弃全部"""
+    if username is None:
+        user_records.clear()
+    else:
+        user_records.invalidate(username)
+    if has_request_context():
+        g.pop('user_records', None)
+
+def create_user_record(username, user_data):
+    """创建一个用户，用户名已存在时返回False"""
+    if StorageAdapter is not None:
+        created = StorageAdapter.create_user(username, user_data)
+    else:
+        users = load_users()
+        created = username not in users
+        if created:
+            users[username] = user_data
+            save_users(users)
+    mark_user_changed(username)
+    return created
+
+def update_user_record(username, **fields):
+    """只更新一个用户的指定字段，用户不存在时返回False"""
+    if StorageAdapter is not None:
+        updated = StorageAdapter.update_user(username, **fields)
+    else:
+        users = load_users()
+        updated = username in users
+        if updated:
+            users[username].update(fields)
+            save_users(users)
+    mark_user_changed(username)
+    return updated
+
+def delete_user_record(username):
+    """删除一个用户，用户不存在时返回False"""
+    # 先写入该用户尚未落库的修改，避免删除后又被写后队列写回
+    if card_write_queue.pending_for(username):
+        card_write_queue.flush()
+    if StorageAdapter is not None:
+        deleted = StorageAdapter.delete_user(username)
+    else:
+        users = load_users()
+        deleted = users.pop(username, None) is not None
+        if deleted:
+            save_users(users)
+    mark_user_changed(username)
+    invalidate_user_state(username)
+    return deleted
+
+def rename_user_record(old_username, new_username):
+    """修改用户名，同时把卡片状态等数据转移到新用户名下；新用户名已存在时返回False"""
+    if card_write_queue.pending_for(old_username):
+        card_write_queue.flush()
+    if StorageAdapter is not None:
+        renamed = StorageAdapter.rename_user(old_username, new_username)
+    else:
+        users = load_users()
+        renamed = old_username in users and new_username not in users
+        if renamed:
+            users[new_username] = users.pop(old_username)
+            save_users(users)
+    if not renamed:
+        return False
+    
+    if StorageAdapter is not None and StorageAdapter.supports_per_user_loading():
+        # 数据库中的关联数据已转移，新旧用户名的缓存都重新加载
+        invalidate_user_state(old_username)
+        invalidate_user_state(new_username)
+        StorageAdapter.bump_user_versions([old_username, new_username])
+    else:
+        # 文件存储模式：存储已在日志中记录转移，这里转移本进程内存中的卡片状态
+        if old_username in user_card_states:
+            user_card_states[new_username] = user_card_states[old_username]
+            del user_card_states[old_username]
+        if old_username in user_fsrs_params:
+            user_fsrs_params[new_username] = user_fsrs_params[old_username]
+            del user_fsrs_params[old_username]
+        user_fsrs_instances.invalidate(old_username)
+        user_retention_curves.invalidate(old_username)
+        user_due_histograms.invalidate(old_username)
+        user_due_indexes.invalidate(old_username)
+        user_card_views.invalidate(old_username)
+        if StorageAdapter is None:
+            save_cards()
+        invalidate_user_record(old_username)
+        invalidate_user_record(new_username)
+    return True
+
+def mark_user_changed(username):
+    """用户记录被修改后调用：丢弃本进程的缓存，并通知其他工作进程"""
+    invalidate_user_record(username)
+    if StorageAdapter is not None and StorageAdapter.supports_per_user_loading():
+        StorageAdapter.bump_user_versions([username])
+
+def invalidate_user_state(username):
+    """丢弃本进程缓存的用户数据，下次访问时重新加载"""
+    user_card_states.invalidate(username)
+    user_fsrs_params.invalidate(username)
+    user_fsrs_instances.invalidate(username)
+    user_retention_curves.invalidate(username)
+    user_due_histograms.invalidate(username)
+    user_due_indexes.invalidate(username)
+    user_card_views.invalidate(username)
+    invalidate_user_record(username)
+    user_state_versions.pop(username, None)
+
+def revalidate_user_state(username):
+    """检查其他工作进程是否修改过用户数据，过期时丢弃或更新本进程的缓存
+    
+    数据库模式下按主键读取一次版本号；文件存储模式下读取其他进程追加的日志。
+    每个请求只检查一次。
+    """
+    global users_file_version
+    if StorageAdapter is None or g.get('user_state_checked'):
+        return
+    g.user_state_checked = True
+    
+    if StorageAdapter.supports_per_user_loading():
+        current_version = _wait_for_pending_writes(username)
+        cached_version = user_state_versions.get(username)
+        if cached_version is None:
+            return
+        if current_version is not None and current_version != cached_version:
+            print(f"用户 {username} 的数据已被其他进程修改(版本 {cached_version} -> {current_version})，重新加载")
+            invalidate_user_state(username)
+        return
+    
+    # 用户文件被修改后丢弃缓存的用户记录
+    current_users_version = StorageAdapter.users_file_version()
+    if current_users_version != users_file_version:
+        if users_file_version is not None:
+            invalidate_user_record()
+        users_file_version = current_users_version
+    
+    with journal_apply_lock:
+        _apply_journal_changes()
+
+def _wait_for_pending_writes(username):
+    """数据库模式：其他工作进程还有该用户未写入的修改时，等待它们的写后队列写入
+    
+    本进程自己登记的修改不需要等待(读取时会合并写后队列中的数据)。
+    超过WRITE_BEHIND_PENDING_TIMEOUT秒没有更新的登记视为进程已退出，清零后继续。
+    
+    Returns:
+        用户数据当前的版本号；查询失败时返回None
+    """
+    deadline = time.monotonic() + WRITE_BEHIND_PENDING_TIMEOUT
+    while True:
+        write_state = StorageAdapter.get_user_write_state(username)
+        if write_state is None:
+            return None
+        version, pending_writes, updated_at = write_state
+        own_writes = sum(1 for operation in card_write_queue.pending_appends_for(username) if operation[0] == 'mark')
+        if pending_writes <= own_writes:
+            return version
+        if time.monotonic() >= deadline:
+            stale_before = datetime.now() - timedelta(seconds=WRITE_BEHIND_PENDING_TIMEOUT)
+            if updated_at is not None and updated_at < stale_before:
+                StorageAdapter.clear_stale_pending_writes(username, stale_before)
+            print(f"等待其他进程写入用户 {username} 的数据超时，使用当前数据")
+            return version
+        time.sleep(0.05)
+
+def _apply_journal_changes():
+    """应用其他工作进程追加的卡片状态日志，快照被其他进程替换时重新加载全部数据"""
+    position = StorageAdapter.journal_position()
+    if position is None:
+        return
+    records, position = StorageAdapter.read_journal_changes(position)
+    if position is None:
+        print("卡片状态快照已被其他进程更新，重新加载")
+        load_cards()
+        return
+    if records:
+        StorageAdapter.apply_journal_records(user_card_states, records, user_fsrs_params)
+        changed_users = set()
+        for operation, username_changed, target, _ in records:
+            changed_users.add(username_changed)
+            if operation == 'rename':
+                changed_users.add(target)
+        for username_changed in changed_users:
+            user_card_states.reweigh(username_changed)
+            user_fsrs_instances.invalidate(username_changed)
+            user_retention_curves.invalidate(username_changed)
+            user_due_histograms.invalidate(username_changed)
+            user_due_indexes.invalidate(username_changed)
+            user_card_views.invalidate(username_changed)
+
+@app.before_request
+def lock_user_state():
+    """请求开始时获取当前用户的锁，与该用户的其他请求和后台任务互斥，请求结束时释放"""
+    username = session.get('username')
+    if username and request.endpoint != 'static':
+        lock = get_user_lock(username)
+        lock.acquire()
+        g.user_lock = lock
+
+@app.teardown_request
+def unlock_user_state(exception=None):
+    lock = g.pop('user_lock', None)
+    if lock is not None:
+        lock.release()
+
+@app.before_request
+def check_user_state_coherence():
+    """请求开始前确认本进程缓存的当前用户数据没有被其他工作进程修改"""
+    username = session.get('username')
+    if username and request.endpoint != 'static':
+        revalidate_user_state(username)
+
+@app.after_request
+def mark_request_writes(response):
+    """请求结束前登记本请求修改过的用户，修改本身留在写后队列中由后台线程写入
+
+    数据库模式下把这些用户的版本号加一并登记一次未写入的修改(一条UPDATE)，
+    其他工作进程据此丢弃缓存，并在读取该用户前等待本进程的写后队列写入；
+    同时在队列中追加一条登记记录，写入完成后撤销登记。登记失败时改为立即写入该用户的修改。
+    文件存储模式下不做任何事，日志记录由后台线程追加。
+    """
+    usernames = g.pop('written_users', ())
+    if usernames and StorageAdapter is not None and StorageAdapter.supports_per_user_loading():
+        new_versions = StorageAdapter.mark_user_writes_pending(usernames)
+        if new_versions is None:
+            for username in usernames:
+                card_write_queue.flush(username)
+            return response
+        _note_own_versions(new_versions)
+        for username in usernames:
+            card_write_queue.append(('mark', username, None, None))
+    return response
+
+def _note_own_versions(new_versions):
+    """本进程写入后版本号加一；中间没有其他进程写入时缓存仍是最新的"""
+    for username, version in (new_versions or {}).items():
+        if user_state_versions.get(username) == version - 1:
+            user_state_versions[username] = version
+
+def _create_user_caches():
+    """创建按需加载、按LRU淘汰的用户数据缓存"""
+    max_card_states = USER_CACHE_MAX_CARD_STATES or None
+    idle_seconds = USER_CACHE_IDLE_SECONDS or None
+    card_state_cache = UserStateCache(
+        loader=_load_user_card_states,
+        max_entries=USER_CACHE_MAX_USERS,
+        max_weight=max_card_states,
+        idle_seconds=idle_seconds,
+        weigher=len
+    )
+    fsrs_params_cache = UserStateCache(
+        loader=_load_user_fsrs_params,
+        max_entries=USER_CACHE_MAX_USERS,
+        idle_seconds=idle_seconds
+    )
+    return card_state_cache, fsrs_params_cache
+
+def _preloaded_cache(data):
+    """把已全部加载到内存的数据放入不淘汰的缓存"""
+    if isinstance(data, UserStateCache):
+        return data
+    cache = UserStateCache()
+    for username, value in data.items():
+        cache[username] = value
+    return cache
 
 # 在load_cards函数中添加加载用户FSRS参数的逻辑
 def load_cards():
     """加载卡片数据"""
     global system_cards, user_card_states, user_fsrs_params
     
+    # 重新加载前先写入尚未落库的修改，避免读到旧数据
+    card_write_queue.flush()
+    user_due_histograms.clear()
+    user_due_indexes.clear()
+    user_card_views.clear()
+    
+    # 数据库模式下只加载系统卡片，用户数据在请求中首次访问时按需加载
+    if StorageAdapter is not None and StorageAdapter.supports_per_user_loading():
+        system_cards = StorageAdapter.load_system_cards(Card)
+        user_card_states, user_fsrs_params = _create_user_caches()
+        user_state_versions.clear()
+        print(f"已加载 {len(system_cards)} 张系统卡片，用户数据将按需加载")
+        return
+    
     # 如果可用，使用存储适配器
     if StorageAdapter is not None:
         system_cards, user_card_states, user_fsrs_params = StorageAdapter.load_cards(
@@ -833,13 +1305,27 @@ def load_cards():
             system_cards = {}
             user_card_states = {}
             user_fsrs_params = {}
+    
+    # 文件存储模式下全部用户数据已在内存中，不做淘汰
+    user_card_states = _preloaded_cache(user_card_states)
+    user_fsrs_params = _preloaded_cache(user_fsrs_params)
 
 def save_cards():
     """保存卡片数据"""
+    # 按需加载模式下内存中只有部分用户，只能逐个写入已加载用户的状态，不能整体覆盖
+    if StorageAdapter is not None and StorageAdapter.supports_per_user_loading():
+        card_write_queue.discard()
+        for username, states in user_card_states.items():
+            StorageAdapter.save_card_states(username, states)
+        return
+    
     if StorageAdapter is not None:
-        # 使用存储适配器保存数据
-        StorageAdapter.save_cards(system_cards, user_card_states, user_fsrs_params)
+        # 文件存储模式：先把队列中的修改写入日志，再把日志合并进快照
+        card_write_queue.flush()
+        StorageAdapter.save_cards(system_cards, dict(user_card_states.items()), dict(user_fsrs_params.items()))
     else:
+        # 整体保存会写入内存中的全部状态，写后队列中尚未写入的条目不再需要
+        card_write_queue.discard()
         # 使用旧的文件存储方式
         try:
             # 确保目录存在
@@ -848,8 +1334,8 @@ def save_cards():
             # 将数据打包为新格式
             all_data = {
                 'system_cards': system_cards,
-                'user_card_states': user_card_states,
-                'user_fsrs_params': user_fsrs_params
+                'user_card_states': dict(user_card_states.items()),
+                'user_fsrs_params': dict(user_fsrs_params.items())
             }
             
             with open(storage_file, 'wb') as f:
@@ -858,61 +1344,373 @@ def save_cards():
         except Exception as e:
             print(f"保存卡片数据失败: {e}")
 
+def get_cache_stats():
+    """汇总用户数据缓存的统计信息"""
+    return {
+        'card_states': user_card_states.stats(),
+        'fsrs_params': user_fsrs_params.stats(),
+        'user_records': user_records.stats()
+    }
+
+def save_card_states(username, states, card_ids):
+    """登记用户修改过的卡片状态，由写后队列在后台批量增量保存
+    
+    Args:
+        states: 调用方修改的卡片状态字典；不重新从缓存读取，用户在修改期间被淘汰时也能保存这次修改
+        card_ids: 修改过的卡片ID
+    """
+    for card_id in card_ids:
+        if card_id in states:
+            card_write_queue.put(username, card_id, states[card_id])
+    _note_request_write(username)
+
+def delete_card_states(username, card_ids):
+    """登记需要删除的用户卡片状态，由写后队列在后台批量删除"""
+    for card_id in card_ids:
+        card_write_queue.delete(username, card_id)
+    _note_request_write(username)
+
+def record_review_logs(username, card_id, logs):
+    """登记新增的复习记录，由写后队列逐条追加到复习记录表"""
+    for log in logs:
+        card_write_queue.append(('add_log', username, card_id, log))
+    _note_request_write(username)
+
+def delete_review_logs(username, card_id=None, since=None):
+    """登记删除复习记录的操作，与新增记录按登记顺序执行"""
+    card_write_queue.append(('delete_logs', username, card_id, since))
+    _note_request_write(username)
+
+def _note_request_write(username):
+    """记录本请求修改过数据的用户，请求结束时登记"""
+    if has_request_context():
+        g.setdefault('written_users', set()).add(username)
+
+def write_card_batch(batch, log_operations):
+    """写后队列的写入函数，按用户分组增量写入；存储不支持增量写入时回退到整体保存"""
+    if StorageAdapter is None or not StorageAdapter.supports_incremental_writes():
+        save_cards()
+        return len(batch) + len(log_operations)
+    
+    changes_by_user = defaultdict(dict)
+    for (username, card_id), state in batch.items():
+        changes_by_user[username][card_id] = state
+    
+    failed = False
+    for username, changes in changes_by_user.items():
+        upserts = {card_id: state for card_id, state in changes.items() if state is not None}
+        deletes = [card_id for card_id, state in changes.items() if state is None]
+        if upserts and not StorageAdapter.save_card_states(username, upserts):
+            failed = True
+        if deletes and not StorageAdapter.delete_card_states(username, deletes):
+            failed = True
+    
+    # 复习记录按登记顺序写入，连续的新增记录合并为一次插入；请求结束时的登记记录只计数
+    new_logs = []
+    settled = defaultdict(int)
+    for operation in log_operations + [('end', None, None, None)]:
+        kind, username, card_id, value = operation
+        if kind == 'add_log':
+            new_logs.append((username, card_id, value))
+            continue
+        if kind == 'mark':
+            settled[username] += 1
+            continue
+        if new_logs and not StorageAdapter.append_review_logs(new_logs):
+            failed = True
+        new_logs = []
+        if kind == 'delete_logs' and not StorageAdapter.delete_review_logs(username, card_id=card_id, since=value):
+            failed = True
+    
+    # 写入均为幂等操作，失败时由写后队列放回整批数据稍后重试
+    if failed:
+        raise RuntimeError('部分卡片状态写入存储失败')
+    
+    # 更新用户数据版本号并撤销已写入的请求登记，其他工作进程据此丢弃过期的缓存
+    if StorageAdapter.supports_per_user_loading():
+        changed_users = set(changes_by_user) | {operation[1] for operation in log_operations}
+        new_versions = StorageAdapter.bump_user_versions(changed_users, settled=settled)
+        if new_versions is None:
+            raise RuntimeError('更新用户数据版本失败')
+        _note_own_versions(new_versions)
+    return len(batch) + len(log_operations)
+
+# 卡片状态写后队列：修改先登记、合并，由后台线程批量写入存储，请求不等待写入
+card_write_queue = WriteBehindQueue(
+    write_card_batch,
+    batch_size=WRITE_BEHIND_BATCH_SIZE,
+    flush_interval=WRITE_BEHIND_FLUSH_INTERVAL,
+    snapshot=copy_card_state
+)
+card_write_queue.start()
+atexit.register(card_write_queue.stop)
+
+def _merge_pending_review_logs(username, logs_by_card):
+    """把写后队列中尚未写入的复习记录操作按登记顺序应用到从存储读取的 {card_id: [ReviewLog]}"""
+    for card_id, state in card_write_queue.pending_for(username).items():
+        if state is None:
+            logs_by_card.pop(card_id, None)
+    for kind, _, card_id, value in card_write_queue.pending_appends_for(username):
+        if kind == 'add_log':
+            logs = logs_by_card.setdefault(card_id, [])
+            # 正在写入的记录可能已经提交，按复习时间去重
+            if all(log.timestamp != value.timestamp for log in logs):
+                logs.append(value)
+        elif kind == 'delete_logs':
+            for key in ([card_id] if card_id is not None else list(logs_by_card)):
+                if key in logs_by_card:
+                    logs_by_card[key] = [log for log in logs_by_card[key] if value is not None and log.timestamp < value]
+
+def collect_review_history(username):
+    """收集用户的全部复习记录和当前参数，供后台参数优化使用(在调度线程中运行)
+    
+    Returns:
+        ([每张卡片的复习记录列表], 当前参数)
+    """
+    logs_by_card = None
+    if StorageAdapter is not None:
+        logs_by_card = StorageAdapter.load_review_logs(username, FsrsReviewLog)
+        if logs_by_card is not None:
+            _merge_pending_review_logs(username, logs_by_card)
+    if logs_by_card is None:
+        logs_by_card = {card_id: list(state.review_logs) for card_id, state in list(user_card_states.get(username, {}).items())}
+    
+    user_params = user_fsrs_params.get(username)
+    params = user_params.params if user_params is not None else FSRS.DEFAULT_PARAMS
+    return list(logs_by_card.values()), list(params)
+
+def set_user_fsrs_params(username, params, optimized=False, settings=None):
+    """替换用户的FSRS参数并保存，然后按新参数重新计算该用户的卡片状态
+    
+    参数对象整体替换，版本号随之变化，缓存的FSRS实例在下次使用时重新创建。
+    
+    Args:
+        username: 用户名
+        params: FSRS参数
+        optimized: 是否为优化得到的参数，是时优化次数加一
+        settings: 同时修改的调度设置 {desired_retention, maximum_interval}，为None时保持不变
+    """
+    current = user_fsrs_params.get(username)
+    new_params = UserFSRSParams(
+        params=params,
+        optimization_count=current.optimization_count if current is not None else 0,
+        desired_retention=current.desired_retention if current is not None else None,
+        maximum_interval=current.maximum_interval if current is not None else None
+    )
+    for field, value in (settings or {}).items():
+        setattr(new_params, field, value)
+    
+    if StorageAdapter is not None and StorageAdapter.supports_per_user_loading():
+        optimization_count = StorageAdapter.save_user_fsrs_params(username, params, optimized=optimized, settings=settings)
+        if optimization_count is None:
+            return False
+        new_params.optimization_count = optimization_count
+        user_fsrs_params[username] = new_params
+        # 通知其他工作进程重新加载该用户的参数
+        _note_own_versions(StorageAdapter.bump_user_versions([username]))
+    else:
+        # 文件存储模式：参数作为一条记录追加到卡片状态日志，不重写快照
+        if optimized:
+            new_params.optimization_count += 1
+        if StorageAdapter is not None and not StorageAdapter.append_user_fsrs_params(username, new_params):
+            return False
+        user_fsrs_params[username] = new_params
+        if StorageAdapter is None:
+            save_cards()
+    
+    replay_user_card_states(username)
+    return True
+
+def collect_replay_input(username):
+    """收集重放一个用户的复习记录所需的数据
+    
+    Returns:
+        replay_logs的参数 (每张卡片的复习记录, FSRS参数, 期望保留率, 最大间隔)
+    """
+    states = user_card_states.get(username) or {}
+    user_fsrs = get_user_fsrs(username)
+    logs_by_card = {card_id: list(state.review_logs) for card_id, state in list(states.items()) if state.review_logs}
+    return logs_by_card, list(user_fsrs.w), user_fsrs.desired_retention, user_fsrs.maximum_interval
+
+def replay_user_card_states(username, results=None, save=True):
+    """按用户当前的FSRS参数重放复习记录，重新计算该用户所有卡片的记忆状态和下次复习时间
+    
+    开启负载均衡时按评分时的方式重新选择到期日，并重建到期索引和直方图。
+    
+    Args:
+        username: 用户名
+        results: 已经计算好的replay_logs结果(如命令行工具在工作进程中计算)，为None时在本线程计算
+        save: 是否把变化的卡片写回存储
+    
+    Returns:
+        状态有变化的卡片数
+    """
+    states = user_card_states.get(username)
+    if not states:
+        return 0
+    if results is None:
+        results, _ = replay_logs(*collect_replay_input(username))
+    changed = apply_replay(states, results, MemoryState)
+    if changed:
+        if LOAD_BALANCE_SCHEDULING:
+            _load_balance_replayed(get_user_fsrs(username), states, changed)
+        user_due_histograms.invalidate(username)
+        user_due_indexes.invalidate(username)
+        if save:
+            save_card_states(username, states, changed)
+    return len(changed)
+
+def _load_balance_replayed(user_fsrs, states, card_ids):
+    """重放得到的是不加波动的到期时间，按评分时的负载均衡在波动范围内重新选择到期卡片最少的一天
+
+    重新安排过的到期时间(积压分摊)保持不变
+    """
+    histogram = DueHistogram.from_states(states)
+    for card_id in card_ids:
+        state = states[card_id]
+        if not state.is_viewed or state.memory_state is None or is_rescheduled(state):
+            continue
+        last_review = last_review_time(state)
+        if last_review is None:
+            continue
+        histogram.remove(state.due_date)
+        interval_days = user_fsrs.next_interval(
+            state.memory_state.stability,
+            load_balancer=lambda low, high, preferred: histogram.least_loaded(last_review, low, high, preferred)
+        )
+        state.due_date = last_review + timedelta(days=interval_days)
+        histogram.add(state.due_date)
+
+def collect_optimization_data(username):
+    """在调度线程中收集用户的复习记录，持有该用户的锁，不与该用户的请求同时读写卡片状态"""
+    with get_user_lock(username):
+        return collect_review_history(username)
+
+def apply_optimized_params(username, params, result):
+    """在进程池的回调线程中保存后台优化得到的参数并重算卡片状态，优化次数加一
+    
+    持有该用户的锁，等待该用户正在处理的请求结束后再修改卡片状态、到期索引和直方图
+    """
+    with get_user_lock(username):
+        return set_user_fsrs_params(username, params, optimized=True)
+
+# FSRS参数后台优化：请求只登记复习数量，达到阈值后由调度线程把任务交给进程池；
+# 数据库模式下任务状态和复习数量保存在数据库中，各工作进程看到同一份状态
+param_scheduler = OptimizationScheduler(
+    collect_optimization_data,
+    apply_optimized_params,
+    store=DatabaseJobStore() if StorageAdapter is not None and StorageAdapter.supports_per_user_loading() else None,
+    max_workers=OPTIMIZER_WORKERS,
+    max_pending=OPTIMIZER_MAX_PENDING,
+    review_threshold=OPTIMIZER_REVIEW_THRESHOLD,
+    iterations=OPTIMIZER_ITERATIONS
+)
+param_scheduler.start()
+atexit.register(param_scheduler.stop)
+
+def get_daily_review_counts(username, since=None, until=None):
+    """按天统计用户的复习次数，返回 {'YYYY-MM-DD': 次数}
+    
+    数据库模式下直接在复习记录表中按天聚合，只读取需要的时间范围
+    """
+    if StorageAdapter is not None:
+        # 写后队列中尚未写入的新增记录直接计入统计，不在请求线程中刷新队列；
+        # 还有未写入的删除操作(删除记录或删除卡片)时表中的数据偏多，改用内存中的复习记录统计
+        pending = card_write_queue.pending_appends_for(username)
+        has_pending_deletes = (
+            any(operation[0] == 'delete_logs' for operation in pending)
+            or any(state is None for state in card_write_queue.pending_for(username).values())
+        )
+        if not has_pending_deletes:
+            counts = StorageAdapter.count_reviews_by_day(username, since=since, until=until)
+            if counts is not None:
+                for kind, _, _, log in pending:
+                    if kind != 'add_log':
+                        continue
+                    if (since is not None and log.timestamp < since) or (until is not None and log.timestamp >= until):
+                        continue
+                    log_date = log.timestamp.strftime('%Y-%m-%d')
+                    counts[log_date] = counts.get(log_date, 0) + 1
+                return counts
+    
+    counts = {}
+    for state in user_card_states.get(username, {}).values():
+        for log in state.review_logs:
+            if since is not None and log.timestamp < since:
+                continue
+            if until is not None and log.timestamp >= until:
+                continue
+            log_date = log.timestamp.strftime('%Y-%m-%d')
+            counts[log_date] = counts.get(log_date, 0) + 1
+    return counts
+
 def get_user_cards():
-    """获取当前用户可见的所有卡片"""
+    """获取当前用户可见的所有卡片
+    
+    返回只读的卡片视图 {card_id: CardView}，不复制卡片数据；需要修改时用get_card取得副本
+    """
     username = session.get('username')
     if not username or username not in user_card_states:
         return {}
-    
-    result = {}
-    user_states = user_card_states[username]
-    
-    # 添加系统卡片
-    for card_id, card in system_cards.items():
-        if card_id in user_states:
-            state = user_states[card_id]
-            # 创建卡片副本，并添加用户状态
-            card_copy = Card(
-                id=card.id,
-                unit_id=card.unit_id,
-                front=card.front,
-                back=card.back,
-                created_at=card.created_at,
-                due_date=state.due_date if state.due_date else card.created_at
-            )
-            # 手动设置其他属性
-            card_copy.memory_state = state.memory_state
-            card_copy.review_logs = state.review_logs
-            card_copy.is_viewed = state.is_viewed
-            card_copy.learning_factor = state.learning_factor
-            result[card_id] = card_copy
-    
-    # 添加用户自己的卡片
-    for card_id, state in user_states.items():
-        if state.is_user_card and state.user_card_data:
-            # 创建用户卡片
-            created_at = state.user_card_data.get('created_at', datetime.now())
-            user_card = Card(
-                id=card_id,
-                unit_id=state.user_card_data.get('unit_id', ''),
-                front=state.user_card_data.get('front', ''),
-                back=state.user_card_data.get('back', ''),
-                created_at=created_at,
-                due_date=state.due_date if state.due_date else created_at
-            )
-            # 手动设置其他属性
-            user_card.memory_state = state.memory_state
-            user_card.review_logs = state.review_logs
-            user_card.is_viewed = state.is_viewed
-            user_card.learning_factor = state.learning_factor
-            result[card_id] = user_card
-    
-    return result
+    return get_user_card_views(username)
+
+def get_user_card_views(username):
+    """获取用户的卡片视图，卡片状态被重新加载或在视图之外增删时重建"""
+    states = user_card_states[username]
+    views = user_card_views[username]
+    if not views.is_current(system_cards, states):
+        views = UserCardViews(system_cards, states)
+        user_card_views[username] = views
+    return views
+
+def get_system_search_indexes():
+    """获取系统卡片的搜索索引和自动补全索引，系统卡片被重新加载后重建"""
+    global system_search_indexes
+    source, search_index, prefix_index = system_search_indexes
+    if source is not system_cards or len(search_index) != len(system_cards):
+        search_index = SearchIndex.from_cards(system_cards)
+        prefix_index = PrefixIndex.from_cards(system_cards)
+        system_search_indexes = (system_cards, search_index, prefix_index)
+    return search_index, prefix_index
+
+def search_cards(query, include_back=False, limit=None):
+    """在当前用户可见的卡片中搜索，按匹配程度排序
+    
+    Args:
+        query: 查询词
+        include_back: 是否同时搜索卡片背面
+        limit: 最多返回的卡片数
+    
+    Returns:
+        卡片视图列表
+    """
+    cards = get_user_cards()
+    if not cards:
+        return []
+    # 系统卡片的结果只保留用户可见、且没有被用户卡片覆盖的
+    results = [
+        (key, card_id) for key, card_id in get_system_search_indexes()[0].search(query, include_back)
+        if card_id in cards and card_id not in cards.search
+    ]
+    results.extend(cards.search.search(query, include_back, limit))
+    results = heapq.nsmallest(limit, results) if limit is not None else sorted(results)
+    return [cards[card_id] for _, card_id in results]
 
-def get_card(card_id):
-    """获取卡片"""
+def suggest_words(prefix, limit=10):
+    """当前用户可见的卡片中以prefix开头的单词，按字母顺序排列"""
     cards = get_user_cards()
-    return cards.get(card_id)
+    if not cards:
+        return []
+    # 系统卡片的单词只保留用户可见、且没有被用户卡片覆盖的
+    visible = lambda card_id: card_id in cards and card_id not in cards.search
+    suggestions = set(get_system_search_indexes()[1].complete(prefix, limit, visible))
+    suggestions.update(cards.words.complete(prefix, limit))
+    return sorted(suggestions, key=lambda word: (word.lower(), word))[:limit]
+
+def get_card(card_id):
+    """获取卡片的可修改副本，修改后调用update_card保存"""
+    view = get_user_cards().get(card_id)
+    return view.to_card(Card) if view is not None else None
 
 def update_card(card):
     """更新卡片"""
@@ -920,17 +1718,24 @@ def update_card(card):
     if not username:
         return None
     
-    # 确保用户有卡片状态字典
-    if username not in user_card_states:
-        user_card_states[username] = {}
+    # 确保用户有卡片状态字典；只取一次，后面的修改和保存都作用于同一个字典
+    states = user_card_states.get(username)
+    if states is None:
+        states = {}
+        user_card_states[username] = states
+    
+    # 在修改状态之前取得到期直方图，记录卡片原来的到期日
+    histogram = user_due_histograms.get(username)
+    previous = states.get(card.id)
+    old_due_date = previous.due_date if previous is not None and previous.is_viewed else None
     
     # 检查是否是系统卡片
     if card.id in system_cards:
         # 更新用户对系统卡片的状态
-        if card.id not in user_card_states[username]:
-            user_card_states[username][card.id] = CardState(card_id=card.id)
+        if card.id not in states:
+            states[card.id] = CardState(card_id=card.id)
         
-        state = user_card_states[username][card.id]
+        state = states[card.id]
         state.is_viewed = card.is_viewed
         state.memory_state = card.memory_state
         state.review_logs = card.review_logs
@@ -938,9 +1743,9 @@ def update_card(card):
         state.learning_factor = card.learning_factor
     else:
         # 如果不是系统卡片，检查是否是用户卡片
-        if card.id in user_card_states[username] and user_card_states[username][card.id].is_user_card:
+        if card.id in states and states[card.id].is_user_card:
             # 更新用户卡片状态
-            state = user_card_states[username][card.id]
+            state = states[card.id]
             state.is_viewed = card.is_viewed
             state.memory_state = card.memory_state
             state.review_logs = card.review_logs
@@ -953,7 +1758,7 @@ def update_card(card):
                 state.user_card_data['back'] = card.back
         else:
             # 新的用户卡片
-            user_card_states[username][card.id] = CardState(
+            states[card.id] = CardState(
                 card_id=card.id,
                 is_viewed=card.is_viewed,
                 memory_state=card.memory_state,
@@ -969,20 +1774,97 @@ def update_card(card):
                 }
             )
     
-    save_cards()
+    histogram.move(old_due_date, card.due_date if card.is_viewed else None)
+    user_due_indexes[username].update(card.id, card.due_date if card.is_viewed else None)
+    user_card_views[username].refresh(card.id)
+    save_card_states(username, states, [card.id])
     return card
 
 def get_due_cards(current_time=None):
-    """获取需要复习的卡片"""
+    """获取需要复习的卡片，按到期时间排序"""
+    username = session.get('username')
     cards = get_user_cards()
+    if not cards:
+        return []
     actual_time = current_time if current_time is not None else datetime.now()
-    # 只返回已查看且到期的卡片
-    return [card for card in cards.values() if hasattr(card, 'is_viewed') and card.is_viewed and card.due_date <= actual_time]
+    due_ids = user_due_indexes[username].due_ids(actual_time)
+    return [cards[card_id] for card_id in due_ids if card_id in cards]
+
+def count_due_cards(current_time=None):
+    """统计需要复习的卡片数量"""
+    username = session.get('username')
+    if not username or username not in user_card_states:
+        return 0
+    actual_time = current_time if current_time is not None else datetime.now()
+    return user_due_indexes[username].count_due(actual_time)
+
+def get_next_due_card(current_time=None):
+    """获取最早到期的卡片，没有需要复习的卡片时返回None"""
+    username = session.get('username')
+    cards = get_user_cards()
+    if not cards:
+        return None
+    actual_time = current_time if current_time is not None else datetime.now()
+    card_id = user_due_indexes[username].next_due(actual_time)
+    return cards.get(card_id) if card_id is not None else None
+
+def reschedule_backlog(username, days=BACKLOG_DAYS, capacity=BACKLOG_DAILY_CAPACITY):
+    """把用户所有过期的卡片按紧急程度分摊到从今天开始的days天，每天连同已有的复习不超过capacity张
+    
+    新的到期时间为当天零点加上按紧急程度排列的序号(微秒)，按到期时间排序即为复习顺序。
+    
+    Returns:
+        每天安排的过期卡片数列表，没有过期卡片时为空列表
+    """
+    states = user_card_states.get(username) or {}
+    now = datetime.now()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    overdue = [(card_id, state) for card_id, state in list(states.items())
+               if state.is_viewed and state.due_date and state.due_date <= now]
+    if not overdue:
+        return []
+    
+    stability = [state.memory_state.stability if state.memory_state else float('nan') for _, state in overdue]
+    elapsed_days = [
+        (now - max(log.timestamp for log in state.review_logs)).total_seconds() / 86400 if state.review_logs else 0.0
+        for _, state in overdue
+    ]
+    
+    # 已经安排在这些天的复习数，今天到期的过期卡片不重复计算
+    histogram = user_due_histograms[username]
+    load = histogram.counts(today, days)
+    load[0] -= sum(1 for _, state in overdue if state.due_date >= today)
+    due_index = user_due_indexes[username]
+    
+    user_fsrs = get_user_fsrs(username)
+    order, offsets, _ = plan_backlog(user_fsrs.batch(), stability, elapsed_days, capacity, days, load)
+    
+    changed = []
+    per_day = [0] * days
+    for rank, (index, offset) in enumerate(zip(order.tolist(), offsets.tolist())):
+        card_id, state = overdue[index]
+        due_date = today + timedelta(days=offset, microseconds=rank)
+        histogram.move(state.due_date, due_date)
+        due_index.update(card_id, due_date)
+        state.due_date = due_date
+        changed.append(card_id)
+        per_day[offset] += 1
+    save_card_states(username, states, changed)
+    return per_day
 
 def get_cards_by_unit(unit_id):
     """获取指定单元的卡片"""
     cards = get_user_cards()
-    return [card for card in cards.values() if card.unit_id == unit_id]
+    if not cards:
+        return []
+    return [cards[card_id] for card_id in cards.units.card_ids(unit_id)]
+
+def get_unit_counts(unit_id):
+    """获取指定单元的卡片数和已查看的卡片数"""
+    cards = get_user_cards()
+    if not cards:
+        return 0, 0
+    return cards.units.total(unit_id), cards.units.viewed(unit_id)
 
 def get_learned_words_count():
     """获取已学习的单词数量"""
@@ -998,7 +1880,7 @@ load_cards()
 def index():
     """首页 - 选择学习或复习"""
     # 获取需要复习的卡片数量
-    due_cards = get_due_cards()
+    due_cards_count = count_due_cards()
     
     # 获取今日任务统计
     total_tasks, completed_tasks = get_daily_tasks_stats()
@@ -1009,7 +1891,7 @@ def index():
     fsrs_adjustment_threshold = 50
     
     return render_template('index.html', 
-                          due_cards_count=len(due_cards),
+                          due_cards_count=due_cards_count,
                           total_tasks=total_tasks,
                           completed_tasks=completed_tasks,
                           learned_words_count=learned_words_count,
@@ -1025,8 +1907,9 @@ def learn():
 @login_required
 def review():
     """复习内容页面"""
-    # 获取需要复习的卡片
-    due_cards = get_due_cards()
+    # 获取最早到期的卡片和到期卡片数
+    card = get_next_due_card()
+    due_count = count_due_cards()
     
     # 初始化session中的复习状态
     if 'cards_reviewed' not in session:
@@ -1037,7 +1920,12 @@ def review():
     # FSRS参数调整所需的基础单词数量
     fsrs_adjustment_threshold = 50
     
-    if not due_cards:
+    # 积压的到期卡片超过每天的复习容量时提示重新排期
+    backlog = None
+    if due_count > BACKLOG_DAILY_CAPACITY:
+        backlog = {'due': due_count, 'days': BACKLOG_DAYS, 'capacity': BACKLOG_DAILY_CAPACITY}
+    
+    if card is None:
         return render_template('review.html', 
                               cards_reviewed=session['cards_reviewed'],
                               total_cards=session['cards_reviewed'],
@@ -1045,29 +1933,15 @@ def review():
                               fsrs_adjustment_threshold=fsrs_adjustment_threshold,
                               card=None)
     
-    # 取第一张卡片显示
-    card = due_cards[0]
-    
     # 计算过期天数
     now = datetime.now()
     overdue_days = (now - card.due_date).days if now > card.due_date else 0
     
-    # 如果卡片过期，调整稳定性
-    if overdue_days > 0:
-        # 根据过期天数调整稳定性，过期越久稳定性下降越多
-        # 这里采用Anki类似的处理方式，但使用更平滑的衰减
-        user_fsrs = get_user_fsrs()  # 获取用户特定的FSRS实例
-        adjusted_stability = card.memory_state.stability if card.memory_state else user_fsrs.INIT_STABILITY
-        if overdue_days > 0:
-            decay_factor = 1.0 / (1.0 + 0.1 * overdue_days)  # 平滑衰减函数
-            adjusted_stability *= decay_factor
-            adjusted_stability = max(user_fsrs.INIT_STABILITY * 0.5, adjusted_stability)  # 确保不会低于初始稳定性的一半
-    else:
-        user_fsrs = get_user_fsrs()  # 获取用户特定的FSRS实例
-        adjusted_stability = card.memory_state.stability if card.memory_state else user_fsrs.INIT_STABILITY
-    
-    # 使用调整后的稳定性计算间隔
+    # 按当前稳定性预估各评分的间隔，与评分时的计算一致，不再额外按过期天数衰减
     user_fsrs = get_user_fsrs()  # 获取用户特定的FSRS实例
+    adjusted_stability = card.memory_state.stability if card.memory_state else user_fsrs.INIT_STABILITY
+    
+    # 使用当前稳定性计算间隔
     hard_interval = user_fsrs.next_interval(adjusted_stability * 0.8 if adjusted_stability else user_fsrs.INIT_STABILITY * 0.8)
     good_interval = user_fsrs.next_interval(adjusted_stability * 1.0 if adjusted_stability else user_fsrs.INIT_STABILITY * 1.0)
     easy_interval = user_fsrs.next_interval(adjusted_stability * 1.3 if adjusted_stability else user_fsrs.INIT_STABILITY * 1.3)
@@ -1081,7 +1955,21 @@ def review():
                           learned_words_count=learned_words_count,
                           fsrs_adjustment_threshold=fsrs_adjustment_threshold,
                           cards_reviewed=session['cards_reviewed'],
-                          total_cards=session['cards_reviewed'] + len(due_cards))
+                          total_cards=session['cards_reviewed'] + due_count,
+                          backlog=backlog)
+
+@app.route('/reschedule_backlog', methods=['POST'])
+@login_required
+def reschedule_backlog_route():
+    """把积压的到期卡片分摊到接下来几天"""
+    days = max(1, min(request.form.get('days', BACKLOG_DAYS, type=int) or BACKLOG_DAYS, 60))
+    capacity = max(1, request.form.get('capacity', BACKLOG_DAILY_CAPACITY, type=int) or BACKLOG_DAILY_CAPACITY)
+    per_day = reschedule_backlog(session['username'], days, capacity)
+    if per_day:
+        flash(f"已把 {sum(per_day)} 张过期卡片分摊到 {days} 天，今天需要复习 {per_day[0]} 张", 'success')
+    else:
+        flash('没有过期的卡片', 'info')
+    return redirect(url_for('review'))
 
 @app.route('/api/search')
 @login_required
@@ -1091,35 +1979,26 @@ def search():
     if not query:
         return jsonify([])
     
-    # 搜索结果
+    # 搜索结果，按匹配程度排序（完全匹配的排在前面）
     results = []
+    for card in search_cards(query, limit=10):
+        # 添加单元信息
+        unit_name = "未知单元"
+        if card.unit_id == 'unit1':
+            unit_name = 'Number'
+        elif card.unit_id == 'unit2':
+            unit_name = 'Algebra'
+        # 可以继续添加其他单元的映射
+        
+        results.append({
+            'id': card.id,
+            'front': card.front,
+            'back': card.back,
+            'unit': unit_name,
+            'unit_id': card.unit_id
+        })
     
-    # 在卡片中搜索
-    for card_id, card in get_user_cards().items():
-        front_lower = card.front.lower()
-        if query in front_lower:
-            # 添加单元信息
-            unit_name = "未知单元"
-            if hasattr(card, 'unit_id'):
-                unit_id = card.unit_id
-                if unit_id == 'unit1':
-                    unit_name = 'Number'
-                elif unit_id == 'unit2':
-                    unit_name = 'Algebra'
-                # 可以继续添加其他单元的映射
-            
-            results.append({
-                'id': card_id,
-                'front': card.front,
-                'back': card.back,
-                'unit': unit_name,
-                'unit_id': card.unit_id if hasattr(card, 'unit_id') else None
-            })
-    
-    # 按照匹配度排序（完全匹配的排在前面）
-    results.sort(key=lambda x: 0 if x['front'].lower() == query else 1)
-    
-    return jsonify(results[:10])  # 限制返回前10个结果
+    return jsonify(results)
 
 @app.route('/unit/<unit_id>')
 @login_required
@@ -1180,11 +2059,10 @@ def word_stats():
     # 获取每个单元的统计信息
     unit_stats = {}
     for unit_id in unit_names.keys():
-        unit_cards = get_cards_by_unit(unit_id)
-        viewed_cards = [card for card in unit_cards if hasattr(card, 'is_viewed') and card.is_viewed]
+        total, viewed = get_unit_counts(unit_id)
         unit_stats[unit_id] = {
-            'total': len(unit_cards),
-            'viewed': len(viewed_cards)
+            'total': total,
+            'viewed': viewed
         }
     
     return render_template('word_stats.html', units=unit_names, unit_stats=unit_stats)
@@ -1268,16 +2146,16 @@ def get_daily_tasks():
         'unit9': 'Unit 9'
     }
     
-    # 获取今日需要复习的卡片
-    due_cards = get_due_cards()
+    # 获取今日需要复习的卡片数量
+    due_cards_count = count_due_cards()
     
     # 如果有需要复习的卡片，添加复习任务
-    if due_cards:
+    if due_cards_count:
         # 获取已复习的卡片数量
         reviewed_today = session.get('cards_reviewed', 0)
         
         # 计算总卡片数
-        total_cards = len(due_cards)
+        total_cards = due_cards_count
         
         # 创建复习任务
         review_task = {
@@ -1294,27 +2172,15 @@ def get_daily_tasks():
         tasks.append(review_task)
     
     # 添加学习新单词任务
-    # 获取所有未查看的卡片
-    unviewed_cards = []
+    # 每个单元未查看的卡片数
     cards = get_user_cards()
-    if isinstance(cards, dict):
-        for card_id, card in cards.items():
-            if not hasattr(card, 'is_viewed') or not card.is_viewed:
-                unviewed_cards.append(card)
-    else:
-        print(f"Warning: cards is not a dictionary, it's a {type(cards)}")
-        unviewed_cards = []
-    
-    if unviewed_cards:
-        # 按单元分组
-        unit_cards = defaultdict(list)
-        for card in unviewed_cards:
-            unit_cards[card.unit_id].append(card)
-        
+    unviewed_counts = cards.units.unviewed() if cards else {}
+    
+    if unviewed_counts:
         # 只选择前3个单元作为今日任务
-        top_units = sorted(unit_cards.items(), key=lambda x: len(x[1]), reverse=True)[:3]
+        top_units = sorted(unviewed_counts.items(), key=lambda x: x[1], reverse=True)[:3]
         
-        for unit_id, unit_cards_list in top_units:
+        for unit_id, unviewed_count in top_units:
             # 获取已学习的卡片数量
             learned_count = 0
             if 'learned_words' in session and unit_id in session['learned_words']:
@@ -1376,38 +2242,43 @@ def mark_as_viewed(card_id):
     return jsonify({'status': 'success'})
 
 # 获取用户的FSRS实例
-def get_user_fsrs():
-    """获取当前用户的FSRS实例"""
-    username = session.get('username')
+def get_user_fsrs(username=None):
+    """获取用户的FSRS实例，默认为当前登录用户"""
+    if username is None:
+        username = session.get('username')
     if not username:
         return fsrs  # 返回默认FSRS实例
     
     # 获取用户学习模式
-    users = load_users()
-    user_data = users.get(username, {})
+    user_data = get_user(username) or {}
     study_mode = user_data.get('study_mode', 'medium')  # 默认为中等模式
     
-    # 根据学习模式设置参数
-    if study_mode == 'long_term':
-        desired_retention = 0.95
-        maximum_interval = 36500
-    elif study_mode == 'cram':
-        desired_retention = 0.80
-        maximum_interval = 30
-    else:  # medium
-        desired_retention = 0.90
-        maximum_interval = 365
-    
     # 如果用户没有自己的FSRS参数，创建一个
     if username not in user_fsrs_params:
         user_fsrs_params[username] = UserFSRSParams()
-    
-    # 返回用户特定的FSRS实例，使用学习模式对应的参数
-    return FSRS(
+    user_params = user_fsrs_params[username]
+    
+    key = (study_mode, user_params.version)
+    cached = user_fsrs_instances.get(username)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    
+    # 根据学习模式设置参数，问卷设置优先
+    desired_retention, maximum_interval = STUDY_MODE_SETTINGS.get(study_mode, STUDY_MODE_SETTINGS['medium'])
+    if user_params.desired_retention:
+        desired_retention = user_params.desired_retention
+    if user_params.maximum_interval:
+        maximum_interval = user_params.maximum_interval
+    
+    # 用户特定的FSRS实例只使用用户自己的参数，不读取全局参数文件
+    user_fsrs = FSRS(
         desired_retention=desired_retention,
         maximum_interval=maximum_interval,
-        params=user_fsrs_params[username].params
+        params=user_params.params,
+        enable_adaptive_params=False
     )
+    user_fsrs_instances[username] = (key, user_fsrs)
+    return user_fsrs
 
 # 修改rate_card函数，使用用户特定的FSRS实例
 @app.route('/rate_card', methods=['POST'])
@@ -1455,32 +2326,25 @@ def rate_card():
         # 获取用户特定的FSRS实例
         user_fsrs = get_user_fsrs()
         
-        # 如果卡片过期，调整稳定性
-        if overdue_days > 0 and card.memory_state:
-            # 根据过期天数调整稳定性，过期越久稳定性下降越多
-            decay_factor = 1.0 / (1.0 + 0.1 * overdue_days)  # 平滑衰减函数
-            card.memory_state.stability *= decay_factor
-            card.memory_state.stability = max(user_fsrs.INIT_STABILITY * 0.5, card.memory_state.stability)  # 确保不会低于初始稳定性的一半
+        # 记录评分前的复习记录数量，之后只追加新增的记录
+        logs_before = len(card.review_logs)
         
-        # 更新记忆状态
-        updated_card = user_fsrs.review_card(card, rating)
+        # 更新记忆状态并追加本次的复习记录；过期的影响已由遗忘曲线按实际间隔计入，与重放复习记录的结果一致
+        updated_card = user_fsrs.review_card(card, rating, review_time=now)
         card.memory_state = updated_card.memory_state
         
-        # 计算下次复习时间
-        interval_days = user_fsrs.next_interval(card.memory_state.stability)
+        # 计算下次复习时间，负载均衡时在波动范围内选择到期卡片最少的一天
+        load_balancer = None
+        if LOAD_BALANCE_SCHEDULING:
+            histogram = user_due_histograms.get(session.get('username'))
+            load_balancer = lambda low, high, preferred: histogram.least_loaded(now, low, high, preferred)
+        interval_days = user_fsrs.next_interval(card.memory_state.stability, load_balancer=load_balancer)
         card.due_date = now + timedelta(days=interval_days)
         
-        # 添加复习记录，直接使用顶层导入的 FsrsReviewLog
-        review_log = FsrsReviewLog(
-            timestamp=now,
-            rating=rating,
-            elapsed_days=overdue_days,
-            scheduled_days=interval_days,
-        )
-        card.review_logs.append(review_log)
-        
         # 更新卡片
         update_card(card)
+        record_review_logs(session.get('username'), card.id, card.review_logs[logs_before:])
+        param_scheduler.note_reviews(session.get('username'))
         
         # 更新会话中的复习计数
         if 'cards_reviewed' not in session:
@@ -1513,21 +2377,23 @@ def reset_session():
         del session['cards_reviewed']
     
     # 移除今天添加的所有复习记录，并将今天标记为已学习的单词重置为未学习
-    cards_modified = False
+    modified_card_ids = []
     username = session.get('username')
-    if username and username in user_card_states:
-        for card_id, state in list(user_card_states[username].items()): # 使用list()避免在迭代时修改字典
+    states = user_card_states.get(username) if username else None
+    if states is not None:
+        for card_id, state in list(states.items()): # 使用list()避免在迭代时修改字典
             # 处理复习记录
             if hasattr(state, 'review_logs') and state.review_logs:
                 # 过滤出今天之前的复习记录
                 new_logs = [log for log in state.review_logs if log.timestamp < today]
                 if len(new_logs) != len(state.review_logs):
                     state.review_logs = new_logs
-                    cards_modified = True
+                    modified_card_ids.append(card_id)
     
     # 如果有修改，保存卡片数据
-    if cards_modified:
-        save_cards()
+    if modified_card_ids:
+        save_card_states(username, states, modified_card_ids)
+        delete_review_logs(username, since=today)
     
     # 重定向回首页
     return redirect(url_for('index'))
@@ -1565,17 +2431,9 @@ def review_data():
         'data': {}
     }
     
-    # 遍历所有卡片，收集复习记录
-    cards = get_user_cards()
-    if isinstance(cards, dict):
-        for card_id, card in cards.items():
-            if hasattr(card, 'review_logs') and card.review_logs:
-                for log in card.review_logs:
-                    log_date = log.timestamp.strftime('%Y-%m-%d')
-                    if log_date in result['data']:
-                        result['data'][log_date] += 1
-                    else:
-                        result['data'][log_date] = 1
+    # 按天统计时间范围内的复习记录
+    until = end_date.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    result['data'] = get_daily_review_counts(session.get('username'), since=start_date, until=until)
     
     # 计算统计数据
     total_reviews = sum(result['data'].values())
@@ -1643,6 +2501,75 @@ def review_data():
     
     return jsonify(result)
 
+def _create_simulator(user_fsrs, cards, replicas, today):
+    """按用户的参数和复习记录创建复习量模拟器
+    
+    Returns:
+        (模拟器, 卡片初始状态, 每天学习的新卡片数)，没有批量计算引擎时返回None
+    """
+    batch = user_fsrs.batch() if hasattr(user_fsrs, 'batch') else None
+    if batch is None:
+        return None
+    log_lists = [card.review_logs for card in cards if getattr(card, 'review_logs', None)]
+    first_ratings, forgot_ratings, recalled_ratings = rating_probabilities(log_lists)
+    simulator = WorkloadSimulator(batch, replicas=replicas, first_ratings=first_ratings,
+                                  forgot_ratings=forgot_ratings, recalled_ratings=recalled_ratings)
+    return simulator, WorkloadSimulator.card_arrays(cards, today), new_cards_rate(log_lists, today)
+
+def forecast_workload(cards, days=30, user_fsrs=None):
+    """模拟未来每天的复习量
+    
+    从卡片当前状态出发，按用户参数逐日模拟复习和新卡片学习，
+    评分分布和每天学习的新卡片数从用户的复习记录中估计。
+    
+    Returns:
+        {'dates', 'counts', 'low', 'high', 'new_cards', 'retention'}，counts为期望复习量，low/high为置信区间
+    """
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    user_fsrs = user_fsrs or get_user_fsrs()
+    dates = [(today + timedelta(days=i)).strftime('%m-%d') for i in range(days)]
+    created = _create_simulator(user_fsrs, cards, FORECAST_REPLICAS, today)
+    if created is None:
+        # 没有批量计算引擎时只统计当前的到期时间
+        counts = user_fsrs.estimate_workload(cards, days)
+        return {'dates': dates, 'counts': counts, 'low': counts, 'high': counts, 'new_cards': [0] * days, 'retention': []}
+    
+    simulator, arrays, new_cards_per_day = created
+    result = simulator.run(arrays['stability'], arrays['difficulty'], arrays['last_review'], arrays['due'], days,
+                           new_cards=arrays['new_cards'], new_cards_per_day=new_cards_per_day)
+    return {
+        'dates': dates,
+        'counts': [round(count, 1) for count in result['reviews_mean']],
+        'low': result['reviews_low'],
+        'high': result['reviews_high'],
+        'new_cards': result['new_cards'],
+        'retention': [round(value, 4) for value in result['retention']]
+    }
+
+def get_optimal_retention(username, cards):
+    """计算用户的最优期望保留率及复习时间与保留率的权衡曲线，按参数版本缓存
+    
+    Returns:
+        {'best', 'curve'}，说明见WorkloadSimulator.retention_curve；没有批量计算引擎时返回None
+    """
+    if username not in user_fsrs_params:
+        user_fsrs_params[username] = UserFSRSParams()
+    version = user_fsrs_params[username].version
+    cached = user_retention_curves.get(username)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    created = _create_simulator(get_user_fsrs(username), cards, RETENTION_SEARCH_REPLICAS, today)
+    if created is None:
+        return None
+    simulator, arrays, new_cards_per_day = created
+    result = simulator.retention_curve(arrays['stability'], arrays['difficulty'], arrays['last_review'], arrays['due'],
+                                       RETENTION_SEARCH_DAYS, new_cards=arrays['new_cards'],
+                                       new_cards_per_day=new_cards_per_day)
+    user_retention_curves[username] = (version, result)
+    return result
+
 # 修改fsrs_analytics路由，支持用户特定的FSRS参数
 @app.route('/fsrs_analytics')
 @login_required
@@ -1668,13 +2595,8 @@ def fsrs_analytics():
     avg_retention = round(sum(retention_rates) / max(1, len(retention_rates)) * 100) if retention_rates else 0
     
     # 统计每天的复习次数
-    daily_reviews = {}
+    daily_reviews = get_daily_review_counts(session.get('username'))
     cards = get_user_cards()
-    for card_id, card in cards.items():
-        if hasattr(card, 'review_logs'):
-            for log in card.review_logs:
-                log_date = log.timestamp.strftime('%Y-%m-%d')
-                daily_reviews[log_date] = daily_reviews.get(log_date, 0) + 1
     
     # 计算平均每日复习量
     avg_daily_reviews = round(sum(daily_reviews.values()) / max(1, len(daily_reviews))) if daily_reviews else 0
@@ -1755,11 +2677,19 @@ def fsrs_analytics():
     # 获取用户FSRS参数
     username = session.get('username')
     user_params = None
+    optimization_count = 0
     if username and username in user_fsrs_params:
         user_params = user_fsrs_params[username].params
+        optimization_count = user_fsrs_params[username].optimization_count
     else:
         user_params = FSRS.DEFAULT_PARAMS
     
+    # 后台参数优化任务状态
+    optimization = {
+        'count': optimization_count,
+        'job': param_scheduler.status(username) if username else None
+    }
+    
     # 准备FSRS参数数据
     params_data = [
         {"description": "记忆稳定性权重", "value": user_params[0], "default": FSRS.DEFAULT_PARAMS[0]},
@@ -1777,19 +2707,20 @@ def fsrs_analytics():
     # 使用用户的FSRS实例计算记忆曲线
     user_fsrs = get_user_fsrs()
     avg_stability = 30  # 假设平均稳定性为30天
-    for day in retention_days:
-        retention_rates_curve.append(user_fsrs._forgetting_curve(avg_stability, day))
+    batch = user_fsrs.batch() if hasattr(user_fsrs, 'batch') else None
+    if batch is not None:
+        retention_rates_curve = batch.forgetting_curve(avg_stability, retention_days).tolist()
+    else:
+        for day in retention_days:
+            retention_rates_curve.append(user_fsrs._forgetting_curve(avg_stability, day))
     
-    # 准备工作量预测数据
-    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-    workload_days = [(today + timedelta(days=i)).strftime('%m-%d') for i in range(30)]
-    workload_counts = [0] * 30
+    # 准备工作量预测数据(模拟未来30天，包括复习产生的复习和新卡片)
+    workload = forecast_workload(all_cards, 30, user_fsrs)
     
-    for card in all_cards:
-        if hasattr(card, 'due_date'):
-            due_day = (card.due_date - today).days
-            if 0 <= due_day < 30:
-                workload_counts[due_day] += 1
+    # 最优期望保留率：复习时间与记住卡片数的权衡曲线
+    retention_optimum = get_optimal_retention(username, all_cards) if username else None
+    if retention_optimum is not None:
+        retention_optimum = dict(retention_optimum, current=user_fsrs.desired_retention)
     
     # 准备复习历史数据
     review_dates = sorted(daily_reviews.keys())[-30:] if daily_reviews else []  # 最近30天
@@ -1799,7 +2730,7 @@ def fsrs_analytics():
     stats = {
         'total': len(all_cards),
         'learned': learned_words_count,
-        'due': len(get_due_cards()),
+        'due': count_due_cards(),
         'avg_stability': sum(card.memory_state.stability for card in all_cards if hasattr(card, 'memory_state') and card.memory_state) / max(1, sum(1 for card in all_cards if hasattr(card, 'memory_state') and card.memory_state))
     }
     
@@ -1809,12 +2740,6 @@ def fsrs_analytics():
         'counts': review_counts
     }
     
-    # 准备工作量预测数据
-    workload = {
-        'dates': workload_days,
-        'counts': workload_counts
-    }
-    
     try:
         return render_template('fsrs_analytics.html',
                           learned_words_count=learned_words_count,
@@ -1826,51 +2751,68 @@ def fsrs_analytics():
                           recent_cards=recent_cards,
                           daily_reviews=daily_reviews,
                           params=params_data,
+                          optimization=optimization,
                           retention_days=retention_days,
                           retention_rates=retention_rates_curve,
                           stats=stats,
                           review_history=review_history,
-                          workload=workload)
+                          workload=workload,
+                          retention_optimum=retention_optimum)
     except Exception as e:
         print(f"渲染模板出错: {e}")
         import traceback
         traceback.print_exc()
         return f"渲染模板出错: {str(e)}"
 
+@app.route('/apply_optimal_retention', methods=['POST'])
+@login_required
+def apply_optimal_retention():
+    """把计算得到的最优期望保留率设为用户的调度设置"""
+    username = session['username']
+    result = get_optimal_retention(username, list(get_user_cards().values()))
+    if not result or result['best'] is None:
+        flash('暂时无法计算最优保留率', 'error')
+        return redirect(url_for('fsrs_analytics'))
+    
+    params = list(user_fsrs_params[username].params)
+    if set_user_fsrs_params(username, params, settings={'desired_retention': result['best']}):
+        flash(f"期望保留率已设为 {result['best'] * 100:.0f}%", 'success')
+    else:
+        flash('保存设置失败', 'error')
+    return redirect(url_for('fsrs_analytics'))
+
+@app.route('/api/workload_forecast')
+@login_required
+def workload_forecast():
+    """预测未来一段时间每天的复习量，days参数为预测天数(不超过FORECAST_MAX_DAYS)"""
+    days = request.args.get('days', 30, type=int) or 30
+    days = max(1, min(days, FORECAST_MAX_DAYS))
+    return jsonify(forecast_workload(list(get_user_cards().values()), days))
+
 @app.route('/word_search')
 @login_required
 def word_search():
     """单词搜索页面"""
     query = request.args.get('q', '').strip()
     
-    # 搜索卡片
+    # 搜索卡片正面和背面，查询为空时列出所有卡片
+    if query:
+        matched_cards = search_cards(query, include_back=True)
+    else:
+        matched_cards = list(get_user_cards().values())
+    
     search_results = []
-    cards = get_user_cards()
-    for card_id, card in cards.items():
-        # 提取卡片中的实际单词和含义
-        front_text = card.front.lower()
-        back_text = card.back.lower()
-        
-        # 如果查询字符串在前面或后面的文本中，添加到结果
-        if query.lower() in front_text or query.lower() in back_text:
-            # 提取单词名称 - 尝试从HTML中提取，如果失败则使用前50个字符
-            word_name = front_text[:50]
-            if '<h3 class="word">' in front_text:
-                try:
-                    word_name = front_text.split('<h3 class="word">')[1].split('</h3>')[0].strip()
-                except:
-                    pass
-            
-            search_results.append({
-                'id': card_id,
-                'word': word_name,
-                'front': card.front,
-                'back': card.back,
-                'unit_id': card.unit_id,
-                'is_viewed': card.is_viewed if hasattr(card, 'is_viewed') else False,
-                'due_date': card.due_date.strftime('%Y-%m-%d') if hasattr(card, 'due_date') else '',
-                'review_count': len(card.review_logs) if hasattr(card, 'review_logs') else 0
-            })
+    for card in matched_cards:
+        search_results.append({
+            'id': card.id,
+            'word': extract_word(card.front.lower()),
+            'front': card.front,
+            'back': card.back,
+            'unit_id': card.unit_id,
+            'is_viewed': card.is_viewed,
+            'due_date': card.due_date.strftime('%Y-%m-%d'),
+            'review_count': len(card.review_logs)
+        })
     
     # 单元名称映射
     unit_names = {
@@ -1905,34 +2847,12 @@ def word_search():
 @login_required
 def word_suggestions():
     """获取单词建议的API"""
-    query = request.args.get('q', '').strip().lower()
+    query = request.args.get('q', '').strip()
     
-    if not query or len(query) < 1:
+    if not query:
         return jsonify([])
     
-    # 从所有卡片中提取单词
-    suggestions = set()
-    cards = get_user_cards()
-    for card_id, card in cards.items():
-        # 提取单词
-        word = ""
-        if '<h3 class="word">' in card.front:
-            try:
-                word = card.front.split('<h3 class="word">')[1].split('</h3>')[0].strip()
-            except:
-                word = card.front[:50]
-        else:
-            # 如果没有HTML标记，使用前50个字符
-            word = card.front[:50]
-        
-        # 如果单词包含查询字符串，添加到建议中
-        if query in word.lower():
-            suggestions.add(word)
-    
-    # 限制返回的建议数量
-    suggestions_list = list(suggestions)
-    suggestions_list.sort()
-    return jsonify(suggestions_list[:10])
+    return jsonify(suggest_words(query))
 
 @app.route('/add_word/<unit_id>', methods=['GET', 'POST'])
 @login_required
@@ -1965,11 +2885,13 @@ def add_word(unit_id):
         # 保存为用户自己的卡片
         username = session.get('username')
         if username:
-            if username not in user_card_states:
-                user_card_states[username] = {}
+            states = user_card_states.get(username)
+            if states is None:
+                states = {}
+                user_card_states[username] = states
             
             # 创建用户卡片状态
-            user_card_states[username][card_id] = CardState(
+            states[card_id] = CardState(
                 card_id=card_id,
                 is_viewed=True,  # 新添加的卡片默认为已查看
                 due_date=now,
@@ -1982,7 +2904,10 @@ def add_word(unit_id):
                 }
             )
             
-            save_cards()
+            user_due_histograms[username].add(now)
+            user_due_indexes[username].update(card_id, now)
+            user_card_views[username].refresh(card_id)
+            save_card_states(username, states, [card_id])
         
         flash('单词添加成功', 'success')
         return redirect(url_for('unit', unit_id=unit_id))
@@ -2107,8 +3032,12 @@ def delete_word(card_id):
             # 只允许删除用户自己添加的卡片
             if state.is_user_card:
                 # 删除用户卡片
+                if state.is_viewed:
+                    user_due_histograms[username].remove(state.due_date)
+                user_due_indexes[username].discard(card_id)
                 del user_card_states[username][card_id]
-                save_cards()
+                user_card_views[username].discard(card_id)
+                delete_card_states(username, [card_id])
                 
                 return jsonify({
                     'status': 'success',
@@ -2136,22 +3065,28 @@ def restore_word(card_id):
             return jsonify({'status': 'error', 'message': '系统卡片不存在'})
         
         # 检查用户卡片状态是否存在
-        if username in user_card_states and card_id in user_card_states[username]:
-            state = user_card_states[username][card_id]
+        states = user_card_states.get(username)
+        if states is not None and card_id in states:
+            state = states[card_id]
             
             # 如果是用户自定义卡片，不能还原
             if state.is_user_card:
                 return jsonify({'status': 'error', 'message': '用户自定义卡片不能还原'})
             
             # 还原卡片内容到系统原始状态
+            if state.is_viewed:
+                user_due_histograms[username].remove(state.due_date)
+            user_due_indexes[username].discard(card_id)
             state.is_viewed = False  # 重置查看状态
             state.memory_state = None  # 清除记忆状态
             state.review_logs = []  # 清除复习记录
             state.due_date = system_card.created_at  # 重置到期时间
             state.learning_factor = 1.0  # 重置学习因子
+            user_card_views[username].refresh(card_id)
             
             # 保存更改
-            save_cards()
+            save_card_states(username, states, [card_id])
+            delete_review_logs(username, card_id=card_id)
             
             return jsonify({
                 'status': 'success',
@@ -2317,6 +3252,11 @@ def create_card_states_for_all_users(card_id, unit_id, front, back, created_at):
                 
                 session_db.commit()
                 print(f"为 {len(users)} 个用户创建了卡片 {card_id} 的默认状态")
+                # 新卡片直接写入了数据库，丢弃本进程缓存的用户数据并通知其他工作进程
+                usernames = [user.username for user in users]
+                for username in usernames:
+                    invalidate_user_state(username)
+                StorageAdapter.bump_user_versions(usernames)
                 return True
             except Exception as e:
                 session_db.rollback()
@@ -2331,17 +3271,16 @@ def create_card_states_for_all_users(card_id, unit_id, front, back, created_at):
         # 文件存储模式
         try:
             # 为所有用户创建该卡片的默认状态
-            for username in user_card_states:
-                if card_id not in user_card_states[username]:
-                    user_card_states[username][card_id] = CardState(
+            for username, states in user_card_states.items():
+                if card_id not in states:
+                    states[card_id] = CardState(
                         card_id=card_id,
                         is_viewed=False,
                         due_date=created_at,
                         learning_factor=1.0,
                         is_user_card=False
                     )
-            
-            save_cards()
+                    save_card_states(username, states, [card_id])
             print(f"为 {len(user_card_states)} 个用户创建了卡片 {card_id} 的默认状态")
             return True
         except Exception as e:
@@ -2374,13 +3313,15 @@ def questionnaire():
         daily_study_time, weekly_study_days
     )
     
+    username = session['username']
+    
     # 保存问卷数据到数据库
     if USE_DATABASE:
         from models.database import get_db_session, UserQuestionnaire
-        session = get_db_session()
+        db_session = get_db_session()
         try:
             # 检查是否已存在问卷数据
-            existing = session.query(UserQuestionnaire).filter_by(username=session['username']).first()
+            existing = db_session.query(UserQuestionnaire).filter_by(username=username).first()
             if existing:
                 # 更新现有数据
                 existing.learning_mode = learning_mode
@@ -2393,7 +3334,7 @@ def questionnaire():
             else:
                 # 创建新数据
                 questionnaire_data = UserQuestionnaire(
-                    username=session['username'],
+                    username=username,
                     learning_mode=learning_mode,
                     exam_months=exam_months,
                     exam_days=exam_days,
@@ -2401,47 +3342,20 @@ def questionnaire():
                     weekly_study_days=weekly_study_days,
                     start_unit=start_unit
                 )
-                session.add(questionnaire_data)
+                db_session.add(questionnaire_data)
             
-            session.commit()
+            db_session.commit()
         except Exception as e:
-            session.rollback()
+            db_session.rollback()
             print(f"保存问卷数据失败: {e}")
         finally:
-            session.close()
+            db_session.close()
     
-    # 保存FSRS参数
-    if USE_DATABASE:
-        from models.database import get_db_session, UserFSRSParam
-        session = get_db_session()
-        try:
-            # 检查是否已存在FSRS参数
-            existing = session.query(UserFSRSParam).filter_by(username=session['username']).first()
-            if existing:
-                # 更新现有参数
-                existing.set_params(fsrs_params)
-                existing.last_updated = datetime.now()
-            else:
-                # 创建新参数
-                fsrs_param = UserFSRSParam(
-                    username=session['username'],
-                    params=json.dumps(fsrs_params),
-                    last_updated=datetime.now()
-                )
-                session.add(fsrs_param)
-            
-            session.commit()
-        except Exception as e:
-            session.rollback()
-            print(f"保存FSRS参数失败: {e}")
-        finally:
-            session.close()
-    else:
-        # 文件模式保存
-        user_fsrs_params = get_user_fsrs_params()
-        user_fsrs_params.params = fsrs_params
-        user_fsrs_params.last_updated = datetime.now()
-        save_user_fsrs_params(user_fsrs_params)
+    # 保存FSRS参数和问卷得出的调度设置，缓存的FSRS实例随参数版本一起更新
+    set_user_fsrs_params(username, fsrs_params['base_params'], settings={
+        'desired_retention': fsrs_params['desired_retention'],
+        'maximum_interval': fsrs_params['maximum_interval']
+    })
     
     flash('问卷提交成功！你的学习计划已经个性化设置。', 'success')
     return redirect(url_for('index'))
@@ -2538,13 +3452,13 @@ def get_user_questionnaire_data():
     """获取用户问卷数据"""
     if USE_DATABASE:
         from models.database import get_db_session, UserQuestionnaire
-        session = get_db_session()
+        db_session = get_db_session()
         try:
-            questionnaire = session.query(UserQuestionnaire).filter_by(username=session['username']).first()
+            questionnaire = db_session.query(UserQuestionnaire).filter_by(username=session['username']).first()
             if questionnaire:
                 return questionnaire.to_dict()
         except Exception as e:
             print(f"获取问卷数据失败: {e}")
         finally:
-            session.close()
+            db_session.close()
     return None
\ No newline at end of file
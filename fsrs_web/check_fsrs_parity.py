@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+检查FSRS批量计算与逐张卡片计算的结果一致。
+
+用法：
+    python check_fsrs_parity.py [--cards N] [--seed SEED]
+
+检查项：
+    batch     FSRSBatch的复习更新、保留率矩阵与FSRS.review_card、FSRS.predict_retention一致
+    gradient  FSRSBatch.loss_and_gradient的解析梯度与有限差分一致
+    replay    重放复习记录(replay_logs)得到的记忆状态、学习因子和下次复习时间，
+              与依次按rate_card的方式评分(review_card + 不加波动的间隔)的结果一致
+
+修改fsrs.py或fsrs_batch.py中的公式后运行，任一检查不通过时以状态码1退出。
+只使用随机生成的卡片，不读写应用数据。
+"""
+import argparse
+import math
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# 项目内导入（确保脚本可单独运行）
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from models.fsrs import FSRS, Card, MemoryState
+from models.fsrs_batch import FSRSBatch, ReviewDataset
+from models.replay import replay_logs
+
+START = datetime(2025, 1, 1)
+
+
+def new_card(card_id):
+    return Card(id=str(card_id), unit_id='unit1', front='word', back='meaning', created_at=START, due_date=START)
+
+
+def random_fsrs(rng):
+    """参数在默认值附近随机扰动的调度器"""
+    params = [value * rng.uniform(0.8, 1.2) for value in FSRS.DEFAULT_PARAMS]
+    return FSRS(params=params, desired_retention=rng.uniform(0.8, 0.95), maximum_interval=365,
+                enable_adaptive_params=False)
+
+
+def reviewed_cards(fsrs, rng, count):
+    """按rate_card的方式随机复习若干次的卡片：review_card更新记忆状态，到期时间使用不加波动的间隔"""
+    cards = []
+    for card_id in range(count):
+        card = new_card(card_id)
+        review_time = START + timedelta(hours=rng.uniform(0, 500))
+        for _ in range(rng.randint(1, 12)):
+            card = fsrs.review_card(card, rng.randint(1, 4), review_time=review_time)
+            _, interval, _ = fsrs.fuzz_range(card.memory_state.stability)
+            card.due_date = review_time + timedelta(days=interval)
+            review_time += timedelta(hours=rng.uniform(1, 24 * 60))
+        cards.append(card)
+    return cards
+
+
+def check_batch(rng, count):
+    """FSRSBatch.review / retrievability 与 FSRS.review_card / predict_retention"""
+    fsrs = random_fsrs(rng)
+    batch = fsrs.batch()
+    failures = 0
+
+    cards, ratings, elapsed, is_new = [], [], [], []
+    for card_id in range(count):
+        card = new_card(card_id)
+        if rng.random() < 0.8:
+            # 已有记忆状态和上次复习的卡片
+            card.memory_state = MemoryState(stability=rng.uniform(0.1, 400), difficulty=rng.uniform(1, 10))
+            card = fsrs.review_card(card, rng.randint(1, 4), review_time=START)
+        cards.append(card)
+        ratings.append(rng.randint(1, 4))
+        elapsed.append(rng.uniform(0, 400) if card.review_logs else 0.0)
+        is_new.append(card.is_new)
+
+    stability = [card.memory_state.stability if card.memory_state else math.nan for card in cards]
+    difficulty = [card.memory_state.difficulty if card.memory_state else math.nan for card in cards]
+    new_stability, new_difficulty = batch.review(stability, difficulty, ratings, elapsed, is_new=is_new)
+
+    for index, card in enumerate(cards):
+        reviewed = fsrs.review_card(card, ratings[index], review_time=START + timedelta(days=elapsed[index]))
+        expected = (reviewed.memory_state.stability, reviewed.memory_state.difficulty)
+        actual = (new_stability[index], new_difficulty[index])
+        if not np.allclose(actual, expected, rtol=1e-12, atol=1e-12):
+            print(f"  复习更新不一致: 卡片 {card.id} 批量 {actual} 逐张 {expected}")
+            failures += 1
+
+    days = [0, 1, 7, 30, 365]
+    matrix = batch.retrievability([card.memory_state.stability for card in cards], days)
+    for index, card in enumerate(cards):
+        expected = [fsrs.predict_retention(card, day) for day in days]
+        if not np.allclose(matrix[index], expected, rtol=1e-12, atol=1e-12):
+            print(f"  保留率不一致: 卡片 {card.id} 批量 {matrix[index].tolist()} 逐张 {expected}")
+            failures += 1
+    return failures
+
+
+def check_gradient(rng, count):
+    """解析梯度与中心差分"""
+    fsrs = random_fsrs(rng)
+    dataset = ReviewDataset.from_cards(reviewed_cards(fsrs, rng, count))
+    params = np.asarray(fsrs.w, dtype=float)
+    prior = params + 0.1
+    regularization = 0.1
+    _, gradient = FSRSBatch(params).loss_and_gradient(dataset, regularization, prior)
+
+    failures = 0
+    step = 1e-6
+    for index in range(len(params)):
+        plus, minus = params.copy(), params.copy()
+        plus[index] += step
+        minus[index] -= step
+        loss_plus, _ = FSRSBatch(plus).loss_and_gradient(dataset, regularization, prior)
+        loss_minus, _ = FSRSBatch(minus).loss_and_gradient(dataset, regularization, prior)
+        numeric = (loss_plus - loss_minus) / (2 * step)
+        if abs(numeric - gradient[index]) > 1e-5 * max(1.0, abs(numeric)):
+            print(f"  梯度不一致: w[{index}] 解析 {gradient[index]:.8g} 差分 {numeric:.8g}")
+            failures += 1
+    return failures
+
+
+def check_replay(rng, count):
+    """replay_logs 与依次评分的结果"""
+    fsrs = random_fsrs(rng)
+    cards = reviewed_cards(fsrs, rng, count)
+    results, _ = replay_logs({card.id: card.review_logs for card in cards}, fsrs.w,
+                             desired_retention=fsrs.desired_retention, maximum_interval=fsrs.maximum_interval)
+
+    failures = 0
+    for card in cards:
+        stability, difficulty, learning_factor, due_date = results[card.id]
+        expected = (card.memory_state.stability, card.memory_state.difficulty, card.learning_factor)
+        if (not np.allclose((stability, difficulty, learning_factor), expected, rtol=1e-9, atol=1e-9)
+                or due_date != card.due_date):
+            print(f"  重放结果不一致: 卡片 {card.id} 重放 {(stability, difficulty, learning_factor, due_date)} "
+                  f"评分 {expected + (card.due_date,)}")
+            failures += 1
+    return failures
+
+
+CHECKS = {
+    'batch': check_batch,
+    'gradient': check_gradient,
+    'replay': check_replay,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="检查FSRS批量计算与逐张卡片计算的结果一致")
+    parser.add_argument("--cards", type=int, default=500, help="每项检查生成的卡片数")
+    parser.add_argument("--seed", type=int, default=0, help="随机数种子")
+    args = parser.parse_args()
+
+    total_failures = 0
+    for name, check in CHECKS.items():
+        failures = check(random.Random(args.seed), args.cards)
+        total_failures += failures
+        print(f"{name}: {'通过' if not failures else f'{failures} 项不一致'}")
+
+    sys.exit(1 if total_failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -24,8 +24,80 @@ DATABASE_URL = os.environ.get(
 )
 
 # 判断是否使用数据库存储(在Render平台上或明确设置了USE_DATABASE环境变量时使用)
-USE_DATABASE = os.environ.get('RENDER', '') or os.environ.get('USE_DATABASE', '').lower() == 'true'
+# USE_DATABASE=sqlite 且未设置DATABASE_URL时，使用数据目录中的嵌入式SQLite数据库，不需要外部数据库服务
+SQLITE_DATABASE_FILE = DATA_DIR / 'fsrs.sqlite3'
+_use_database = os.environ.get('USE_DATABASE', '').lower()
+if _use_database == 'sqlite' and not os.environ.get('DATABASE_URL'):
+    DATABASE_URL = f'sqlite:///{SQLITE_DATABASE_FILE}'
+USE_DATABASE = os.environ.get('RENDER', '') or _use_database in ('true', 'sqlite')
+
+# gunicorn工作进程数和每个进程的线程数(与gunicorn_config.py读取相同的环境变量)
+GUNICORN_WORKERS = int(os.environ.get('GUNICORN_WORKERS', '2'))
+GUNICORN_THREADS = int(os.environ.get('GUNICORN_THREADS', '2'))
+
+# SQLite配置：WAL模式下多个gunicorn工作进程可以同时读取同一个数据库文件
+# 写锁冲突时最长等待时间(毫秒)、同步级别(OFF/NORMAL/FULL/EXTRA)和每个进程连接池常驻的连接数(请求线程数加写后队列后台线程)
+SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', '5000'))
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL').upper()
+SQLITE_POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE', str(GUNICORN_THREADS + 2)))
+
+# 数据库连接池配置，默认按gunicorn的工作进程数和线程数计算
+# 每个工作进程常驻的连接：每个请求线程一个，再加写后队列后台线程一个；高峰时最多再溢出每线程一个
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', str(GUNICORN_THREADS + 1)))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', str(GUNICORN_THREADS)))
+# 数据库允许本应用使用的总连接数，设置后按工作进程数平分，0表示不限制
+DB_MAX_CONNECTIONS = int(os.environ.get('DB_MAX_CONNECTIONS', '0'))
+if DB_MAX_CONNECTIONS > 0:
+    _connections_per_worker = max(1, DB_MAX_CONNECTIONS // max(1, GUNICORN_WORKERS))
+    DB_POOL_SIZE = min(DB_POOL_SIZE, _connections_per_worker)
+    DB_MAX_OVERFLOW = max(0, min(DB_MAX_OVERFLOW, _connections_per_worker - DB_POOL_SIZE))
+# 等待空闲连接的超时(秒)、连接最长复用时间(秒)、检出前是否先ping检测失效连接
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '30'))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', '1800'))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'
+# PostgreSQL建立连接的超时(秒)和单条语句的超时(毫秒)，0表示不限制
+DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', '10'))
+DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', '30000'))
 
 # Flask配置
 SECRET_KEY = os.environ.get('SECRET_KEY', 'dev_key_for_development_only')
-DEBUG = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true' 
\ No newline at end of file
+DEBUG = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'
+
+# 写后队列配置：卡片状态修改先进入内存队列，达到批量大小或刷新间隔(秒)时由后台线程批量写入存储，
+# 请求不等待写入；数据库模式下请求结束时只在用户版本行上登记未写入的修改，
+# 其他工作进程读取该用户前最多等待WRITE_BEHIND_PENDING_TIMEOUT秒，超过后视为登记的进程已退出
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', '50'))
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.environ.get('WRITE_BEHIND_FLUSH_INTERVAL', '2.0'))
+WRITE_BEHIND_PENDING_TIMEOUT = float(os.environ.get('WRITE_BEHIND_PENDING_TIMEOUT', '10.0'))
+
+# 用户数据缓存配置(数据库模式)：用户卡片状态在首次访问时加载，按LRU淘汰
+# 最大卡片状态总数和空闲淘汰时间(秒)设为0表示不限制
+USER_CACHE_MAX_USERS = int(os.environ.get('USER_CACHE_MAX_USERS', '200'))
+USER_CACHE_MAX_CARD_STATES = int(os.environ.get('USER_CACHE_MAX_CARD_STATES', '0'))
+USER_CACHE_IDLE_SECONDS = int(os.environ.get('USER_CACHE_IDLE_SECONDS', '1800'))
+
+# 文件存储模式的卡片状态日志：修改追加到日志文件，日志超过该大小(字节)时压缩进快照，设为0表示不自动压缩
+CARD_JOURNAL_FILE = DATA_DIR / 'card_states.journal'
+CARD_JOURNAL_COMPACT_BYTES = int(os.environ.get('CARD_JOURNAL_COMPACT_BYTES', str(8 * 1024 * 1024)))
+CARD_JOURNAL_FSYNC = os.environ.get('CARD_JOURNAL_FSYNC', 'true').lower() == 'true'
+
+# FSRS参数后台优化：用户新增多少条复习记录后安排一次优化，进程池大小，最多排队的任务数和最大迭代次数
+OPTIMIZER_REVIEW_THRESHOLD = int(os.environ.get('OPTIMIZER_REVIEW_THRESHOLD', '50'))
+OPTIMIZER_WORKERS = int(os.environ.get('OPTIMIZER_WORKERS', '1'))
+OPTIMIZER_MAX_PENDING = int(os.environ.get('OPTIMIZER_MAX_PENDING', '16'))
+OPTIMIZER_ITERATIONS = int(os.environ.get('OPTIMIZER_ITERATIONS', '100'))
+
+# 复习量预测：蒙特卡洛模拟的随机副本数和最多预测的天数
+FORECAST_REPLICAS = int(os.environ.get('FORECAST_REPLICAS', '50'))
+FORECAST_MAX_DAYS = int(os.environ.get('FORECAST_MAX_DAYS', '365'))
+
+# 最优期望保留率搜索：每个候选保留率的随机副本数和模拟天数
+RETENTION_SEARCH_REPLICAS = int(os.environ.get('RETENTION_SEARCH_REPLICAS', '4'))
+RETENTION_SEARCH_DAYS = int(os.environ.get('RETENTION_SEARCH_DAYS', '365'))
+
+# 排期负载均衡：在随机波动范围内选择到期卡片最少的一天，设为false时按随机波动排期
+LOAD_BALANCE_SCHEDULING = os.environ.get('LOAD_BALANCE_SCHEDULING', 'true').lower() == 'true'
+
+# 积压复习：到期卡片超过每天的复习容量时提示把过期卡片分摊到接下来的天数
+BACKLOG_DAILY_CAPACITY = int(os.environ.get('BACKLOG_DAILY_CAPACITY', '100'))
+BACKLOG_DAYS = int(os.environ.get('BACKLOG_DAYS', '7'))
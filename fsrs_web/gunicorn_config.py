@@ -1,4 +1,5 @@
 import os
+import sys
 
 # 工作进程数量 - 可以根据应用需求调整
 workers = int(os.environ.get('GUNICORN_WORKERS', '2'))
@@ -19,4 +20,21 @@ worker_class = 'sync'
 limit_request_line = 0
 
 # 应用程序模块路径
-app = 'app:app' 
\ No newline at end of file
+app = 'app:app'
+
+
+def worker_exit(server, worker):
+    """工作进程退出时写入写后队列中剩余的卡片状态"""
+    app_module = sys.modules.get('app')
+    queue = getattr(app_module, 'card_write_queue', None)
+    if queue is not None:
+        rows, elapsed = queue.stop()
+        server.log.info(f"工作进程 {worker.pid} 退出前写入 {rows} 行卡片状态，耗时 {elapsed * 1000:.1f} ms")
+    storage = getattr(app_module, 'StorageAdapter', None)
+    pool_stats = storage.get_pool_stats() if storage is not None else None
+    if pool_stats:
+        server.log.info(
+            f"工作进程 {worker.pid} 数据库连接池: 检出 {pool_stats['checkouts']} 次，"
+            f"新建连接 {pool_stats['connects']} 次，等待 {pool_stats['waits']} 次(最长 {pool_stats['max_wait_ms']} ms)，"
+            f"超时 {pool_stats['timeouts']} 次，溢出检出 {pool_stats['overflow_checkouts']} 次，失效连接 {pool_stats['invalidations']} 次"
+        )
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+积压复习的重新排期
+
+长时间没有复习后，到期卡片会大量积压。这里一次向量化计算所有过期卡片当前的保留率，
+按紧急程度排序，再按每天的复习容量分摊到接下来的若干天。
+"""
+
+import numpy as np
+
+try:
+    from models.fsrs_batch import FSRSBatch
+except ImportError:
+    from fsrs_web.models.fsrs_batch import FSRSBatch
+
+
+def plan_backlog(batch: FSRSBatch, stability, elapsed_days, capacity: int, days: int, load=None):
+    """为过期卡片安排复习日期
+
+    保留率越低越紧急，保留率相同时稳定性低的优先；没有记忆状态(尚未评分)的卡片排在最后。
+    按紧急程度依次填满每天剩余的容量，总容量不够时多出的卡片平均分摊到各天。
+
+    Args:
+        batch: 使用用户参数的批量计算引擎
+        stability: 过期卡片的稳定性，没有记忆状态的为NaN
+        elapsed_days: 距离上次复习的天数
+        capacity: 每天最多复习的卡片数
+        days: 分摊的天数，第0天为今天
+        load: 这些天中已经安排的复习数(不含这些过期卡片)，默认为0
+
+    Returns:
+        (order, offsets, retrievability)：order为按紧急程度排列的卡片下标，
+        offsets为order中每张卡片安排在第几天，retrievability为每张卡片当前的保留率(没有记忆状态的为NaN)
+    """
+    stability = np.asarray(stability, dtype=float)
+    days = max(1, int(days))
+    has_state = ~np.isnan(stability)
+    retrievability = np.where(
+        has_state,
+        batch.forgetting_curve(np.where(has_state, stability, 1.0), elapsed_days),
+        np.nan
+    )
+
+    urgency = np.where(has_state, retrievability, np.inf)
+    order = np.lexsort((np.where(has_state, stability, np.inf), urgency))
+
+    load = np.zeros(days, dtype=int) if load is None else np.asarray(load, dtype=int)[:days]
+    slots = np.cumsum(np.maximum(capacity - load, 0))
+    positions = np.arange(order.size)
+    offsets = np.searchsorted(slots, positions, side='right')
+    overflow = offsets >= days
+    if overflow.any():
+        offsets[overflow] = (positions[overflow] - slots[-1]) % days
+    return order, offsets, retrievability
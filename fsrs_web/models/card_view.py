@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+用户卡片视图
+
+卡片内容来自所有用户共享的系统卡片(用户自己添加的卡片来自卡片状态中的卡片数据)，
+学习进度来自用户的卡片状态。视图只保存这两个引用，读取属性时直接访问原对象，不复制数据；
+每个用户的视图集合只构建一次，之后随卡片状态的增删增量更新。
+"""
+
+from datetime import datetime
+
+try:
+    from models.unit_index import UnitIndex
+    from models.search_index import SearchIndex, PrefixIndex
+except ImportError:
+    from fsrs_web.models.unit_index import UnitIndex
+    from fsrs_web.models.search_index import SearchIndex, PrefixIndex
+
+
+class CardView:
+    """只读的用户卡片，属性与Card相同"""
+
+    __slots__ = ('_card', '_state')
+
+    def __init__(self, card, state):
+        """
+        Args:
+            card: 系统卡片，用户自己添加的卡片为None
+            state: 用户的卡片状态
+        """
+        object.__setattr__(self, '_card', card)
+        object.__setattr__(self, '_state', state)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"卡片视图是只读的，不能修改 {name}")
+
+    def __repr__(self):
+        return f"CardView(id={self.id!r}, unit_id={self.unit_id!r})"
+
+    def _content(self, name, default=''):
+        if self._card is not None:
+            return getattr(self._card, name)
+        return (self._state.user_card_data or {}).get(name, default)
+
+    # 卡片内容
+
+    @property
+    def id(self):
+        return self._state.card_id
+
+    @property
+    def unit_id(self):
+        return self._content('unit_id')
+
+    @property
+    def front(self):
+        return self._content('front')
+
+    @property
+    def back(self):
+        return self._content('back')
+
+    @property
+    def created_at(self):
+        created_at = self._content('created_at', None)
+        return created_at if created_at is not None else datetime.now()
+
+    @property
+    def tags(self):
+        return ()
+
+    # 学习进度
+
+    @property
+    def state(self):
+        """用户的卡片状态"""
+        return self._state
+
+    @property
+    def due_date(self):
+        return self._state.due_date if self._state.due_date else self.created_at
+
+    @property
+    def memory_state(self):
+        return self._state.memory_state
+
+    @property
+    def review_logs(self):
+        return self._state.review_logs
+
+    @property
+    def is_viewed(self):
+        return self._state.is_viewed
+
+    @property
+    def learning_factor(self):
+        return self._state.learning_factor
+
+    @property
+    def is_user_card(self):
+        return self._state.is_user_card
+
+    @property
+    def is_new(self) -> bool:
+        """判断是否为新卡片"""
+        return len(self._state.review_logs) == 0
+
+    @property
+    def average_rating(self) -> float:
+        """计算平均评分"""
+        logs = self._state.review_logs
+        if not logs:
+            return 0.0
+        return sum(log.rating for log in logs) / len(logs)
+
+    @property
+    def retention_rate(self) -> float:
+        """计算记忆保留率"""
+        logs = self._state.review_logs
+        if not logs:
+            return 0.0
+        return sum(1 for log in logs if log.rating >= 3) / len(logs)
+
+    def to_card(self, card_class):
+        """创建可修改的卡片副本，修改后通过update_card写回卡片状态"""
+        card = card_class(
+            id=self.id,
+            unit_id=self.unit_id,
+            front=self.front,
+            back=self.back,
+            created_at=self.created_at,
+            due_date=self.due_date
+        )
+        card.memory_state = self.memory_state
+        card.review_logs = self.review_logs
+        card.is_viewed = self.is_viewed
+        card.learning_factor = self.learning_factor
+        return card
+
+
+class UserCardViews(dict):
+    """一个用户可见的全部卡片 {card_id: CardView}
+
+    顺序与原来的get_user_cards一致：先是有状态的系统卡片，再是用户自己添加的卡片。
+    units为按单元分组的索引，search和words为用户自己添加的卡片的搜索索引和自动补全索引，都与视图同步更新。
+    """
+
+    def __init__(self, system_cards, states):
+        super().__init__()
+        self.system_cards = system_cards
+        self.states = states
+        self._build()
+
+    def _build(self):
+        self.clear()
+        for card_id, card in self.system_cards.items():
+            state = self.states.get(card_id)
+            if state is not None:
+                self[card_id] = CardView(card, state)
+        for card_id, state in self.states.items():
+            if state.is_user_card and state.user_card_data:
+                self[card_id] = CardView(None, state)
+        self.units = UnitIndex.from_views(self)
+        user_cards = {card_id: view for card_id, view in self.items() if view._card is None}
+        self.search = SearchIndex.from_cards(user_cards)
+        self.words = PrefixIndex.from_cards(user_cards)
+        self._sizes = (len(self.system_cards), len(self.states))
+
+    def is_current(self, system_cards, states) -> bool:
+        """视图是否仍对应这份系统卡片和卡片状态
+
+        卡片状态字典被替换(重新加载)或增删了卡片而没有通过refresh/discard登记时返回False
+        """
+        return (self.system_cards is system_cards and self.states is states
+                and self._sizes == (len(system_cards), len(states)))
+
+    def refresh(self, card_id):
+        """卡片状态新增、被替换或查看状态改变后更新对应的视图"""
+        state = self.states.get(card_id)
+        view = self.get(card_id)
+        if state is None:
+            self.discard(card_id)
+            return
+        if view is not None and view.state is state:
+            self._index(card_id, view)
+            return
+        if state.is_user_card and state.user_card_data:
+            view = self[card_id] = CardView(None, state)
+            self._index(card_id, view)
+        elif card_id in self.system_cards:
+            # 新增系统卡片的状态时重建，保持系统卡片的顺序
+            self._build()
+            return
+        else:
+            self.pop(card_id, None)
+            self.units.discard(card_id)
+            self.search.discard(card_id)
+            self.words.discard(card_id)
+        self._sizes = (len(self.system_cards), len(self.states))
+
+    def discard(self, card_id):
+        """卡片状态被删除后移除对应的视图"""
+        self.pop(card_id, None)
+        self.units.discard(card_id)
+        self.search.discard(card_id)
+        self.words.discard(card_id)
+        self._sizes = (len(self.system_cards), len(self.states))
+
+    def _index(self, card_id, view):
+        """更新视图对应的单元索引，以及搜索和自动补全索引(只有用户自己添加的卡片)"""
+        self.units.update(card_id, view.unit_id, view.is_viewed)
+        if view._card is None:
+            self.search.add(card_id, view.front, view.back)
+            self.words.add(card_id, view.front)
+        else:
+            self.search.discard(card_id)
+            self.words.discard(card_id)
@@ -1,13 +1,201 @@
+import os
 import json
 import pickle
+import threading
+import time
 from datetime import datetime
-from sqlalchemy import create_engine, Column, String, DateTime, Boolean, Float, Integer, LargeBinary, Text, ForeignKey
+from sqlalchemy import case, create_engine, event, func, inspect, text, Column, String, DateTime, Boolean, Float, Integer, LargeBinary, Text, ForeignKey, Index
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
-from config import DATABASE_URL
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool, SingletonThreadPool
+from config import (
+    DATABASE_URL, SQLITE_BUSY_TIMEOUT, SQLITE_SYNCHRONOUS, SQLITE_POOL_SIZE,
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING,
+    DB_CONNECT_TIMEOUT, DB_STATEMENT_TIMEOUT
+)
+
+# 等待空闲连接超过该时间(秒)时打印日志
+POOL_WAIT_LOG_SECONDS = 0.1
+
+class PoolStats:
+    """数据库连接池统计：检出、新建连接、等待、超时、溢出和失效次数"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self.overflow_checkouts = 0
+        self.max_overflow_in_use = 0
+    
+    def record_checkout(self, waited=None, overflow=0):
+        """记录一次检出；waited为连接池已满时等待的秒数"""
+        with self._lock:
+            self.checkouts += 1
+            if overflow > 0:
+                self.overflow_checkouts += 1
+                self.max_overflow_in_use = max(self.max_overflow_in_use, overflow)
+            if waited is not None:
+                self.waits += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        if waited is not None and waited >= POOL_WAIT_LOG_SECONDS:
+            print(f"数据库连接池已满，等待空闲连接 {waited * 1000:.0f} ms")
+    
+    def record(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+    
+    def as_dict(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'connects': self.connects,
+                'invalidations': self.invalidations,
+                'waits': self.waits,
+                'wait_ms': round(self.wait_seconds * 1000, 1),
+                'max_wait_ms': round(self.max_wait_seconds * 1000, 1),
+                'timeouts': self.timeouts,
+                'overflow_checkouts': self.overflow_checkouts,
+                'max_overflow_in_use': self.max_overflow_in_use
+            }
+
+pool_stats = PoolStats()
+
+class InstrumentedQueuePool(QueuePool):
+    """记录检出等待和溢出情况的QueuePool"""
+    
+    def __init__(self, creator, pool_size=5, max_overflow=10, **kw):
+        super().__init__(creator, pool_size=pool_size, max_overflow=max_overflow, **kw)
+        self.overflow_limit = max_overflow
+    
+    def _do_get(self):
+        # 没有空闲连接且不能再溢出时，本次检出需要等待其他线程归还连接
+        exhausted = self.checkedin() == 0 and self.overflow() >= self.overflow_limit
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            pool_stats.record('timeouts')
+            raise
+        pool_stats.record_checkout(time.perf_counter() - start if exhausted else None, self.overflow())
+        return connection
+
+def is_sqlite_url(url):
+    """数据库URL是否指向SQLite"""
+    return make_url(url).get_backend_name() == 'sqlite'
+
+def create_db_engine(url):
+    """创建数据库引擎
+    
+    SQLite数据库文件使用普通连接池，连接在请求结束后归还，由各线程和写后队列的后台线程共用；
+    每个新连接都开启WAL模式并设置忙等待时间，读操作不会被其他进程的写操作阻塞。
+    内存数据库只存在于创建它的连接中，仍然每线程保留一个连接。
+    其他数据库使用按gunicorn线程数配置大小的连接池
+    """
+    if not is_sqlite_url(url):
+        return _create_pooled_engine(url)
+    
+    database = make_url(url).database
+    in_memory = not database or database == ':memory:'
+    if not in_memory:
+        os.makedirs(os.path.dirname(os.path.abspath(database)), exist_ok=True)
+    
+    connect_args = {
+        'check_same_thread': False,  # 连接归还后可能被其他线程检出
+        'timeout': SQLITE_BUSY_TIMEOUT / 1000
+    }
+    if in_memory:
+        sqlite_engine = create_engine(
+            url,
+            poolclass=SingletonThreadPool,
+            pool_size=SQLITE_POOL_SIZE,
+            connect_args=connect_args
+        )
+    else:
+        sqlite_engine = create_engine(
+            url,
+            poolclass=InstrumentedQueuePool,
+            pool_size=SQLITE_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            connect_args=connect_args
+        )
+    synchronous = SQLITE_SYNCHRONOUS if SQLITE_SYNCHRONOUS in ('OFF', 'NORMAL', 'FULL', 'EXTRA') else 'NORMAL'
+    
+    @event.listens_for(sqlite_engine, 'connect')
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if not in_memory:
+            cursor.execute('PRAGMA journal_mode=WAL')
+        # WAL模式下NORMAL只在检查点时同步，崩溃不会损坏数据库
+        cursor.execute(f'PRAGMA synchronous={synchronous}')
+        cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}')
+        # 与PostgreSQL一致地检查外键
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.close()
+    
+    _instrument_engine(sqlite_engine)
+    print(f"使用SQLite数据库: {database or ':memory:'} (synchronous={synchronous} pool_size={SQLITE_POOL_SIZE})")
+    return sqlite_engine
+
+def _create_pooled_engine(url):
+    """创建带连接池配置的引擎(PostgreSQL等服务端数据库)"""
+    connect_args = {}
+    if make_url(url).get_backend_name() == 'postgresql':
+        if DB_CONNECT_TIMEOUT > 0:
+            connect_args['connect_timeout'] = DB_CONNECT_TIMEOUT
+        if DB_STATEMENT_TIMEOUT > 0:
+            connect_args['options'] = f'-c statement_timeout={DB_STATEMENT_TIMEOUT}'
+    
+    pooled_engine = create_engine(
+        url,
+        poolclass=InstrumentedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        connect_args=connect_args
+    )
+    _instrument_engine(pooled_engine)
+    print(
+        f"数据库连接池: pool_size={DB_POOL_SIZE} max_overflow={DB_MAX_OVERFLOW} "
+        f"timeout={DB_POOL_TIMEOUT}s recycle={DB_POOL_RECYCLE}s pre_ping={DB_POOL_PRE_PING}"
+    )
+    return pooled_engine
+
+def _instrument_engine(target_engine):
+    """统计新建连接和失效连接(pre_ping检测到的断开连接会被置为失效)"""
+    event.listen(target_engine, 'connect', lambda dbapi_connection, connection_record: pool_stats.record('connects'))
+    event.listen(target_engine, 'invalidate', lambda dbapi_connection, connection_record, exception: pool_stats.record('invalidations'))
+    if not isinstance(target_engine.pool, QueuePool):
+        event.listen(target_engine, 'checkout', lambda dbapi_connection, connection_record, connection_proxy: pool_stats.record_checkout())
+
+def get_pool_stats():
+    """获取连接池当前状态和累计统计"""
+    pool = engine.pool
+    stats = {'pool_class': type(pool).__name__, 'status': pool.status()}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'pool_size': pool.size(),
+            'max_overflow': getattr(pool, 'overflow_limit', None),
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0)
+        })
+    stats.update(pool_stats.as_dict())
+    return stats
 
 # 创建数据库引擎
-engine = create_engine(DATABASE_URL)
+engine = create_db_engine(DATABASE_URL)
 Base = declarative_base()
 Session = sessionmaker(bind=engine)
 
@@ -19,10 +207,56 @@ class User(Base):
     password = Column(String(100), nullable=False)
     email = Column(String(100))
     created_at = Column(DateTime, default=datetime.now)
+    last_login = Column(DateTime, nullable=True)
+    study_mode = Column(String(20), default='medium')
+    avatar = Column(String(200), nullable=True)  # 头像文件相对static目录的路径
     
     # 关系
     cards = relationship("UserCardState", back_populates="user", cascade="all, delete-orphan")
+    review_log_entries = relationship("ReviewLogEntry", cascade="all, delete-orphan")
     fsrs_params = relationship("UserFSRSParam", back_populates="user", uselist=False, cascade="all, delete-orphan")
+    
+    # 可以通过update_user单独修改的字段
+    UPDATABLE_FIELDS = ('password', 'email', 'last_login', 'study_mode', 'avatar')
+    
+    def to_record(self):
+        """转换为与users.json相同格式的用户数据字典"""
+        record = {
+            'password': self.password,
+            'email': self.email,
+            'created_at': _format_datetime(self.created_at),
+            'last_login': _format_datetime(self.last_login),
+            'study_mode': self.study_mode or 'medium'
+        }
+        if self.avatar:
+            record['avatar'] = self.avatar
+        return record
+    
+    @staticmethod
+    def column_values(user_data):
+        """把users.json格式的用户数据转换为列值(时间字符串转换为datetime)"""
+        values = {}
+        for field in User.UPDATABLE_FIELDS + ('created_at',):
+            if field not in user_data:
+                continue
+            value = user_data[field]
+            if field in ('created_at', 'last_login'):
+                value = _parse_datetime(value)
+            values[field] = value
+        return values
+
+def _format_datetime(value):
+    """时间格式与users.json保持一致"""
+    return value.strftime('%Y-%m-%d %H:%M:%S') if value else None
+
+def _parse_datetime(value):
+    """把users.json中的时间字符串转换为datetime"""
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
 
 # 系统卡片表
 class SystemCard(Base):
@@ -40,6 +274,12 @@ class SystemCard(Base):
 # 用户卡片状态表
 class UserCardState(Base):
     __tablename__ = 'user_card_states'
+    __table_args__ = (
+        # 按 (username, card_id) 定位单张卡片；用户自定义卡片的card_id为空，不受唯一约束影响
+        Index('ix_user_card_states_username_card_id', 'username', 'card_id', unique=True),
+        # 按用户统计/查询到期卡片时走索引范围扫描
+        Index('ix_user_card_states_username_viewed_due', 'username', 'is_viewed', 'due_date'),
+    )
     
     id = Column(Integer, primary_key=True)
     username = Column(String(50), ForeignKey('users.username'), nullable=False)
@@ -51,7 +291,7 @@ class UserCardState(Base):
     learning_factor = Column(Float, default=1.0)
     is_user_card = Column(Boolean, default=False)
     user_card_data = Column(Text, nullable=True)  # JSON格式存储用户自定义卡片
-    review_logs = Column(Text, nullable=True)  # JSON格式存储复习记录
+    review_logs = Column(Text, nullable=True)  # 旧版JSON格式复习记录，启动时迁移到review_log表
     
     # 关系
     user = relationship("User", back_populates="cards")
@@ -72,6 +312,41 @@ class UserCardState(Base):
             'scheduled_days': log.scheduled_days
         } for log in logs])
     
+    def get_card_key(self):
+        """获取内存中使用的卡片键
+
+        系统卡片直接使用 card_id；用户自定义卡片没有对应的系统卡片（card_id 为空），
+        其原始ID保存在 user_card_data 中，旧数据缺失时退回到行ID
+        """
+        if self.card_id:
+            return self.card_id
+        if self.user_card_data:
+            data = json.loads(self.user_card_data)
+            if data.get('card_id'):
+                return data['card_id']
+        return str(self.id)
+    
+    def apply_card_state(self, card_id, state):
+        """将内存中的卡片状态写入当前行"""
+        self.card_id = card_id if not state.is_user_card else None
+        self.is_viewed = state.is_viewed
+        self.memory_stability = state.memory_state.stability if state.memory_state else None
+        self.memory_difficulty = state.memory_state.difficulty if state.memory_state else None
+        self.due_date = state.due_date
+        self.learning_factor = state.learning_factor
+        self.is_user_card = state.is_user_card
+        
+        # 设置用户卡片数据，同时记录卡片ID以便重新加载时保持不变
+        if state.is_user_card and state.user_card_data:
+            data = dict(state.user_card_data)
+            data['card_id'] = card_id
+            self.set_user_card_data(data)
+        else:
+            self.user_card_data = None
+        
+        # 复习记录单独保存在review_log表中
+        self.review_logs = None
+    
     def get_user_card_data(self):
         """获取用户卡片数据"""
         if not self.user_card_data:
@@ -96,6 +371,32 @@ class UserCardState(Base):
         else:
             self.user_card_data = None
 
+# 复习记录表（只追加）
+class ReviewLogEntry(Base):
+    __tablename__ = 'review_log'
+    
+    username = Column(String(50), ForeignKey('users.username'), primary_key=True)
+    card_id = Column(String(50), primary_key=True)  # 系统卡片ID或用户自定义卡片ID
+    timestamp = Column(DateTime, primary_key=True)
+    rating = Column(Integer, nullable=False)
+    elapsed_days = Column(Float, default=0.0)
+    scheduled_days = Column(Float, default=0.0)
+    
+    @staticmethod
+    def row_from_log(username, card_id, log):
+        """将复习记录转换为插入用的字典"""
+        timestamp = log.timestamp
+        if isinstance(timestamp, str):
+            timestamp = datetime.fromisoformat(timestamp)
+        return {
+            'username': username,
+            'card_id': card_id,
+            'timestamp': timestamp,
+            'rating': int(log.rating),
+            'elapsed_days': float(log.elapsed_days or 0),
+            'scheduled_days': float(log.scheduled_days or 0)
+        }
+
 # 用户FSRS参数表
 class UserFSRSParam(Base):
     __tablename__ = 'user_fsrs_params'
@@ -104,6 +405,11 @@ class UserFSRSParam(Base):
     params = Column(Text, nullable=True)  # JSON格式存储参数
     last_updated = Column(DateTime, default=datetime.now)
     optimization_count = Column(Integer, default=0)
+    desired_retention = Column(Float, nullable=True)  # 问卷设置的期望保留率，为空时按学习模式
+    maximum_interval = Column(Integer, nullable=True)  # 问卷设置的最大间隔天数，为空时按学习模式
+    
+    # 可以通过save_user_fsrs_params修改的调度设置
+    SETTING_FIELDS = ('desired_retention', 'maximum_interval')
     
     # 关系
     user = relationship("User", back_populates="fsrs_params")
@@ -148,9 +454,90 @@ class UserQuestionnaire(Base):
             'updated_at': self.updated_at.isoformat() if self.updated_at else None
         }
 
+# 用户数据版本表：每次写入用户的卡片状态或参数后版本号加一，
+# 各工作进程据此判断自己缓存的用户数据是否已被其他进程修改；
+# pending_writes为已结束但修改还在某个进程写后队列中的请求数，其他进程读取该用户前等它归零
+class UserStateVersion(Base):
+    __tablename__ = 'user_state_versions'
+    
+    username = Column(String(50), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    pending_writes = Column(Integer, nullable=True, default=0)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+# 已执行的一次性数据迁移：每个迁移成功后记录一行，之后启动时直接跳过
+class SchemaMigration(Base):
+    __tablename__ = 'schema_migrations'
+    
+    name = Column(String(100), primary_key=True)
+    applied_at = Column(DateTime, default=datetime.now)
+
+# FSRS参数后台优化任务表：每个用户一行，记录最近一次任务的状态和之后新增的复习数，
+# 所有工作进程共享，同一用户同时只有一个进程能领取到任务
+class OptimizationJob(Base):
+    __tablename__ = 'optimization_jobs'
+    
+    username = Column(String(50), primary_key=True)
+    state = Column(String(20), nullable=True)  # 为空表示还没有安排过任务
+    review_count = Column(Integer, nullable=False, default=0)  # 上次安排优化后新增的复习数
+    submitted_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, nullable=True)
+    result = Column(Text, nullable=True)  # JSON格式的优化结果
+    error = Column(Text, nullable=True)
+    
+    def to_dict(self):
+        """转换为任务状态字典"""
+        return {
+            'state': self.state,
+            'submitted_at': self.submitted_at,
+            'finished_at': self.finished_at,
+            'updated_at': self.updated_at,
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error
+        }
+
 def initialize_db():
     """初始化数据库，创建所有表"""
     Base.metadata.create_all(engine)
+    ensure_columns(User)
+    ensure_columns(UserFSRSParam)
+    ensure_columns(UserStateVersion)
+    ensure_indexes()
+    run_migration('review_logs_to_table', migrate_review_logs)
+    run_migration('dedupe_rate_card_review_logs', dedupe_rate_card_review_logs)
+
+def run_migration(name, migrate):
+    """执行一次性数据迁移，已记录在schema_migrations表中的迁移直接跳过
+    
+    Args:
+        name: 迁移名称
+        migrate: 迁移函数，成功时返回True；失败时不记录，下次启动时重试
+    
+    Returns:
+        本次是否执行了迁移
+    """
+    session = get_db_session()
+    try:
+        if session.get(SchemaMigration, name) is not None:
+            return False
+    finally:
+        session.close()
+    
+    if not migrate():
+        return False
+    
+    session = get_db_session()
+    try:
+        session.add(SchemaMigration(name=name, applied_at=datetime.now()))
+        session.commit()
+        print(f"数据迁移 {name} 已完成")
+    except Exception:
+        # 多个工作进程同时启动时迁移可能被执行两次，迁移本身可以重复执行，只需要记录一次
+        session.rollback()
+    finally:
+        session.close()
+    return True
 
 def get_db_session():
     """获取数据库会话"""
@@ -162,6 +549,7 @@ def migrate_from_files(system_cards_data, user_card_states_data, user_fsrs_param
     session = get_db_session()
     try:
         # 清空现有数据
+        session.query(ReviewLogEntry).delete()
         session.query(UserCardState).delete()
         session.query(SystemCard).delete()
         session.query(UserFSRSParam).delete()
@@ -169,11 +557,7 @@ def migrate_from_files(system_cards_data, user_card_states_data, user_fsrs_param
         
         # 导入用户数据
         for username, user_data in users_data.items():
-            user = User(
-                username=username,
-                password=user_data.get('password', ''),
-                email=user_data.get('email', '')
-            )
+            user = User(username=username, **User.column_values(user_data))
             session.add(user)
         
         # 导入系统卡片
@@ -188,29 +572,18 @@ def migrate_from_files(system_cards_data, user_card_states_data, user_fsrs_param
             session.add(system_card)
         
         # 导入用户卡片状态
+        log_rows = []
         for username, states in user_card_states_data.items():
             for card_id, state in states.items():
-                # 创建用户卡片状态
-                user_state = UserCardState(
-                    username=username,
-                    card_id=card_id if not state.is_user_card else None,
-                    is_viewed=state.is_viewed,
-                    memory_stability=state.memory_state.stability if state.memory_state else None,
-                    memory_difficulty=state.memory_state.difficulty if state.memory_state else None,
-                    due_date=state.due_date,
-                    learning_factor=state.learning_factor,
-                    is_user_card=state.is_user_card
-                )
-                
-                # 设置用户卡片数据
-                if state.is_user_card and state.user_card_data:
-                    user_state.set_user_card_data(state.user_card_data)
-                
-                # 设置复习记录
-                if state.review_logs:
-                    user_state.set_review_logs(state.review_logs)
-                    
+                user_state = UserCardState(username=username)
+                user_state.apply_card_state(card_id, state)
                 session.add(user_state)
+                log_rows.extend(ReviewLogEntry.row_from_log(username, card_id, log) for log in state.review_logs)
+        
+        # 导入复习记录
+        session.flush()
+        if log_rows:
+            session.execute(_insert_ignore(session, ReviewLogEntry), log_rows)
         
         # 导入用户FSRS参数
         for username, fsrs_param in user_fsrs_params_data.items():
@@ -218,7 +591,9 @@ def migrate_from_files(system_cards_data, user_card_states_data, user_fsrs_param
                 username=username,
                 params=json.dumps(fsrs_param.params),
                 last_updated=fsrs_param.last_updated,
-                optimization_count=fsrs_param.optimization_count
+                optimization_count=fsrs_param.optimization_count,
+                desired_retention=getattr(fsrs_param, 'desired_retention', None),
+                maximum_interval=getattr(fsrs_param, 'maximum_interval', None)
             )
             session.add(user_param)
             
@@ -229,4 +604,724 @@ def migrate_from_files(system_cards_data, user_card_states_data, user_fsrs_param
         print(f"迁移数据失败: {e}")
         return False
     finally:
-        session.close() 
\ No newline at end of file
+        session.close() 
+
+def _query_user_card_rows(session, username, card_ids, include_user_cards):
+    """按 (username, card_id) 查询已存在的卡片状态行，返回 {card_key: UserCardState}"""
+    rows = {}
+    if card_ids:
+        query = session.query(UserCardState).filter(
+            UserCardState.username == username,
+            UserCardState.card_id.in_(card_ids)
+        )
+        for row in query:
+            rows[row.card_id] = row
+    if include_user_cards:
+        # 用户自定义卡片数量很少，直接取出该用户的全部自定义卡片再匹配键
+        for row in session.query(UserCardState).filter_by(username=username, is_user_card=True):
+            rows[row.get_card_key()] = row
+    return rows
+
+def upsert_card_states(username, states):
+    """增量写入用户卡片状态
+
+    只更新或插入 states 中的行，写入成本与本次修改的卡片数量成正比，而不是与全部数据量成正比
+
+    Args:
+        username: 用户名
+        states: {card_id: CardState}
+    """
+    if not states:
+        return True
+    session = get_db_session()
+    try:
+        system_ids = [card_id for card_id, state in states.items() if not state.is_user_card]
+        include_user_cards = len(system_ids) < len(states)
+        existing = _query_user_card_rows(session, username, system_ids, include_user_cards)
+        
+        for card_id, state in states.items():
+            user_state = existing.get(card_id)
+            if user_state is None:
+                user_state = UserCardState(username=username)
+                session.add(user_state)
+            user_state.apply_card_state(card_id, state)
+        
+        session.commit()
+        return True
+    except Exception as e:
+        session.rollback()
+        print(f"增量保存卡片状态失败: {e}")
+        return False
+    finally:
+        session.close()
+
+def delete_card_states(username, card_ids):
+    """删除用户指定的卡片状态行"""
+    if not card_ids:
+        return True
+    session = get_db_session()
+    try:
+        existing = _query_user_card_rows(session, username, list(card_ids), include_user_cards=True)
+        for card_id in card_ids:
+            if card_id in existing:
+                session.delete(existing[card_id])
+        session.query(ReviewLogEntry).filter(
+            ReviewLogEntry.username == username,
+            ReviewLogEntry.card_id.in_(list(card_ids))
+        ).delete(synchronize_session=False)
+        session.commit()
+        return True
+    except Exception as e:
+        session.rollback()
+        print(f"删除卡片状态失败: {e}")
+        return False
+    finally:
+        session.close()
+
+def _insert_ignore(session, model):
+    """构造忽略主键冲突的INSERT语句，重复写入同一条复习记录时保持幂等"""
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return model.__table__.insert()
+    return insert(model.__table__).on_conflict_do_nothing()
+
+def append_review_logs(entries):
+    """追加复习记录，每条复习只插入一行
+
+    Args:
+        entries: [(username, card_id, ReviewLog)]
+    """
+    if not entries:
+        return True
+    session = get_db_session()
+    try:
+        rows = [ReviewLogEntry.row_from_log(username, card_id, log) for username, card_id, log in entries]
+        session.execute(_insert_ignore(session, ReviewLogEntry), rows)
+        session.commit()
+        return True
+    except Exception as e:
+        session.rollback()
+        print(f"追加复习记录失败: {e}")
+        return False
+    finally:
+        session.close()
+
+def delete_review_logs(username, card_id=None, since=None):
+    """删除用户的复习记录，可按卡片和起始时间过滤"""
+    session = get_db_session()
+    try:
+        query = session.query(ReviewLogEntry).filter(ReviewLogEntry.username == username)
+        if card_id is not None:
+            query = query.filter(ReviewLogEntry.card_id == card_id)
+        if since is not None:
+            query = query.filter(ReviewLogEntry.timestamp >= since)
+        query.delete(synchronize_session=False)
+        session.commit()
+        return True
+    except Exception as e:
+        session.rollback()
+        print(f"删除复习记录失败: {e}")
+        return False
+    finally:
+        session.close()
+
+def query_review_logs(username, since=None, until=None):
+    """查询用户的复习记录，按时间排序，返回ReviewLogEntry列表"""
+    session = get_db_session()
+    try:
+        query = session.query(ReviewLogEntry).filter(ReviewLogEntry.username == username)
+        if since is not None:
+            query = query.filter(ReviewLogEntry.timestamp >= since)
+        if until is not None:
+            query = query.filter(ReviewLogEntry.timestamp < until)
+        return query.order_by(ReviewLogEntry.timestamp).all()
+    finally:
+        session.close()
+
+def count_reviews_by_day(username, since=None, until=None):
+    """按天统计用户的复习次数，返回 {'YYYY-MM-DD': 次数}"""
+    session = get_db_session()
+    try:
+        day = func.date(ReviewLogEntry.timestamp)
+        query = session.query(day, func.count()).filter(ReviewLogEntry.username == username)
+        if since is not None:
+            query = query.filter(ReviewLogEntry.timestamp >= since)
+        if until is not None:
+            query = query.filter(ReviewLogEntry.timestamp < until)
+        return {str(log_day): count for log_day, count in query.group_by(day)}
+    finally:
+        session.close()
+
+def migrate_review_logs(batch_size=500):
+    """将UserCardState.review_logs中的旧版JSON复习记录拆分写入review_log表
+
+    按行ID分批处理，每批单独提交；迁移完成的行会清空JSON列，因此可以重复执行。
+    由run_migration在第一次启动时执行一次，成功时返回True
+    """
+    session = get_db_session()
+    migrated_rows = 0
+    migrated_logs = 0
+    last_id = 0
+    try:
+        while True:
+            batch = (
+                session.query(UserCardState)
+                .filter(UserCardState.id > last_id, UserCardState.review_logs.isnot(None))
+                .order_by(UserCardState.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not batch:
+                break
+            
+            log_rows = []
+            for user_state in batch:
+                card_key = user_state.get_card_key()
+                for log_data in user_state.get_review_logs():
+                    timestamp = log_data['timestamp']
+                    if isinstance(timestamp, str):
+                        timestamp = datetime.fromisoformat(timestamp)
+                    log_rows.append({
+                        'username': user_state.username,
+                        'card_id': card_key,
+                        'timestamp': timestamp,
+                        'rating': int(log_data['rating']),
+                        'elapsed_days': float(log_data.get('elapsed_days') or 0),
+                        'scheduled_days': float(log_data.get('scheduled_days') or 0)
+                    })
+                user_state.review_logs = None
+            
+            if log_rows:
+                session.execute(_insert_ignore(session, ReviewLogEntry), log_rows)
+            session.commit()
+            
+            last_id = batch[-1].id
+            migrated_rows += len(batch)
+            migrated_logs += len(log_rows)
+        
+        if migrated_rows:
+            print(f"已迁移 {migrated_rows} 行卡片状态中的 {migrated_logs} 条复习记录到review_log表")
+        return True
+    except Exception as e:
+        session.rollback()
+        print(f"迁移复习记录失败: {e}")
+        return False
+    finally:
+        session.close()
+
+def dedupe_rate_card_review_logs(batch_size=500):
+    """删除旧版评分接口重复追加的复习记录
+
+    旧版每次评分会追加两条评分相同、时间相差不到一秒的记录。同一张卡片中与上一条记录评分相同且间隔不到60秒的记录
+    视为重复，只保留时间较早的一条(与之前重放时跳过重复记录的结果一致)。成功时返回True
+    """
+    session = get_db_session()
+    try:
+        query = (
+            session.query(ReviewLogEntry.username, ReviewLogEntry.card_id, ReviewLogEntry.timestamp, ReviewLogEntry.rating)
+            .order_by(ReviewLogEntry.username, ReviewLogEntry.card_id, ReviewLogEntry.timestamp)
+        )
+        duplicates = []
+        previous = None
+        for row in query.yield_per(batch_size):
+            if (previous is not None and row.username == previous.username and row.card_id == previous.card_id
+                    and row.rating == previous.rating and (row.timestamp - previous.timestamp).total_seconds() < 60):
+                duplicates.append((row.username, row.card_id, row.timestamp))
+                continue
+            previous = row
+        
+        for start in range(0, len(duplicates), batch_size):
+            for username, card_id, timestamp in duplicates[start:start + batch_size]:
+                session.query(ReviewLogEntry).filter(
+                    ReviewLogEntry.username == username,
+                    ReviewLogEntry.card_id == card_id,
+                    ReviewLogEntry.timestamp == timestamp
+                ).delete(synchronize_session=False)
+            session.commit()
+        if duplicates:
+            print(f"已删除 {len(duplicates)} 条重复的复习记录")
+        return True
+    except Exception as e:
+        session.rollback()
+        print(f"清理重复复习记录失败: {e}")
+        return False
+    finally:
+        session.close()
+
+def ensure_indexes():
+    """为已存在的表补建索引
+
+    create_all 不会修改已经存在的表，因此旧数据库需要单独创建索引；
+    唯一索引依赖的去重只在第一次启动时执行一次(见dedupe_user_card_states)。可以重复执行。
+    """
+    run_migration('dedupe_user_card_states', dedupe_user_card_states)
+    for index in UserCardState.__table__.indexes:
+        try:
+            index.create(engine, checkfirst=True)
+        except Exception as e:
+            print(f"创建索引 {index.name} 失败: {e}")
+
+def dedupe_user_card_states():
+    """删除重复的 (username, card_id) 卡片状态行，只保留每组中ID最大(最新)的一行，逐组打印删除的行
+
+    创建唯一索引前执行一次，成功时返回True
+    """
+    session = get_db_session()
+    try:
+        duplicates = (
+            session.query(UserCardState.username, UserCardState.card_id, func.max(UserCardState.id))
+            .filter(UserCardState.card_id.isnot(None))
+            .group_by(UserCardState.username, UserCardState.card_id)
+            .having(func.count(UserCardState.id) > 1)
+            .all()
+        )
+        removed = 0
+        for username, card_id, keep_id in duplicates:
+            rows = (
+                session.query(UserCardState.id, UserCardState.is_viewed, UserCardState.due_date)
+                .filter(
+                    UserCardState.username == username,
+                    UserCardState.card_id == card_id,
+                    UserCardState.id != keep_id
+                )
+                .all()
+            )
+            for row_id, is_viewed, due_date in rows:
+                print(f"删除重复的卡片状态: 用户 {username} 卡片 {card_id} 行 {row_id} "
+                      f"(已查看: {bool(is_viewed)}, 到期: {due_date})，保留行 {keep_id}")
+            session.query(UserCardState).filter(
+                UserCardState.id.in_([row_id for row_id, _, _ in rows])
+            ).delete(synchronize_session=False)
+            removed += len(rows)
+        session.commit()
+        if duplicates:
+            print(f"已清理 {len(duplicates)} 组重复的用户卡片状态，共删除 {removed} 行")
+        return True
+    except Exception as e:
+        session.rollback()
+        print(f"清理重复卡片状态失败: {e}")
+        return False
+    finally:
+        session.close()
+
+def ensure_columns(model):
+    """为已存在的表补加模型中新增的可空列(create_all不会修改已存在的表)，可以重复执行"""
+    table = model.__table__
+    try:
+        existing = {column['name'] for column in inspect(engine).get_columns(table.name)}
+    except Exception as e:
+        print(f"读取表 {table.name} 的结构失败: {e}")
+        return
+    for column in table.columns:
+        if column.name in existing or not column.nullable:
+            continue
+        column_type = column.type.compile(dialect=engine.dialect)
+        try:
+            with engine.begin() as connection:
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            print(f"已为表 {table.name} 添加列 {column.name}")
+        except Exception as e:
+            print(f"为表 {table.name} 添加列 {column.name} 失败: {e}")
+
+def query_due_card_ids(username, now):
+    """查询用户已查看且到期的卡片，按到期时间排序
+
+    使用 (username, is_viewed, due_date) 索引做范围扫描，只读取卡片ID和到期时间；
+    用户自定义卡片的card_id为空，只对这些行读取卡片数据取出原始ID
+
+    Returns:
+        [(due_date, card_id)]
+    """
+    session = get_db_session()
+    try:
+        rows = (
+            session.query(
+                UserCardState.id,
+                UserCardState.card_id,
+                UserCardState.due_date,
+                case((UserCardState.card_id.is_(None), UserCardState.user_card_data), else_=None)
+            )
+            .filter(
+                UserCardState.username == username,
+                UserCardState.is_viewed == True,
+                UserCardState.due_date <= now
+            )
+            .order_by(UserCardState.due_date)
+            .all()
+        )
+        result = []
+        for row_id, card_id, due_date, user_card_data in rows:
+            if not card_id:
+                data = json.loads(user_card_data) if user_card_data else {}
+                card_id = data.get('card_id') or str(row_id)
+            result.append((due_date, card_id))
+        return result
+    finally:
+        session.close()
+
+def count_due_cards(username, now):
+    """统计用户已查看且到期的卡片数量"""
+    session = get_db_session()
+    try:
+        return (
+            session.query(func.count(UserCardState.id))
+            .filter(
+                UserCardState.username == username,
+                UserCardState.is_viewed == True,
+                UserCardState.due_date <= now
+            )
+            .scalar()
+        )
+    finally:
+        session.close()
+
+def get_user_version(username):
+    """获取用户数据的当前版本号，从未写入过时为0"""
+    session = get_db_session()
+    try:
+        version = (
+            session.query(UserStateVersion.version)
+            .filter(UserStateVersion.username == username)
+            .scalar()
+        )
+        return version or 0
+    finally:
+        session.close()
+
+def get_user_write_state(username):
+    """获取用户数据的版本号、未写入的请求数和最后更新时间，从未写入过时为 (0, 0, None)"""
+    session = get_db_session()
+    try:
+        row = (
+            session.query(UserStateVersion.version, UserStateVersion.pending_writes, UserStateVersion.updated_at)
+            .filter(UserStateVersion.username == username)
+            .first()
+        )
+        if row is None:
+            return 0, 0, None
+        return row.version or 0, row.pending_writes or 0, row.updated_at
+    finally:
+        session.close()
+
+def _update_user_versions(usernames, values_for):
+    """按用户更新版本行，版本行不存在时先插入
+    
+    Args:
+        values_for: 参数为username，返回该用户版本行的UPDATE值
+    
+    Returns:
+        {username: 新版本号}；失败时返回None
+    """
+    usernames = sorted(set(usernames))
+    if not usernames:
+        return {}
+    session = get_db_session()
+    try:
+        for username in usernames:
+            query = session.query(UserStateVersion).filter(UserStateVersion.username == username)
+            if not query.update(values_for(username), synchronize_session=False):
+                # 第一次写入时插入版本行(其他进程同时插入时忽略)，再执行同样的更新
+                session.execute(
+                    _insert_ignore(session, UserStateVersion),
+                    [{'username': username, 'version': 0, 'pending_writes': 0, 'updated_at': datetime.now()}]
+                )
+                query.update(values_for(username), synchronize_session=False)
+        session.commit()
+        rows = session.query(UserStateVersion).filter(UserStateVersion.username.in_(usernames)).all()
+        return {row.username: row.version for row in rows}
+    except Exception as e:
+        session.rollback()
+        print(f"更新用户数据版本失败: {e}")
+        return None
+    finally:
+        session.close()
+
+def bump_user_versions(usernames, settled=None):
+    """把用户数据的版本号加一
+    
+    Args:
+        settled: {username: 本次写入完成的请求数}，从这些用户的未写入请求数中减去
+    
+    Returns:
+        {username: 新版本号}；失败时返回None
+    """
+    settled = settled or {}
+    pending = func.coalesce(UserStateVersion.pending_writes, 0)
+    
+    def values_for(username):
+        values = {UserStateVersion.version: UserStateVersion.version + 1, UserStateVersion.updated_at: datetime.now()}
+        count = settled.get(username)
+        if count:
+            values[UserStateVersion.pending_writes] = case((pending > count, pending - count), else_=0)
+        return values
+    
+    return _update_user_versions(set(usernames) | set(settled), values_for)
+
+def mark_user_writes_pending(usernames):
+    """请求结束时把用户数据的版本号加一，并把未写入的请求数加一，实际的行由写后队列稍后写入
+    
+    Returns:
+        {username: 新版本号}；失败时返回None
+    """
+    values = lambda username: {
+        UserStateVersion.version: UserStateVersion.version + 1,
+        UserStateVersion.pending_writes: func.coalesce(UserStateVersion.pending_writes, 0) + 1,
+        UserStateVersion.updated_at: datetime.now()
+    }
+    return _update_user_versions(usernames, values)
+
+def clear_stale_pending_writes(username, stale_before):
+    """清零stale_before之后没有更新过的未写入请求数(登记它们的进程已退出)，返回是否清零"""
+    session = get_db_session()
+    try:
+        cleared = (
+            session.query(UserStateVersion)
+            .filter(
+                UserStateVersion.username == username,
+                UserStateVersion.pending_writes > 0,
+                UserStateVersion.updated_at < stale_before
+            )
+            .update({UserStateVersion.pending_writes: 0}, synchronize_session=False)
+        )
+        session.commit()
+        return cleared > 0
+    except Exception as e:
+        session.rollback()
+        print(f"清除用户 {username} 的未写入标记失败: {e}")
+        return False
+    finally:
+        session.close()
+
+def save_user_fsrs_params(username, params, optimized=False, settings=None):
+    """写入用户的FSRS参数
+
+    Args:
+        username: 用户名
+        params: FSRS参数
+        optimized: 是否为优化得到的参数，是时优化次数加一
+        settings: 同时写入的调度设置 {desired_retention, maximum_interval}，为None时保持不变
+
+    Returns:
+        写入后的优化次数；失败时返回None
+    """
+    session = get_db_session()
+    try:
+        user_param = session.get(UserFSRSParam, username)
+        if user_param is None:
+            user_param = UserFSRSParam(username=username, optimization_count=0)
+            session.add(user_param)
+        user_param.set_params(params)
+        user_param.last_updated = datetime.now()
+        for field, value in (settings or {}).items():
+            if field in UserFSRSParam.SETTING_FIELDS:
+                setattr(user_param, field, value)
+        if optimized:
+            user_param.optimization_count = (user_param.optimization_count or 0) + 1
+        session.commit()
+        return user_param.optimization_count
+    except Exception as e:
+        session.rollback()
+        print(f"保存用户 {username} 的FSRS参数失败: {e}")
+        return None
+    finally:
+        session.close()
+
+def _ensure_optimization_job(session, username):
+    """插入用户的任务行，已存在时不做任何事"""
+    session.execute(_insert_ignore(session, OptimizationJob), [{'username': username, 'review_count': 0}])
+
+def add_optimization_reviews(username, count):
+    """增加用户上次安排优化后新增的复习数
+    
+    Returns:
+        增加后的数量；失败时返回None
+    """
+    session = get_db_session()
+    try:
+        updated = (
+            session.query(OptimizationJob)
+            .filter(OptimizationJob.username == username)
+            .update({OptimizationJob.review_count: OptimizationJob.review_count + count}, synchronize_session=False)
+        )
+        if not updated:
+            _ensure_optimization_job(session, username)
+            session.query(OptimizationJob).filter(OptimizationJob.username == username).update(
+                {OptimizationJob.review_count: OptimizationJob.review_count + count}, synchronize_session=False
+            )
+        session.commit()
+        return (
+            session.query(OptimizationJob.review_count)
+            .filter(OptimizationJob.username == username)
+            .scalar()
+        )
+    except Exception as e:
+        session.rollback()
+        print(f"更新用户 {username} 的新增复习数失败: {e}")
+        return None
+    finally:
+        session.close()
+
+def claim_optimization_job(username, stale_before):
+    """为用户登记一个新的优化任务并清零新增复习数
+    
+    用一条带条件的UPDATE完成，多个工作进程同时领取时只有一个成功
+    
+    Args:
+        stale_before: 未完成的任务在此之前没有更新过时视为已中断，可以重新领取
+    
+    Returns:
+        是否领取成功
+    """
+    session = get_db_session()
+    try:
+        _ensure_optimization_job(session, username)
+        now = datetime.now()
+        claimed = (
+            session.query(OptimizationJob)
+            .filter(
+                OptimizationJob.username == username,
+                (OptimizationJob.state.is_(None)) |
+                (OptimizationJob.state.notin_(('queued', 'running'))) |
+                (OptimizationJob.updated_at < stale_before)
+            )
+            .update({
+                OptimizationJob.state: 'queued',
+                OptimizationJob.review_count: 0,
+                OptimizationJob.submitted_at: now,
+                OptimizationJob.finished_at: None,
+                OptimizationJob.updated_at: now,
+                OptimizationJob.result: None,
+                OptimizationJob.error: None
+            }, synchronize_session=False)
+        )
+        session.commit()
+        return claimed > 0
+    except Exception as e:
+        session.rollback()
+        print(f"登记用户 {username} 的优化任务失败: {e}")
+        return False
+    finally:
+        session.close()
+
+def update_optimization_job(username, fields):
+    """修改用户优化任务的状态字段，result为字典时以JSON保存"""
+    session = get_db_session()
+    try:
+        values = {getattr(OptimizationJob, field): value for field, value in fields.items() if field != 'result'}
+        if 'result' in fields:
+            result = fields['result']
+            values[OptimizationJob.result] = json.dumps(result, default=float) if result else None
+        values[OptimizationJob.updated_at] = datetime.now()
+        session.query(OptimizationJob).filter(OptimizationJob.username == username).update(
+            values, synchronize_session=False
+        )
+        session.commit()
+        return True
+    except Exception as e:
+        session.rollback()
+        print(f"更新用户 {username} 的优化任务状态失败: {e}")
+        return False
+    finally:
+        session.close()
+
+def get_optimization_job(username):
+    """获取用户最近一次优化任务的状态字典，没有安排过任务时返回None"""
+    session = get_db_session()
+    try:
+        job = session.get(OptimizationJob, username)
+        if job is None or job.state is None:
+            return None
+        return job.to_dict()
+    finally:
+        session.close()
+
+def create_user(username, user_data):
+    """插入一个新用户，用户已存在时返回False"""
+    session = get_db_session()
+    try:
+        if session.get(User, username) is not None:
+            return False
+        values = User.column_values(user_data)
+        values.setdefault('created_at', datetime.now())
+        session.add(User(username=username, **values))
+        session.commit()
+        return True
+    except Exception as e:
+        session.rollback()
+        print(f"创建用户 {username} 失败: {e}")
+        return False
+    finally:
+        session.close()
+
+def update_user(username, fields):
+    """只更新一个用户的指定字段，用户不存在时返回False"""
+    values = User.column_values(fields)
+    if not values:
+        return True
+    session = get_db_session()
+    try:
+        updated = (
+            session.query(User)
+            .filter(User.username == username)
+            .update(values, synchronize_session=False)
+        )
+        session.commit()
+        return updated > 0
+    except Exception as e:
+        session.rollback()
+        print(f"更新用户 {username} 失败: {e}")
+        return False
+    finally:
+        session.close()
+
+# 通过username外键引用用户的表，删除或重命名用户时需要一起处理
+_USER_CHILD_MODELS = (ReviewLogEntry, UserCardState, UserFSRSParam, UserQuestionnaire, UserStateVersion, OptimizationJob)
+
+def delete_user(username):
+    """删除一个用户及其卡片状态、复习记录和参数，用户不存在时返回False"""
+    session = get_db_session()
+    try:
+        for model in _USER_CHILD_MODELS:
+            session.query(model).filter(model.username == username).delete(synchronize_session=False)
+        deleted = session.query(User).filter(User.username == username).delete(synchronize_session=False)
+        session.commit()
+        return deleted > 0
+    except Exception as e:
+        session.rollback()
+        print(f"删除用户 {username} 失败: {e}")
+        return False
+    finally:
+        session.close()
+
+def rename_user(old_username, new_username):
+    """修改用户名：插入新用户行，把关联数据改到新用户名下，再删除旧用户行
+    
+    Returns:
+        是否修改成功；旧用户不存在或新用户名已被使用时返回False
+    """
+    session = get_db_session()
+    try:
+        user = session.get(User, old_username)
+        if user is None or session.get(User, new_username) is not None:
+            return False
+        values = {column.name: getattr(user, column.name) for column in User.__table__.columns}
+        values['username'] = new_username
+        session.add(User(**values))
+        session.flush()
+        for model in _USER_CHILD_MODELS:
+            session.query(model).filter(model.username == old_username).update(
+                {model.username: new_username}, synchronize_session=False
+            )
+        session.query(User).filter(User.username == old_username).delete(synchronize_session=False)
+        session.commit()
+        return True
+    except Exception as e:
+        session.rollback()
+        print(f"修改用户名 {old_username} -> {new_username} 失败: {e}")
+        return False
+    finally:
+        session.close()
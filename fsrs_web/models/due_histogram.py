@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+每天到期卡片数的直方图
+
+每个用户一份，只在第一次使用时遍历一次卡片状态，之后随排期增量更新。
+排期时在随机波动允许的范围内选择到期卡片最少的一天，避免同一批学习的卡片集中在同一天到期。
+"""
+
+from collections import Counter
+from datetime import date, datetime
+from typing import Iterable, List, Optional, Union
+
+
+class DueHistogram:
+    """按日期统计到期的卡片数 {日期序号: 卡片数}"""
+
+    def __init__(self, due_dates: Iterable[Optional[datetime]] = ()):
+        self._counts = Counter()
+        for due_date in due_dates:
+            self.add(due_date)
+
+    @classmethod
+    def from_states(cls, states) -> 'DueHistogram':
+        """从用户的卡片状态构建，只统计已查看(进入复习队列)的卡片"""
+        return cls(state.due_date for state in states.values() if state.is_viewed)
+
+    @staticmethod
+    def day(value: Union[date, datetime, int]) -> int:
+        """日期序号"""
+        if isinstance(value, int):
+            return value
+        if isinstance(value, datetime):
+            value = value.date()
+        return value.toordinal()
+
+    def add(self, due_date, count: int = 1):
+        """登记一张卡片的到期日，due_date为None时忽略"""
+        if due_date is None:
+            return
+        day = self.day(due_date)
+        self._counts[day] += count
+        if self._counts[day] <= 0:
+            del self._counts[day]
+
+    def remove(self, due_date):
+        """移除一张卡片的到期日"""
+        self.add(due_date, -1)
+
+    def move(self, old_due_date, new_due_date):
+        """卡片的到期日从old_due_date改为new_due_date"""
+        if old_due_date is not None and new_due_date is not None and self.day(old_due_date) == self.day(new_due_date):
+            return
+        self.remove(old_due_date)
+        self.add(new_due_date)
+
+    def count(self, value) -> int:
+        """某一天到期的卡片数"""
+        return self._counts.get(self.day(value), 0)
+
+    def counts(self, start, days: int) -> List[int]:
+        """从start开始连续days天的到期卡片数"""
+        first = self.day(start)
+        return [self._counts.get(first + offset, 0) for offset in range(days)]
+
+    def least_loaded(self, start, low: int, high: int, preferred: int) -> int:
+        """在start之后第low到第high天中选择到期卡片最少的一天，数量相同时选离preferred最近的
+
+        Returns:
+            距离start的天数
+        """
+        first = self.day(start)
+        return min(range(low, high + 1), key=lambda offset: (self._counts.get(first + offset, 0), abs(offset - preferred)))
+
+    def total(self) -> int:
+        """登记的卡片总数"""
+        return sum(self._counts.values())
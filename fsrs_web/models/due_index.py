@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+按到期时间排序的卡片索引
+
+每个用户一份，只统计已查看(进入复习队列)的卡片。第一次使用时遍历一次卡片状态，
+之后在卡片被查看、评分、重新排期或删除时增量更新；到期卡片数和最早到期的卡片用二分查找得到。
+"""
+
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+
+class DueIndex:
+    """按(到期时间, 卡片ID)排序的有序数组"""
+
+    def __init__(self):
+        self._entries: List[Tuple[datetime, str]] = []
+        self._due_dates: Dict[str, datetime] = {}
+
+    @classmethod
+    def from_states(cls, states) -> 'DueIndex':
+        """从用户的卡片状态构建"""
+        index = cls()
+        index._due_dates = {
+            card_id: state.due_date
+            for card_id, state in states.items()
+            if state.is_viewed and state.due_date is not None
+        }
+        index._entries = sorted((due_date, card_id) for card_id, due_date in index._due_dates.items())
+        return index
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, card_id):
+        return card_id in self._due_dates
+
+    def update(self, card_id: str, due_date: Optional[datetime]):
+        """登记卡片新的到期时间，due_date为None(未查看)时移除"""
+        old_due_date = self._due_dates.get(card_id)
+        if old_due_date is not None:
+            if old_due_date == due_date:
+                return
+            del self._entries[bisect_left(self._entries, (old_due_date, card_id))]
+            del self._due_dates[card_id]
+        if due_date is not None:
+            insort(self._entries, (due_date, card_id))
+            self._due_dates[card_id] = due_date
+
+    def discard(self, card_id: str):
+        """移除卡片"""
+        self.update(card_id, None)
+
+    def count_due(self, now: datetime) -> int:
+        """到期时间不晚于now的卡片数"""
+        # 单元素元组排在同一时间的所有条目之前，时间精度为微秒
+        return bisect_left(self._entries, (now + timedelta(microseconds=1),))
+
+    def next_due(self, now: datetime) -> Optional[str]:
+        """最早到期的卡片ID，没有到期卡片时返回None"""
+        if self._entries and self._entries[0][0] <= now:
+            return self._entries[0][1]
+        return None
+
+    def due_ids(self, now: datetime, limit: Optional[int] = None) -> List[str]:
+        """按到期时间排列的到期卡片ID，最多limit个"""
+        end = self.count_due(now)
+        if limit is not None:
+            end = min(end, limit)
+        return [card_id for _, card_id in self._entries[:end]]
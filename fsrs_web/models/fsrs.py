@@ -13,6 +13,16 @@ from typing import List, Optional, Dict, Union, Tuple, Any
 from datetime import datetime, timedelta
 import json
 import os
+import time
+
+try:
+    import numpy as np
+    from models.fsrs_batch import FSRSBatch, ReviewDataset
+except ImportError:
+    try:
+        from fsrs_web.models.fsrs_batch import FSRSBatch, ReviewDataset
+    except ImportError:  # 没有安装numpy时逐张卡片计算
+        FSRSBatch = ReviewDataset = None
 
 
 @dataclass
@@ -70,112 +80,122 @@ class Card:
 
 
 class FSRSOptimizer:
-    """FSRS参数优化器"""
+    """FSRS参数优化器
+
+    在展平的复习数据(ReviewDataset)上一次计算损失和精确梯度，使用Adam更新参数。
+    """
     
-    def __init__(self, learning_rate: float = 0.01, regularization: float = 0.1):
+    def __init__(self, learning_rate: float = 0.05, regularization: float = 0.01,
+                 tolerance: float = 1e-6, patience: int = 5):
         """初始化优化器
         
         Args:
-            learning_rate: 学习率
-            regularization: 正则化系数
+            learning_rate: 学习率(Adam步长)
+            regularization: 正则化系数，惩罚参数偏离初始参数的程度
+            tolerance: 损失下降小于该值视为没有改进
+            patience: 连续多少次迭代没有改进后认为已收敛
         """
         self.learning_rate = learning_rate
         self.regularization = regularization
+        self.tolerance = tolerance
+        self.patience = patience
+        # 最近一次优化的损失曲线和结果
+        self.history = []
+        self.last_result = None
     
-    def compute_loss(self, cards: List[Card], params: List[float]) -> float:
+    @staticmethod
+    def build_dataset(cards: Union[List[Card], 'ReviewDataset']) -> Optional['ReviewDataset']:
+        """把卡片的复习记录展平为优化使用的数据集，已经是数据集时直接返回"""
+        if ReviewDataset is None:
+            print("未安装numpy，无法优化FSRS参数")
+            return None
+        if isinstance(cards, ReviewDataset):
+            return cards
+        return ReviewDataset.from_cards(cards)
+    
+    def compute_loss(self, cards: Union[List[Card], 'ReviewDataset'], params: List[float],
+                     prior: Optional[List[float]] = None) -> float:
         """计算损失函数
         
         Args:
-            cards: 卡片列表
+            cards: 卡片列表或已构建的复习数据集
             params: FSRS参数
+            prior: 正则化的中心，默认为params本身
             
         Returns:
             损失值
         """
-        loss = 0.0
-        total_reviews = 0
-        
-        # 临时FSRS实例，用于计算预测值
-        temp_fsrs = FSRS(params=params)
-        
-        for card in cards:
-            if len(card.review_logs) < 2:
-                continue
-                
-            for i in range(1, len(card.review_logs)):
-                prev_log = card.review_logs[i-1]
-                curr_log = card.review_logs[i]
-                
-                # 计算实际间隔天数
-                elapsed_days = curr_log.elapsed_days
-                
-                # 计算预测的保留率
-                if card.memory_state and prev_log.timestamp:
-                    stability = card.memory_state.stability
-                    predicted_retention = temp_fsrs._forgetting_curve(stability, elapsed_days)
-                    
-                    # 实际评分转换为二元结果（记得/忘记）
-                    actual_result = 1.0 if curr_log.rating >= 3 else 0.0
-                    
-                    # 计算二元交叉熵损失
-                    if 0 < predicted_retention < 1 and 0 < actual_result < 1:
-                        loss -= actual_result * math.log(predicted_retention) + (1 - actual_result) * math.log(1 - predicted_retention)
-                        total_reviews += 1
-        
-        # 添加L2正则化
-        l2_reg = self.regularization * sum(p*p for p in params)
-        
-        # 平均损失
-        return (loss / max(1, total_reviews)) + l2_reg
+        dataset = self.build_dataset(cards)
+        if dataset is None:
+            return float('inf')
+        loss, _ = FSRSBatch(params).loss_and_gradient(dataset, self.regularization, prior)
+        return loss
     
-    def optimize(self, cards: List[Card], initial_params: List[float], 
+    def optimize(self, cards: Union[List[Card], 'ReviewDataset'], initial_params: List[float], 
                 iterations: int = 100) -> List[float]:
         """优化FSRS参数
         
         Args:
-            cards: 卡片列表
+            cards: 卡片列表或已构建的复习数据集
             initial_params: 初始参数
-            iterations: 迭代次数
+            iterations: 最大迭代次数
             
         Returns:
             优化后的参数
         """
-        params = initial_params.copy()
+        start = time.perf_counter()
+        self.history = []
+        self.last_result = None
+        dataset = self.build_dataset(cards)
+        if dataset is None or dataset.review_count == 0:
+            return list(initial_params)
+        
+        prior = np.asarray(initial_params, dtype=float)
+        params = prior.copy()
         best_params = params.copy()
         best_loss = float('inf')
-        
-        for i in range(iterations):
-            # 计算当前损失
-            current_loss = self.compute_loss(cards, params)
+        first_moment = np.zeros_like(params)
+        second_moment = np.zeros_like(params)
+        beta1, beta2, epsilon = 0.9, 0.999, 1e-8
+        stale = 0
+        converged = False
+        
+        for i in range(1, iterations + 1):
+            loss, gradient = FSRSBatch(params).loss_and_gradient(dataset, self.regularization, prior)
+            self.history.append(loss)
             
-            if current_loss < best_loss:
-                best_loss = current_loss
+            if loss < best_loss - self.tolerance:
+                stale = 0
+            else:
+                stale += 1
+            if loss < best_loss:
+                best_loss = loss
                 best_params = params.copy()
             
-            # 计算梯度
-            gradients = []
-            for j in range(len(params)):
-                eps = 1e-5
-                params_plus = params.copy()
-                params_plus[j] += eps
-                
-                loss_plus = self.compute_loss(cards, params_plus)
-                gradient = (loss_plus - current_loss) / eps
-                gradients.append(gradient)
+            # 梯度接近0或连续多次没有改进时认为已收敛
+            if np.max(np.abs(gradient)) < self.tolerance or stale >= self.patience:
+                converged = True
+                break
+            
+            # Adam更新
+            first_moment = beta1 * first_moment + (1 - beta1) * gradient
+            second_moment = beta2 * second_moment + (1 - beta2) * gradient ** 2
+            step = (first_moment / (1 - beta1 ** i)) / (np.sqrt(second_moment / (1 - beta2 ** i)) + epsilon)
+            params = params - self.learning_rate * step
             
-            # 更新参数
-            for j in range(len(params)):
-                params[j] -= self.learning_rate * gradients[j]
-                
             # 确保参数在合理范围内
-            for j in range(len(params)):
-                params[j] = max(0.01, min(10.0, params[j]))
-                
-            # 如果损失变化很小，提前结束
-            if i > 10 and abs(current_loss - best_loss) < 1e-6:
-                break
-                
-        return best_params
+            params = np.clip(params, 0.01, 10.0)
+        
+        self.last_result = {
+            'iterations': len(self.history),
+            'initial_loss': self.history[0],
+            'loss': best_loss,
+            'converged': converged,
+            'cards': len(dataset),
+            'reviews': dataset.review_count,
+            'elapsed_ms': (time.perf_counter() - start) * 1000
+        }
+        return best_params.tolist()
 
 
 class FSRS:
@@ -244,6 +264,12 @@ class FSRS:
         except Exception as e:
             print(f"保存参数失败: {e}")
     
+    def batch(self) -> Optional['FSRSBatch']:
+        """使用当前参数创建批量计算引擎，没有安装numpy时返回None"""
+        if FSRSBatch is None:
+            return None
+        return FSRSBatch.from_fsrs(self)
+    
     def init_card(self, card: Card) -> Card:
         """初始化卡片的记忆状态"""
         if card.is_new:
@@ -253,16 +279,22 @@ class FSRS:
             )
         return card
     
-    def next_interval(self, stability: float, learning_factor: float = 1.0) -> int:
+    def next_interval(self, stability: float, learning_factor: float = 1.0, load_balancer=None) -> int:
         """计算下一个复习间隔
         
         Args:
             stability: 记忆稳定性
             learning_factor: 学习因子，用于个性化调整
+            load_balancer: 负载均衡函数，参数为 (最短间隔, 最长间隔, 不加波动的间隔)，返回选定的间隔；
+                为None时在波动范围内随机取值
             
         Returns:
             下一个复习间隔天数
         """
+        if load_balancer is not None:
+            low, preferred, high = self.fuzz_range(stability, learning_factor)
+            return load_balancer(low, high, preferred)
+        
         # 计算精确间隔，考虑学习因子
         interval = stability * math.log(self.desired_retention) * -1.0 * learning_factor
         
@@ -276,6 +308,16 @@ class FSRS:
         # 向上取整，确保至少为1天
         return max(1, round(interval))
     
+    def fuzz_range(self, stability: float, learning_factor: float = 1.0) -> Tuple[int, int, int]:
+        """随机波动(±5%)允许的间隔范围，与next_interval的取整和上限一致
+        
+        Returns:
+            (最短间隔, 不加波动的间隔, 最长间隔)
+        """
+        interval = stability * math.log(self.desired_retention) * -1.0 * learning_factor
+        low, preferred, high = (max(1, round(min(interval * fuzz, self.maximum_interval))) for fuzz in (0.95, 1.0, 1.05))
+        return low, preferred, high
+    
     def _update_difficulty(self, difficulty: float, rating: int) -> float:
         """更新难度
         
@@ -461,6 +503,11 @@ class FSRS:
                 
                 # 优化参数
                 new_params = self.optimizer.optimize(cards, self.w, iterations=50)
+                result = self.optimizer.last_result
+                if result:
+                    print(f"损失 {result['initial_loss']:.4f} -> {result['loss']:.4f}，"
+                          f"迭代 {result['iterations']} 次({'已收敛' if result['converged'] else '未收敛'})，"
+                          f"耗时 {result['elapsed_ms']:.1f} ms")
                 
                 # 如果优化成功，更新参数
                 if new_params and len(new_params) == len(self.w):
@@ -512,6 +559,15 @@ class FSRS:
         Returns:
             卡片ID到记忆概率列表的映射
         """
+        batch = self.batch()
+        if batch is not None:
+            cards = [card for card in cards if card.memory_state]
+            if not cards:
+                return {}
+            arrays = batch.card_arrays(cards)
+            matrix = batch.retrievability(arrays['stability'], days)
+            return {card.id: probs for card, probs in zip(cards, matrix.tolist())}
+
         results = {}
         for card in cards:
             if card.memory_state:
@@ -530,6 +586,10 @@ class FSRS:
             每天预计需要复习的卡片数量列表
         """
         today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        batch = self.batch()
+        if batch is not None:
+            return batch.workload([card.due_date for card in cards], days, today)
+
         workload = [0] * days
         
         for card in cards:
@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+FSRS批量计算引擎(NumPy向量化)
+
+与FSRS类中逐张卡片计算的方法结果一致，
+用于仪表盘统计和批量重新排期等需要一次处理大量卡片状态的场景
+"""
+
+from datetime import datetime
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+ONE_DAY = np.timedelta64(1, 'D')
+
+
+class FSRSBatch:
+    """FSRS批量计算
+
+    所有方法接收数组(或可转换为数组的序列)，按元素计算，返回NumPy数组。
+    """
+
+    def __init__(self,
+                 params: Sequence[float],
+                 desired_retention: float = 0.9,
+                 maximum_interval: int = 36500,
+                 init_stability: float = 1.0,
+                 init_difficulty: float = 5.0):
+        """初始化批量计算引擎
+
+        Args:
+            params: FSRS参数
+            desired_retention: 期望的记忆保留率
+            maximum_interval: 最大复习间隔天数
+            init_stability: 新卡片的初始稳定性
+            init_difficulty: 新卡片的初始难度
+        """
+        self.w = np.asarray(params, dtype=float)
+        self.desired_retention = desired_retention
+        self.maximum_interval = maximum_interval
+        self.init_stability = init_stability
+        self.init_difficulty = init_difficulty
+
+    @classmethod
+    def from_fsrs(cls, fsrs) -> 'FSRSBatch':
+        """使用FSRS实例的参数创建批量计算引擎"""
+        return cls(
+            fsrs.w,
+            desired_retention=fsrs.desired_retention,
+            maximum_interval=fsrs.maximum_interval,
+            init_stability=fsrs.INIT_STABILITY,
+            init_difficulty=fsrs.INIT_DIFFICULTY
+        )
+
+    # ------------------------------------------------------------------
+    # 记忆模型
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def forgetting_curve(stability, elapsed_days) -> np.ndarray:
+        """遗忘曲线，对应FSRS._forgetting_curve，经过天数不大于0时保留率为1"""
+        stability = np.asarray(stability, dtype=float)
+        elapsed_days = np.asarray(elapsed_days, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            retention = np.exp(-elapsed_days / stability)
+        return np.where(elapsed_days <= 0, 1.0, retention)
+
+    def update_difficulty(self, difficulty, ratings) -> np.ndarray:
+        """更新难度，对应FSRS._update_difficulty"""
+        difficulty = np.asarray(difficulty, dtype=float)
+        ratings = np.asarray(ratings)
+        # 评分1-4分别使用w[4]-w[7]，其他评分按Good处理(查表下标0)
+        table = np.array([self.w[6], self.w[4], self.w[5], self.w[6], self.w[7]])
+        factor = table[np.where((ratings >= 1) & (ratings <= 4), ratings, 0)]
+        next_difficulty = difficulty + self.w[3] * (factor - difficulty)
+        return np.clip(next_difficulty, 1.0, 10.0)
+
+    def update_stability(self, stability, difficulty, ratings, elapsed_days) -> np.ndarray:
+        """更新稳定性，对应FSRS._update_stability"""
+        stability = np.asarray(stability, dtype=float)
+        ratings = np.asarray(ratings)
+        decay = self.forgetting_curve(stability, elapsed_days)
+        # 评分2、3的增长系数为w[1]、w[2]，评分4及其他为2*w[2]，评分1按遗忘处理
+        growth = np.where(ratings == 2, self.w[1], np.where(ratings == 3, self.w[2], self.w[2] * 2.0))
+        new_stability = np.where(
+            ratings == 1,
+            self.w[0] * stability * decay,
+            stability * (1 + growth * decay)
+        )
+        return np.maximum(1.0, new_stability)
+
+    def review(self, stability, difficulty, ratings, elapsed_days, is_new=None):
+        """批量复习，对应FSRS.review_card中的记忆状态更新
+
+        Args:
+            stability: 当前稳定性，没有记忆状态的卡片为NaN
+            difficulty: 当前难度，没有记忆状态的卡片为NaN
+            ratings: 评分 (1-4)
+            elapsed_days: 距离上次复习的天数
+            is_new: 是否为新卡片(没有复习记录)，新卡片先初始化且经过天数按0计算
+
+        Returns:
+            (新稳定性数组, 新难度数组)
+        """
+        stability = np.asarray(stability, dtype=float)
+        difficulty = np.asarray(difficulty, dtype=float)
+        elapsed_days = np.asarray(elapsed_days, dtype=float)
+        if is_new is not None:
+            is_new = np.asarray(is_new, dtype=bool)
+            stability = np.where(is_new, self.init_stability, stability)
+            difficulty = np.where(is_new, self.init_difficulty, difficulty)
+            elapsed_days = np.where(is_new, 0.0, elapsed_days)
+        # 没有记忆状态的卡片使用初始值
+        stability = np.where(np.isnan(stability), self.init_stability, stability)
+        difficulty = np.where(np.isnan(difficulty), self.init_difficulty, difficulty)
+
+        new_difficulty = self.update_difficulty(difficulty, ratings)
+        new_stability = self.update_stability(stability, new_difficulty, ratings, elapsed_days)
+        return new_stability, new_difficulty
+
+    @staticmethod
+    def learning_factors(factors, review_counts, rating_sums, difficult=None, easy=None) -> np.ndarray:
+        """计算学习因子，对应FSRS._calculate_learning_factor
+
+        Args:
+            factors: 当前学习因子
+            review_counts: 已有复习记录数
+            rating_sums: 已有复习记录的评分之和
+            difficult: 是否带有difficult标签
+            easy: 是否带有easy标签
+        """
+        factors = np.asarray(factors, dtype=float)
+        review_counts = np.asarray(review_counts)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            average = np.asarray(rating_sums, dtype=float) / review_counts
+        enough = review_counts >= 3
+        factors = np.where(enough & (average > 3.5), factors * 1.1, factors)
+        factors = np.where(enough & (average < 2.5), factors * 0.9, factors)
+        if difficult is not None:
+            factors = np.where(np.asarray(difficult, dtype=bool), factors * 0.85, factors)
+        if easy is not None:
+            easy_only = np.asarray(easy, dtype=bool)
+            if difficult is not None:
+                easy_only = easy_only & ~np.asarray(difficult, dtype=bool)
+            factors = np.where(easy_only, factors * 1.15, factors)
+        return np.clip(factors, 0.5, 1.5)
+
+    def next_intervals(self, stability, learning_factors=1.0, fuzz=None, rng=None) -> np.ndarray:
+        """计算复习间隔天数，对应FSRS.next_interval
+
+        Args:
+            stability: 记忆稳定性
+            learning_factors: 学习因子
+            fuzz: 随机波动系数；为None时与FSRS.next_interval一样在0.95-1.05之间随机取值
+            rng: 生成随机波动使用的numpy随机数生成器
+        """
+        stability = np.asarray(stability, dtype=float)
+        interval = stability * np.log(self.desired_retention) * -1.0 * np.asarray(learning_factors, dtype=float)
+        if fuzz is None:
+            rng = rng if rng is not None else np.random.default_rng()
+            fuzz = rng.uniform(0.95, 1.05, size=interval.shape)
+        interval = interval * np.asarray(fuzz, dtype=float)
+        interval = np.minimum(interval, self.maximum_interval)
+        # np.rint与内置round一样采用四舍六入五成双
+        return np.maximum(1, np.rint(interval)).astype(int)
+
+    # ------------------------------------------------------------------
+    # 预测
+    # ------------------------------------------------------------------
+
+    def retrievability(self, stability, days, has_state=None) -> np.ndarray:
+        """记忆保留率矩阵，对应FSRS.predict_retention
+
+        Args:
+            stability: 每张卡片的稳定性
+            days: 未来天数列表
+            has_state: 卡片是否有记忆状态，没有记忆状态的卡片保留率为0
+
+        Returns:
+            形状为 (卡片数, 天数) 的矩阵
+        """
+        stability = np.asarray(stability, dtype=float)[:, None]
+        days = np.asarray(days, dtype=float)[None, :]
+        matrix = self.forgetting_curve(stability, days)
+        if has_state is not None:
+            matrix = np.where(np.asarray(has_state, dtype=bool)[:, None], matrix, 0.0)
+        return matrix
+
+    @staticmethod
+    def workload(due_dates, days: int = 30, today: Optional[datetime] = None) -> List[int]:
+        """统计未来每天到期的卡片数量，对应FSRS.estimate_workload
+
+        Args:
+            due_dates: 到期时间(datetime64数组或datetime列表，None表示没有到期时间)
+            days: 统计的天数
+            today: 统计起点，默认为今天零点
+        """
+        if today is None:
+            today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        due_dates = np.asarray(due_dates, dtype='datetime64[us]')
+        due_dates = due_dates[~np.isnat(due_dates)]
+        # 向下取整，与timedelta.days的取整方式一致
+        offsets = np.floor_divide(due_dates - np.datetime64(today, 'us'), ONE_DAY).astype(int)
+        offsets = offsets[(offsets >= 0) & (offsets < days)]
+        return np.bincount(offsets, minlength=days)[:days].tolist()
+
+    # ------------------------------------------------------------------
+    # 数据转换
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def card_arrays(cards) -> dict:
+        """把卡片列表转换为批量计算使用的数组
+
+        Returns:
+            {'stability', 'difficulty', 'has_state', 'due_date', 'learning_factor'}
+        """
+        count = len(cards)
+        stability = np.full(count, np.nan)
+        difficulty = np.full(count, np.nan)
+        learning_factor = np.ones(count)
+        due_date = np.full(count, np.datetime64('NaT'), dtype='datetime64[us]')
+        for index, card in enumerate(cards):
+            memory_state = getattr(card, 'memory_state', None)
+            if memory_state:
+                stability[index] = memory_state.stability
+                difficulty[index] = memory_state.difficulty
+            learning_factor[index] = getattr(card, 'learning_factor', 1.0)
+            if getattr(card, 'due_date', None):
+                due_date[index] = card.due_date
+        return {
+            'stability': stability,
+            'difficulty': difficulty,
+            'has_state': ~np.isnan(stability),
+            'due_date': due_date,
+            'learning_factor': learning_factor
+        }
+
+    # ------------------------------------------------------------------
+    # 复习记录重放
+    # ------------------------------------------------------------------
+
+    def replay(self, dataset: 'ReviewDataset') -> dict:
+        """按复习顺序重放所有卡片的复习记录，重新计算最终的记忆状态和下次复习时间
+
+        每一步对所有卡片向量化计算，与依次调用FSRS.review_card的结果一致：
+        第一次复习从初始状态开始，学习因子按之前的评分逐次调整。
+        下次复习间隔与rate_card一致，由稳定性计算(不乘学习因子)，并且不加随机波动，保证结果可重现。
+
+        Returns:
+            {'stability', 'difficulty', 'learning_factor', 'interval', 'due_date'}，每项为按数据集行排列的数组
+        """
+        count = len(dataset)
+        stability = np.full(count, self.init_stability)
+        difficulty = np.full(count, self.init_difficulty)
+        factors = np.ones(count)
+        rating_sums = np.zeros(count)
+
+        for step in range(dataset.ratings.shape[1]):
+            active = dataset.mask[:, step]
+            ratings = dataset.ratings[:, step]
+            new_difficulty = self.update_difficulty(difficulty, ratings)
+            new_stability = self.update_stability(stability, new_difficulty, ratings, dataset.elapsed_days[:, step])
+            # 学习因子在记录本次复习之前计算，只参考之前的评分
+            new_factors = self.learning_factors(factors, np.full(count, step), rating_sums)
+            difficulty = np.where(active, new_difficulty, difficulty)
+            stability = np.where(active, new_stability, stability)
+            factors = np.where(active, new_factors, factors)
+            rating_sums = rating_sums + np.where(active, ratings, 0)
+
+        interval = self.next_intervals(stability, fuzz=np.ones(count))
+        return {
+            'stability': stability,
+            'difficulty': difficulty,
+            'learning_factor': factors,
+            'interval': interval,
+            'due_date': dataset.last_review + interval * ONE_DAY
+        }
+
+    # ------------------------------------------------------------------
+    # 参数优化
+    # ------------------------------------------------------------------
+
+    def loss_and_gradient(self, dataset: 'ReviewDataset', regularization: float = 0.0, prior=None):
+        """按复习顺序重放所有卡片，计算预测保留率的二元交叉熵损失及其对参数的精确梯度
+
+        每一步对所有卡片向量化计算，同时前向传播稳定性对w[0]-w[2]的导数
+        (难度不影响稳定性和保留率，其余参数的梯度只来自正则项)。
+
+        Args:
+            dataset: 复习数据
+            regularization: 正则化系数，惩罚参数偏离prior的平方距离
+            prior: 正则化的中心，默认为当前参数
+
+        Returns:
+            (损失值, 梯度数组)
+        """
+        w = self.w
+        prior = w if prior is None else np.asarray(prior, dtype=float)
+        count = dataset.ratings.shape[0]
+        stability = np.full(count, self.init_stability)
+        stability_grad = np.zeros((count, 3))  # dS/d(w0, w1, w2)
+        loss = 0.0
+        grad = np.zeros(len(w))
+        predictions = 0
+
+        for step in range(dataset.ratings.shape[1]):
+            active = dataset.mask[:, step]
+            ratings = dataset.ratings[:, step]
+            elapsed = dataset.elapsed_days[:, step]
+            positive = active & (elapsed > 0)
+
+            # 复习时的保留率及其对稳定性的导数
+            retention = np.where(positive, np.exp(-np.where(positive, elapsed, 0.0) / stability), 1.0)
+            retention_ds = np.where(positive, retention * elapsed / stability ** 2, 0.0)
+
+            if positive.any():
+                predicted = retention[positive]
+                recalled = dataset.recalled[positive, step]
+                clipped = np.clip(predicted, 1e-6, 1 - 1e-6)
+                loss -= np.sum(recalled * np.log(clipped) + (1 - recalled) * np.log(1 - clipped))
+                loss_dr = np.where(clipped == predicted, (1 - recalled) / (1 - clipped) - recalled / clipped, 0.0)
+                grad[:3] += (loss_dr * retention_ds[positive]) @ stability_grad[positive]
+                predictions += int(positive.sum())
+
+            # 更新稳定性，与_update_stability一致
+            is_again, is_hard, is_good = ratings == 1, ratings == 2, ratings == 3
+            growth = np.select([is_hard, is_good], [w[1], w[2]], default=2.0 * w[2])
+            new_stability = np.where(is_again, w[0] * stability * retention, stability * (1 + growth * retention))
+            new_stability_ds = np.where(
+                is_again,
+                w[0] * (retention + stability * retention_ds),
+                1 + growth * (retention + stability * retention_ds)
+            )
+            new_stability_dw = np.zeros((count, 3))
+            new_stability_dw[:, 0] = np.where(is_again, stability * retention, 0.0)
+            new_stability_dw[:, 1] = np.where(is_hard, stability * retention, 0.0)
+            new_stability_dw[:, 2] = np.select([is_good, ~(is_again | is_hard)], [stability * retention, 2.0 * stability * retention], default=0.0)
+            new_grad = new_stability_dw + new_stability_ds[:, None] * stability_grad
+            # 稳定性被截断为1时与参数无关
+            floored = new_stability < 1.0
+            new_stability = np.where(floored, 1.0, new_stability)
+            new_grad[floored] = 0.0
+
+            stability = np.where(active, new_stability, stability)
+            stability_grad = np.where(active[:, None], new_grad, stability_grad)
+
+        loss /= max(1, predictions)
+        grad /= max(1, predictions)
+        difference = w - prior
+        loss += regularization * float(np.sum(difference ** 2))
+        grad += 2.0 * regularization * difference
+        return float(loss), grad
+
+
+class ReviewDataset:
+    """展平后的复习数据，供参数优化和复习记录重放使用
+
+    每行对应一张卡片，按时间顺序排列其复习记录，长度不足的行用mask补齐。
+    只需构建一次，之后的计算都在这些数组上进行，不再遍历卡片对象。
+    """
+
+    def __init__(self, ratings, elapsed_days, mask, keys=None, last_review=None):
+        self.ratings = np.asarray(ratings, dtype=int)
+        self.elapsed_days = np.asarray(elapsed_days, dtype=float)
+        self.mask = np.asarray(mask, dtype=bool)
+        # 评分3(Good)及以上视为记住
+        self.recalled = (self.ratings >= 3).astype(float)
+        # 每行对应的卡片标识和最后一次复习时间
+        self.keys = list(keys) if keys is not None else list(range(self.ratings.shape[0]))
+        self.last_review = (np.asarray(last_review, dtype='datetime64[us]') if last_review is not None
+                            else np.full(self.ratings.shape[0], np.datetime64('NaT'), dtype='datetime64[us]'))
+
+    @classmethod
+    def from_cards(cls, cards, min_reviews: int = 2) -> 'ReviewDataset':
+        """从卡片的复习记录构建数据集，复习次数少于min_reviews的卡片不参与优化"""
+        return cls.from_review_logs([getattr(card, 'review_logs', None) or [] for card in cards], min_reviews)
+
+    @classmethod
+    def from_review_logs(cls, log_lists, min_reviews: int = 2, keys=None) -> 'ReviewDataset':
+        """从每张卡片的复习记录列表构建数据集
+
+        Args:
+            log_lists: 每张卡片的复习记录列表
+            min_reviews: 复习次数少于该值的卡片不放入数据集
+            keys: 与log_lists对应的卡片标识，保存在数据集的keys中
+        """
+        sequences = []
+        kept_keys = []
+        for index, logs in enumerate(log_lists):
+            sequence = cls._sequence(logs)
+            if sequence and len(sequence) >= min_reviews:
+                sequences.append(sequence)
+                kept_keys.append(keys[index] if keys is not None else index)
+
+        width = max((len(sequence) for sequence in sequences), default=0)
+        ratings = np.zeros((len(sequences), width), dtype=int)
+        elapsed_days = np.zeros((len(sequences), width))
+        mask = np.zeros((len(sequences), width), dtype=bool)
+        last_review = np.full(len(sequences), np.datetime64('NaT'), dtype='datetime64[us]')
+        for row, sequence in enumerate(sequences):
+            length = len(sequence)
+            ratings[row, :length] = [rating for rating, _, _ in sequence]
+            elapsed_days[row, :length] = [elapsed for _, elapsed, _ in sequence]
+            mask[row, :length] = True
+            last_review[row] = sequence[-1][2]
+        return cls(ratings, elapsed_days, mask, kept_keys, last_review)
+
+    @staticmethod
+    def _sequence(logs):
+        """把复习记录转换为 [(评分, 距上次复习的天数, 复习时间)]，第一次复习的天数为0"""
+        sequence = []
+        previous = None
+        for log in sorted(logs, key=lambda log: log.timestamp):
+            if previous is not None:
+                elapsed = (log.timestamp - previous.timestamp).total_seconds() / (24 * 3600)
+            else:
+                elapsed = 0.0
+            sequence.append((log.rating, elapsed, log.timestamp))
+            previous = log
+        return sequence
+
+    @property
+    def review_count(self) -> int:
+        """复习记录总数"""
+        return int(self.mask.sum())
+
+    def __len__(self):
+        return self.ratings.shape[0]
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+文件存储模式下的卡片状态日志(journal)
+
+卡片状态的修改以记录的形式追加到日志文件，快照文件(card_states.pkl)只在压缩时整体重写。
+启动时先读取快照，再按顺序重放日志中的记录。
+每条记录带有长度和CRC校验，写入中途崩溃留下的不完整记录会在加载时被截掉。
+快照中记录已执行的一次性数据迁移，迁移在压缩时对合并后的数据执行。
+"""
+
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Windows下没有fcntl，只做进程内加锁
+    fcntl = None
+
+# 记录头：负载长度 + CRC32
+_HEADER = struct.Struct('<II')
+
+
+class CardJournal:
+    """卡片状态快照 + 只追加日志
+
+    日志记录格式为 (操作, 用户名, 卡片ID, 卡片状态)：
+        ('put', username, card_id, CardState)          写入或覆盖卡片状态
+        ('delete', username, card_id, None)            删除卡片状态
+        ('params', username, None, UserFSRSParams)     写入或覆盖用户的FSRS参数
+        ('rename', old_username, new_username, None)   把卡片状态和参数转移到新用户名下
+    重放时后面的记录覆盖前面的记录，所以同一条记录重复重放不影响结果。
+    """
+
+    def __init__(self, snapshot_path, journal_path, compact_bytes=8 * 1024 * 1024, fsync=True):
+        """初始化日志
+
+        Args:
+            snapshot_path: 快照文件路径
+            journal_path: 日志文件路径
+            compact_bytes: 日志超过该大小时压缩为新的快照
+            fsync: 每次追加后是否调用fsync确保写入磁盘
+        """
+        self.snapshot_path = str(snapshot_path)
+        self.journal_path = str(journal_path)
+        self.lock_path = self.journal_path + '.lock'
+        self.compact_bytes = compact_bytes
+        self.fsync = fsync
+        self._lock = threading.RLock()
+        self._lock_depth = 0
+        # 本进程已应用到的位置 (快照标识, 日志偏移量)，用于读取其他进程之后追加的记录；
+        # 本进程压缩日志后移到新快照的开头，不需要重新加载
+        self.loaded_position = None
+        self._own_ranges = []  # 本进程追加的日志区间 [(起始偏移量, 结束偏移量)]
+        self._unread = []  # 本进程压缩时合并进快照、但本进程还没有应用的其他进程的记录
+
+    # ------------------------------------------------------------------
+    # 读取
+    # ------------------------------------------------------------------
+
+    def load(self):
+        """读取快照并重放日志
+
+        Returns:
+            {'system_cards': ..., 'user_card_states': ..., 'user_fsrs_params': ..., 'migrations': ...}
+        """
+        with self._locked():
+            data = self._read_snapshot()
+            records, valid_size = self._read_journal()
+            self._truncate_torn_tail(valid_size)
+            self.loaded_position = (self._snapshot_id(), valid_size)
+            self._own_ranges = []
+            self._unread = []
+        replayed = self.apply(data['user_card_states'], records, data['user_fsrs_params'])
+        if replayed:
+            print(f"已重放 {replayed} 条卡片状态日志")
+        return data
+
+    @staticmethod
+    def apply(user_card_states, records, user_fsrs_params=None):
+        """把日志记录应用到 {username: {card_id: CardState}} 和 {username: UserFSRSParams}，返回应用的记录数
+
+        user_fsrs_params为None时忽略参数记录
+        """
+        count = 0
+        for operation, username, card_id, state in records:
+            if operation == 'put':
+                states = user_card_states.get(username)
+                if states is None:
+                    states = {}
+                    user_card_states[username] = states
+                states[card_id] = state
+            elif operation == 'delete':
+                user_card_states.get(username, {}).pop(card_id, None)
+            elif operation == 'params':
+                if user_fsrs_params is not None:
+                    user_fsrs_params[username] = state
+            elif operation == 'rename':
+                # 卡片ID位置保存新用户名
+                for data in (user_card_states, user_fsrs_params):
+                    if data is not None and data.get(username) is not None:
+                        data[card_id] = data[username]
+                        del data[username]
+            else:
+                continue
+            count += 1
+        return count
+
+    def journal_size(self):
+        """当前日志文件大小(字节)"""
+        try:
+            return os.path.getsize(self.journal_path)
+        except OSError:
+            return 0
+
+    # ------------------------------------------------------------------
+    # 写入
+    # ------------------------------------------------------------------
+
+    def append(self, records):
+        """追加一批记录，整批通过一次write写入
+
+        Returns:
+            追加后的日志大小
+        """
+        if not records:
+            return self.journal_size()
+        payload = b''.join(self._encode(record) for record in records)
+        with self._locked():
+            os.makedirs(os.path.dirname(self.journal_path), exist_ok=True)
+            fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, payload)
+                if self.fsync:
+                    os.fsync(fd)
+                size = os.fstat(fd).st_size
+                self._own_ranges.append((size - len(payload), size))
+                return size
+            finally:
+                os.close(fd)
+
+    def read_changes(self, position):
+        """读取position之后其他进程追加的日志记录，position为本进程已应用到的位置时随之前移
+
+        Args:
+            position: 上次读取到的位置 (快照标识, 日志偏移量)
+
+        Returns:
+            (记录列表, 新位置)；快照已被其他进程替换或日志已被清空时返回 (None, None)，调用方需要重新加载全部数据
+        """
+        if position is None:
+            return None, None
+        snapshot_id, offset = position
+        # 快照和日志都没有变化时只需两次stat
+        if self._snapshot_id() != snapshot_id:
+            return None, None
+        size = self.journal_size()
+        if size == offset and not self._unread:
+            return [], position
+        if size < offset:
+            return None, None
+
+        with self._locked():
+            if self._snapshot_id() != snapshot_id or self.journal_size() < offset:
+                return None, None
+            records = []
+            if position == self.loaded_position:
+                records, self._unread = self._unread, []
+            end = offset
+            for start, end, record in self._iter_records(offset):
+                if record is not None and not self._is_own(start):
+                    records.append(record)
+            self._own_ranges = [(own_start, own_end) for own_start, own_end in self._own_ranges if own_end > end]
+            if position == self.loaded_position:
+                self.loaded_position = (snapshot_id, end)
+            return records, (snapshot_id, end)
+
+    def needs_compaction(self, size=None):
+        """日志是否已超过压缩阈值"""
+        if not self.compact_bytes:
+            return False
+        return (self.journal_size() if size is None else size) >= self.compact_bytes
+
+    def run_migration(self, name, migrate):
+        """执行一次性数据迁移：合并日志后对快照数据执行迁移，写出新快照并记录迁移名称，已记录的迁移直接跳过
+
+        Args:
+            name: 迁移名称
+            migrate: 迁移函数，参数为快照数据(同load的返回值)，原地修改，成功时返回True；失败时不写快照，下次加载时重试
+
+        Returns:
+            本次是否执行了迁移
+        """
+        with self._locked():
+            if name in self._read_snapshot()['migrations']:
+                return False
+            return self.compact(migration=(name, migrate))
+
+    def compact(self, system_cards=None, migration=None):
+        """把日志合并进快照：读取磁盘上的快照和日志，写出新快照后清空日志
+
+        用户的卡片状态和参数只依赖磁盘上的数据，不依赖调用方内存中的状态。
+
+        Args:
+            system_cards: 系统卡片不写入日志，传入时替换快照中的系统卡片
+            migration: (迁移名称, 迁移函数)，合并日志后执行，见run_migration
+
+        Returns:
+            是否压缩成功
+        """
+        start = time.perf_counter()
+        try:
+            with self._locked():
+                data = self._read_snapshot()
+                records, _ = self._read_journal()
+                journal_bytes = self.journal_size()
+                # 本进程的数据与磁盘上的快照一致时，先留下其他进程追加而本进程还没读到的记录，压缩后不需要重新加载
+                current = self.loaded_position is not None and self.loaded_position[0] == self._snapshot_id()
+                if current:
+                    self._unread.extend(
+                        record for start, _, record in self._iter_records(self.loaded_position[1])
+                        if record is not None and not self._is_own(start)
+                    )
+                self.apply(data['user_card_states'], records, data['user_fsrs_params'])
+                if system_cards is not None:
+                    data['system_cards'] = system_cards
+                if migration is not None:
+                    name, migrate = migration
+                    if not migrate(data):
+                        raise RuntimeError(f"数据迁移 {name} 失败")
+                    data['migrations'].add(name)
+                self._write_snapshot(data)
+                self._reset_journal()
+                if current:
+                    self.loaded_position = (self._snapshot_id(), 0)
+                    self._own_ranges = []
+            elapsed = time.perf_counter() - start
+            print(f"卡片状态日志压缩: 合并 {len(records)} 条记录({journal_bytes} 字节)，耗时 {elapsed * 1000:.1f} ms")
+            if migration is not None:
+                print(f"数据迁移 {migration[0]} 已完成")
+            return True
+        except Exception as e:
+            print(f"卡片状态日志压缩失败: {e}")
+            return False
+
+    # ------------------------------------------------------------------
+    # 内部实现
+    # ------------------------------------------------------------------
+
+    def _locked(self):
+        return _JournalLock(self)
+
+    def _is_own(self, start):
+        """从start开始的记录是否由本进程追加"""
+        return any(own_start <= start < own_end for own_start, own_end in self._own_ranges)
+
+    @staticmethod
+    def _encode(record):
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        return _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+    def _read_snapshot(self):
+        data = {'system_cards': {}, 'user_card_states': {}, 'user_fsrs_params': {}, 'migrations': set()}
+        if not os.path.exists(self.snapshot_path):
+            return data
+        with open(self.snapshot_path, 'rb') as f:
+            all_data = pickle.load(f)
+        # 只接受包含system_cards和user_card_states的新格式
+        if isinstance(all_data, dict) and 'system_cards' in all_data and 'user_card_states' in all_data:
+            data['system_cards'] = all_data['system_cards']
+            data['user_card_states'] = dict(all_data['user_card_states'])
+            data['user_fsrs_params'] = dict(all_data.get('user_fsrs_params', {}))
+            data['migrations'] = set(all_data.get('migrations', ()))
+        return data
+
+    def _snapshot_id(self):
+        """快照文件标识，快照被替换后会变化"""
+        try:
+            stat = os.stat(self.snapshot_path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _read_journal(self):
+        """读取日志中所有完整的记录
+
+        Returns:
+            (记录列表, 最后一条完整记录结束处的偏移量)
+        """
+        records = []
+        end = 0
+        for _, end, record in self._iter_records(0):
+            if record is not None:
+                records.append(record)
+        return records, end
+
+    def _iter_records(self, offset):
+        """从offset开始逐条解析日志记录，生成 (起始偏移量, 结束偏移量, 记录)"""
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'rb') as f:
+            f.seek(offset)
+            content = f.read()
+
+        position = 0
+        while position + _HEADER.size <= len(content):
+            length, checksum = _HEADER.unpack_from(content, position)
+            start = position + _HEADER.size
+            payload = content[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                return
+            try:
+                record = pickle.loads(payload)
+            except Exception as e:
+                # 校验通过但无法反序列化(如类定义已变化)，不当作不完整记录截断
+                print(f"卡片状态日志记录无法解析，忽略之后的记录: {e}")
+                yield offset + position, offset + len(content), None
+                return
+            yield offset + position, offset + start + length, record
+            position = start + length
+
+    def _truncate_torn_tail(self, valid_size):
+        """截掉写入中途崩溃留下的不完整记录"""
+        size = self.journal_size()
+        if size > valid_size:
+            print(f"卡片状态日志末尾有 {size - valid_size} 字节不完整记录，已截断")
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(valid_size)
+
+    def _write_snapshot(self, data):
+        """写入临时文件后用os.replace替换，崩溃时旧快照保持完整"""
+        os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+        tmp_path = f"{self.snapshot_path}.tmp{os.getpid()}"
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _reset_journal(self):
+        # 快照已包含日志中的全部修改；即使清空前崩溃，重放旧日志也只会写入相同的状态
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(0)
+                if self.fsync:
+                    os.fsync(f.fileno())
+
+
+class _JournalLock:
+    """进程内线程锁 + 跨进程文件锁(gunicorn多个工作进程共享同一个日志文件)"""
+
+    def __init__(self, journal):
+        self.journal = journal
+        self._fd = None
+
+    def __enter__(self):
+        self.journal._lock.acquire()
+        self.journal._lock_depth += 1
+        # 同一线程重入时已持有文件锁，不再重复加锁
+        if fcntl is not None and self.journal._lock_depth == 1:
+            try:
+                os.makedirs(os.path.dirname(self.journal.lock_path), exist_ok=True)
+                self._fd = os.open(self.journal.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except OSError:
+                self._close()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._close()
+        self.journal._lock_depth -= 1
+        self.journal._lock.release()
+        return False
+
+    def _close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+FSRS参数后台优化调度
+
+请求线程只登记需要优化的用户，后台调度线程收集该用户的全部复习记录，
+交给有上限的进程池拟合参数，完成后通过回调写回存储。
+同一用户同时最多只有一个优化任务，请求线程不会运行优化器。
+
+任务状态和新增复习数保存在任务存储中：数据库模式下使用数据库表，所有工作进程看到同一份状态，
+由先领取到任务的进程运行优化；文件存储模式下保存在本进程内存中。
+"""
+
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+try:
+    from models.fsrs import FSRSOptimizer, ReviewDataset
+except ImportError:
+    from fsrs_web.models.fsrs import FSRSOptimizer, ReviewDataset
+
+
+def fit_user_params(dataset, initial_params, iterations):
+    """在工作进程中运行：拟合一个用户的FSRS参数
+
+    Returns:
+        (优化后的参数, 优化结果)
+    """
+    optimizer = FSRSOptimizer()
+    params = optimizer.optimize(dataset, initial_params, iterations=iterations)
+    return params, optimizer.last_result
+
+
+class MemoryJobStore:
+    """保存在本进程内存中的优化任务状态和新增复习数"""
+
+    def __init__(self):
+        self._jobs = {}  # {username: 任务状态}
+        self._review_counts = {}  # {username: 上次安排优化后新增的复习数}
+        self._lock = threading.Lock()
+
+    def add_reviews(self, username, count):
+        """增加用户的新增复习数，返回增加后的数量"""
+        with self._lock:
+            total = self._review_counts.get(username, 0) + count
+            self._review_counts[username] = total
+            return total
+
+    def claim(self, username, stale_before):
+        """为用户登记一个新任务并清零新增复习数；已有未完成且在stale_before之后更新过的任务时返回False"""
+        with self._lock:
+            job = self._jobs.get(username)
+            if (job is not None and job['state'] in OptimizationScheduler.ACTIVE_STATES
+                    and job['updated_at'] >= stale_before):
+                return False
+            now = datetime.now()
+            self._review_counts[username] = 0
+            self._jobs[username] = {
+                'state': 'queued',
+                'submitted_at': now,
+                'finished_at': None,
+                'updated_at': now,
+                'result': None,
+                'error': None
+            }
+            return True
+
+    def update(self, username, **fields):
+        """修改用户任务的状态字段"""
+        with self._lock:
+            job = self._jobs.get(username)
+            if job is not None:
+                job.update(fields, updated_at=datetime.now())
+
+    def get(self, username):
+        """用户最近一次任务的状态，没有任务时返回None"""
+        with self._lock:
+            job = self._jobs.get(username)
+            return dict(job) if job is not None else None
+
+
+class OptimizationScheduler:
+    """按用户调度FSRS参数优化任务
+
+    任务状态：queued(等待) -> running(优化中) -> done(完成) / failed(失败) / skipped(数据不足)
+    """
+
+    ACTIVE_STATES = ('queued', 'running')
+
+    def __init__(self, collect, apply, store=None, max_workers=1, max_pending=16,
+                 review_threshold=50, min_cards=10, iterations=100, stale_seconds=3600):
+        """初始化调度器
+
+        Args:
+            collect: 收集用户数据的函数，参数为username，返回 (每张卡片的复习记录列表, 初始参数)，在调度线程中调用
+            apply: 写回优化结果的函数，参数为 (username, 参数, 优化结果)，返回是否成功；在进程池的回调线程中调用，
+                需要自行与该用户的请求互斥
+            store: 任务存储(接口同MemoryJobStore)，默认保存在本进程内存中
+            max_workers: 进程池大小
+            max_pending: 本进程最多同时排队或运行的任务数，超过时不再接受新任务
+            review_threshold: 用户新增多少条复习记录后自动安排一次优化
+            min_cards: 参与优化的卡片(至少复习两次)少于该数量时跳过
+            iterations: 优化的最大迭代次数
+            stale_seconds: 未完成的任务超过该时间没有更新时视为运行它的进程已退出，允许重新安排
+        """
+        self.collect = collect
+        self.apply = apply
+        self.store = store if store is not None else MemoryJobStore()
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.review_threshold = review_threshold
+        self.min_cards = min_cards
+        self.iterations = iterations
+        self.stale_seconds = stale_seconds
+
+        self._active = set()  # 本进程排队或运行中的用户
+        self._futures = {}  # {username: Future}
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._executor = None
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        """启动后台调度线程"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='fsrs-optimizer', daemon=True)
+        self._thread.start()
+
+    def note_reviews(self, username, count=1):
+        """记录用户新增的复习，达到阈值时安排一次优化"""
+        total = self.store.add_reviews(username, count)
+        if total is not None and total >= self.review_threshold:
+            self.request(username)
+
+    def request(self, username):
+        """安排一次优化任务；该用户已有未完成的任务或本进程的队列已满时返回False"""
+        with self._lock:
+            if username in self._active or len(self._active) >= self.max_pending:
+                return False
+            stale_before = datetime.now() - timedelta(seconds=self.stale_seconds)
+            if not self.store.claim(username, stale_before):
+                return False
+            self._active.add(username)
+            self._queue.append(username)
+            self._wakeup.notify()
+        return True
+
+    def status(self, username):
+        """获取用户最近一次优化任务的状态，没有任务时返回None"""
+        return self.store.get(username)
+
+    def stats(self):
+        """本进程排队和运行中的任务数"""
+        with self._lock:
+            return {'queued': len(self._queue), 'running': len(self._futures)}
+
+    def stop(self):
+        """停止调度线程和进程池，未开始的任务被取消"""
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify_all()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _run(self):
+        """后台线程：依次收集用户数据并提交到进程池"""
+        while True:
+            with self._lock:
+                while not self._queue and not self._stopped:
+                    self._wakeup.wait()
+                if self._stopped:
+                    return
+                username = self._queue.popleft()
+            self._submit(username)
+
+    def _submit(self, username):
+        try:
+            log_lists, initial_params = self.collect(username)
+            dataset = ReviewDataset.from_review_logs(log_lists) if ReviewDataset is not None else None
+        except Exception as e:
+            self._finish(username, 'failed', error=f"收集复习记录失败: {e}")
+            return
+        if dataset is None or len(dataset) < self.min_cards:
+            self._finish(username, 'skipped', error='复习数据不足')
+            return
+
+        try:
+            future = self._get_executor().submit(fit_user_params, dataset, initial_params, self.iterations)
+        except Exception as e:
+            self._finish(username, 'failed', error=f"提交优化任务失败: {e}")
+            return
+        with self._lock:
+            self._futures[username] = future
+        self.store.update(username, state='running')
+        future.add_done_callback(lambda future: self._on_done(username, future))
+
+    def _on_done(self, username, future):
+        """优化完成后在本进程中写回参数"""
+        with self._lock:
+            self._futures.pop(username, None)
+        if future.cancelled():
+            self._finish(username, 'failed', error='任务已取消')
+            return
+        try:
+            params, result = future.result()
+            if not self.apply(username, params, result):
+                self._finish(username, 'failed', result=result, error='保存优化后的参数失败')
+                return
+        except Exception as e:
+            self._finish(username, 'failed', error=str(e))
+            return
+        if result:
+            print(f"用户 {username} 的FSRS参数优化完成: 损失 {result['initial_loss']:.4f} -> {result['loss']:.4f}，"
+                  f"迭代 {result['iterations']} 次，耗时 {result['elapsed_ms']:.1f} ms")
+        self._finish(username, 'done', result=result)
+
+    def _finish(self, username, state, result=None, error=None):
+        if error:
+            print(f"用户 {username} 的FSRS参数优化{'跳过' if state == 'skipped' else '失败'}: {error}")
+        self.store.update(username, state=state, finished_at=datetime.now(), result=result, error=error)
+        with self._lock:
+            self._active.discard(username)
+
+    def _get_executor(self):
+        if self._executor is None:
+            # 调用方是多线程的Web进程，直接fork出的子进程可能继承被其他线程持有的锁；
+            # 使用forkserver从干净的服务进程创建工作进程，服务进程只预先导入本模块，不导入应用；
+            # 没有forkserver的平台使用spawn
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload([__name__])
+            else:
+                context = multiprocessing.get_context('spawn')
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+        return self._executor
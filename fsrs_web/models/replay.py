@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+复习记录重放
+
+按给定的FSRS参数，从每张卡片有序的复习记录重新计算记忆状态、学习因子和下次复习时间。
+参数更新后用它得到与新参数一致的卡片状态；一个用户的全部卡片一次向量化计算。
+最后一次复习之后又被重新安排过的到期时间(如积压分摊)保持不变。
+"""
+
+from datetime import timedelta
+
+try:
+    from models.fsrs_batch import FSRSBatch, ReviewDataset
+except ImportError:
+    from fsrs_web.models.fsrs_batch import FSRSBatch, ReviewDataset
+
+
+def replay_logs(logs_by_card, params, desired_retention=0.9, maximum_interval=36500):
+    """重放一个用户的复习记录，只做计算，可以在工作进程中运行
+
+    Args:
+        logs_by_card: {card_id: [ReviewLog]}
+        params: FSRS参数
+        desired_retention: 期望的记忆保留率
+        maximum_interval: 最大复习间隔天数
+
+    Returns:
+        ({card_id: (稳定性, 难度, 学习因子, 下次复习时间)}, 重放的复习记录数)
+    """
+    card_ids = list(logs_by_card)
+    dataset = ReviewDataset.from_review_logs([logs_by_card[card_id] for card_id in card_ids], min_reviews=1, keys=card_ids)
+    if not len(dataset):
+        return {}, 0
+
+    batch = FSRSBatch(params, desired_retention=desired_retention, maximum_interval=maximum_interval)
+    result = batch.replay(dataset)
+    rows = zip(
+        dataset.keys,
+        result['stability'].tolist(),
+        result['difficulty'].tolist(),
+        result['learning_factor'].tolist(),
+        result['due_date'].tolist()  # datetime64[us] 转换为 datetime
+    )
+    return {card_id: (stability, difficulty, factor, due_date) for card_id, stability, difficulty, factor, due_date in rows}, dataset.review_count
+
+
+def last_review_time(state):
+    """卡片最后一次复习的时间，没有复习记录时返回None"""
+    if not state.review_logs:
+        return None
+    return max(log.timestamp for log in state.review_logs)
+
+
+def is_rescheduled(state):
+    """卡片的到期时间是否在最后一次复习之后被重新安排过
+
+    评分时的到期时间是复习时间加整数天(包括负载均衡选定的日期)；积压分摊等重新排期按当天零点排列，
+    与最后一次复习不再相差整数天
+    """
+    last_review = last_review_time(state)
+    if last_review is None or state.due_date is None:
+        return False
+    return (state.due_date - last_review) % timedelta(days=1) != timedelta(0)
+
+
+def apply_replay(states, results, memory_state_class):
+    """把重放结果写回卡片状态，重新安排过的到期时间保留不变
+
+    Args:
+        states: {card_id: CardState}
+        results: replay_logs返回的结果
+        memory_state_class: 记忆状态类
+
+    Returns:
+        状态有变化的卡片ID列表
+    """
+    changed = []
+    for card_id, (stability, difficulty, factor, due_date) in results.items():
+        state = states.get(card_id)
+        if state is None:
+            continue
+        if is_rescheduled(state):
+            due_date = state.due_date
+        memory_state = state.memory_state
+        if (memory_state is not None and memory_state.stability == stability and memory_state.difficulty == difficulty
+                and state.learning_factor == factor and state.due_date == due_date):
+            continue
+        state.memory_state = memory_state_class(stability=stability, difficulty=difficulty)
+        state.learning_factor = factor
+        state.due_date = due_date
+        changed.append(card_id)
+    return changed
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+单词搜索索引
+
+把卡片正面和背面的文字(去掉HTML标记、转为小写)拆成1~3个字符的片段，记录每个片段出现在哪些卡片中。
+查询时取查询词中最少见的几个片段求交集得到候选卡片，再逐个确认包含查询词，不需要遍历全部卡片。
+自动补全使用按单词排序的数组，二分查找到前缀的位置后顺序取出。
+系统卡片的索引所有用户共享，用户自己添加的卡片在各自的卡片视图中另建索引。
+"""
+
+import heapq
+import html
+import re
+from bisect import bisect_left, insort
+from typing import Callable, Dict, List, Optional, Tuple
+
+# 片段的最大长度，更长的查询词用其中的3字符片段求交集
+GRAM_SIZE = 3
+# 求交集时最多使用的片段数，其余由逐个确认完成
+MAX_GRAMS = 3
+# 已移除的文档数超过仍在索引中的文档数的该比例(且不少于MIN_COMPACT个)时重建倒排表
+COMPACT_RATIO = 0.5
+MIN_COMPACT = 64
+
+_TAG_PATTERN = re.compile(r'<[^>]+>')
+_SPACE_PATTERN = re.compile(r'\s+')
+
+
+def extract_word(front: str) -> str:
+    """从卡片正面的HTML中提取单词，没有单词标记时使用前50个字符"""
+    if '<h3 class="word">' in front:
+        try:
+            return front.split('<h3 class="word">')[1].split('</h3>')[0].strip()
+        except IndexError:
+            pass
+    return front[:50]
+
+
+def normalize(text: str) -> str:
+    """去掉HTML标记，合并空白并转为小写"""
+    text = html.unescape(_TAG_PATTERN.sub(' ', text or ''))
+    return _SPACE_PATTERN.sub(' ', text).strip().lower()
+
+
+def _grams(text: str, size: int) -> set:
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+class SearchIndex:
+    """卡片文字的n-gram倒排索引"""
+
+    def __init__(self):
+        # 每次登记卡片分配新的文档号，倒排表中的文档号按登记顺序递增
+        self._postings: Dict[str, List[int]] = {}
+        self._docs: List[Optional[Tuple[str, str, str, str]]] = []
+        self._doc_ids: Dict[str, int] = {}
+        self._removed = 0  # 已移除但仍留在倒排表中的文档数
+
+    @classmethod
+    def from_cards(cls, cards) -> 'SearchIndex':
+        """从 {card_id: 卡片} 构建"""
+        index = cls()
+        for card_id, card in cards.items():
+            index.add(card_id, card.front, card.back)
+        return index
+
+    def __len__(self):
+        return len(self._doc_ids)
+
+    def __contains__(self, card_id):
+        return card_id in self._doc_ids
+
+    def add(self, card_id: str, front: str, back: str):
+        """登记或更新卡片的文字，文字没有变化时不做任何事"""
+        word = extract_word(front or '').lower()
+        front_text, back_text = normalize(front), normalize(back)
+        doc_id = self._doc_ids.get(card_id)
+        if doc_id is not None:
+            if self._docs[doc_id][1:] == (word, front_text, back_text):
+                return
+            self.discard(card_id)
+        self._append((card_id, word, front_text, back_text))
+
+    def _append(self, doc):
+        doc_id = len(self._docs)
+        self._docs.append(doc)
+        self._doc_ids[doc[0]] = doc_id
+        text = doc[2] + '\n' + doc[3]
+        for size in range(1, GRAM_SIZE + 1):
+            for gram in _grams(text, size):
+                self._postings.setdefault(gram, []).append(doc_id)
+
+    def discard(self, card_id: str):
+        """移除卡片；倒排表中的旧文档号在查询时跳过，积累过多时重建倒排表"""
+        doc_id = self._doc_ids.pop(card_id, None)
+        if doc_id is None:
+            return
+        self._docs[doc_id] = None
+        self._removed += 1
+        if self._removed >= max(MIN_COMPACT, len(self._doc_ids) * COMPACT_RATIO):
+            self._compact()
+
+    def _compact(self):
+        """按登记顺序重新编号仍在索引中的文档并重建倒排表，去掉已移除的文档"""
+        docs = [doc for doc in self._docs if doc is not None]
+        self._postings = {}
+        self._docs = []
+        self._doc_ids = {}
+        self._removed = 0
+        for doc in docs:
+            self._append(doc)
+
+    def _candidates(self, query: str):
+        """包含查询词所有片段的文档号"""
+        size = min(len(query), GRAM_SIZE)
+        postings = sorted((self._postings.get(gram, ()) for gram in _grams(query, size)), key=len)
+        if not postings or not postings[0]:
+            return []
+        candidates = set(postings[0])
+        for posting in postings[1:MAX_GRAMS]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                break
+        return candidates
+
+    def search(self, query: str, include_back: bool = False, limit: Optional[int] = None) -> List[Tuple[tuple, str]]:
+        """查找文字中包含查询词的卡片
+
+        排序依次为：单词与查询词相同、单词以查询词开头、单词包含查询词、正面包含查询词、背面包含查询词，
+        同一级中单词较短的在前，再按登记顺序。
+
+        Returns:
+            [(排序键, card_id)]，按排序键从小到大
+        """
+        query = normalize(query)
+        if not query:
+            return []
+        results = []
+        for doc_id in self._candidates(query):
+            doc = self._docs[doc_id]
+            if doc is None:
+                continue
+            card_id, word, front_text, back_text = doc
+            if word == query:
+                rank = 0
+            elif word.startswith(query):
+                rank = 1
+            elif query in word:
+                rank = 2
+            elif query in front_text:
+                rank = 3
+            elif include_back and query in back_text:
+                rank = 4
+            else:
+                continue
+            results.append(((rank, len(word), doc_id), card_id))
+        if limit is not None:
+            return heapq.nsmallest(limit, results)
+        results.sort()
+        return results
+
+
+class PrefixIndex:
+    """按小写单词排序的有序数组，用于单词自动补全"""
+
+    def __init__(self):
+        self._entries: List[Tuple[str, str, str]] = []
+        self._words: Dict[str, str] = {}
+
+    @classmethod
+    def from_cards(cls, cards) -> 'PrefixIndex':
+        """从 {card_id: 卡片} 构建"""
+        index = cls()
+        index._words = {card_id: extract_word(card.front or '') for card_id, card in cards.items()}
+        index._entries = sorted((word.lower(), word, card_id) for card_id, word in index._words.items())
+        return index
+
+    def __len__(self):
+        return len(self._words)
+
+    def add(self, card_id: str, front: str):
+        """登记或更新卡片的单词"""
+        word = extract_word(front or '')
+        if self._words.get(card_id) == word:
+            return
+        self.discard(card_id)
+        insort(self._entries, (word.lower(), word, card_id))
+        self._words[card_id] = word
+
+    def discard(self, card_id: str):
+        """移除卡片"""
+        word = self._words.pop(card_id, None)
+        if word is not None:
+            del self._entries[bisect_left(self._entries, (word.lower(), word, card_id))]
+
+    def complete(self, prefix: str, limit: int = 10, accept: Optional[Callable[[str], bool]] = None) -> List[str]:
+        """以prefix开头(不区分大小写)的单词，按字母顺序最多返回limit个，相同的单词只返回一次
+
+        Args:
+            accept: 判断卡片是否可用的函数，默认全部可用
+        """
+        prefix = prefix.lower()
+        words = []
+        position = bisect_left(self._entries, (prefix,))
+        while position < len(self._entries) and len(words) < limit:
+            key, word, card_id = self._entries[position]
+            if not key.startswith(prefix):
+                break
+            if (not words or words[-1] != word) and (accept is None or accept(card_id)):
+                words.append(word)
+            position += 1
+        return words
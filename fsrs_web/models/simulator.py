@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+复习量蒙特卡洛模拟
+
+从用户当前的卡片状态出发逐日模拟：到期的卡片按保留率随机决定是否记住，
+按用户的FSRS参数更新记忆状态并重新排期，同时按学习进度引入新卡片。
+多个随机副本放在同一组数组中向量化计算，统计每天复习量的期望和置信区间。
+"""
+
+import math
+from datetime import datetime
+from typing import Optional
+
+import numpy as np
+
+try:
+    from models.fsrs_batch import FSRSBatch, ReviewDataset, ONE_DAY
+except ImportError:
+    from fsrs_web.models.fsrs_batch import FSRSBatch, ReviewDataset, ONE_DAY
+
+
+# 没有复习记录时使用的评分分布
+DEFAULT_FIRST_RATINGS = (0.2, 0.15, 0.5, 0.15)  # 新卡片第一次复习评分1-4的概率
+DEFAULT_FORGOT_RATINGS = (0.8, 0.2)  # 没记住时评分1、2的概率
+DEFAULT_RECALLED_RATINGS = (0.85, 0.15)  # 记住时评分3、4的概率
+
+# 每次复习花费的时间(秒)：新卡片第一次学习、没记住、记住
+DEFAULT_REVIEW_COSTS = (25.0, 20.0, 8.0)
+
+# 寻找最优期望保留率时尝试的取值
+DEFAULT_RETENTION_GRID = tuple(round(0.70 + 0.02 * step, 2) for step in range(14))  # 0.70-0.96
+
+
+def rating_probabilities(log_lists):
+    """从复习记录统计评分分布(加一平滑)
+
+    Returns:
+        (第一次复习评分1-4的概率, 没记住时评分1-2的概率, 记住时评分3-4的概率)
+    """
+    first = np.ones(4)
+    later = np.ones(4)
+    for logs in log_lists:
+        sequence = ReviewDataset._sequence(logs or [])
+        for index, (rating, _, _) in enumerate(sequence):
+            if 1 <= rating <= 4:
+                (first if index == 0 else later)[rating - 1] += 1
+    return (
+        tuple(first / first.sum()),
+        tuple(later[:2] / later[:2].sum()),
+        tuple(later[2:] / later[2:].sum())
+    )
+
+
+def new_cards_rate(log_lists, today: Optional[datetime] = None, window: int = 14) -> float:
+    """按最近window天第一次复习的卡片数估计每天引入的新卡片数"""
+    if today is None:
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    since = np.datetime64(today, 'us') - window * ONE_DAY
+    count = 0
+    for logs in log_lists:
+        if logs and np.datetime64(min(log.timestamp for log in logs), 'us') >= since:
+            count += 1
+    return count / window
+
+
+class WorkloadSimulator:
+    """复习量模拟器
+
+    所有副本的状态展平放在同一组数组中，每天只取出当天到期的元素向量化计算。
+    """
+
+    def __init__(self, batch: FSRSBatch, replicas: int = 100, seed=None,
+                 first_ratings=DEFAULT_FIRST_RATINGS,
+                 forgot_ratings=DEFAULT_FORGOT_RATINGS,
+                 recalled_ratings=DEFAULT_RECALLED_RATINGS,
+                 review_costs=DEFAULT_REVIEW_COSTS):
+        """初始化模拟器
+
+        Args:
+            batch: 使用用户参数的批量计算引擎
+            replicas: 随机副本数
+            seed: 随机种子
+            first_ratings: 新卡片第一次复习评分1-4的概率
+            forgot_ratings: 没记住时评分1、2的概率
+            recalled_ratings: 记住时评分3、4的概率
+            review_costs: 每次复习花费的秒数 (新卡片, 没记住, 记住)
+        """
+        self.batch = batch
+        self.replicas = replicas
+        self.rng = np.random.default_rng(seed)
+        self.first_ratings = np.asarray(first_ratings, dtype=float)
+        self.forgot_ratings = np.asarray(forgot_ratings, dtype=float)
+        self.recalled_ratings = np.asarray(recalled_ratings, dtype=float)
+        self.review_costs = tuple(float(cost) for cost in review_costs)
+
+    @staticmethod
+    def card_arrays(cards, today: Optional[datetime] = None) -> dict:
+        """把卡片转换为模拟的初始状态，时间都以距今天的天数表示
+
+        已查看的卡片从当前状态开始模拟，没有记忆状态的按新卡片处理；
+        未查看的卡片只计入待学习的新卡片数。
+
+        Returns:
+            {'stability', 'difficulty', 'last_review', 'due', 'new_cards'}
+        """
+        if today is None:
+            today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        viewed = [card for card in cards if getattr(card, 'is_viewed', False)]
+        arrays = FSRSBatch.card_arrays(viewed)
+        start = np.datetime64(today, 'us')
+
+        # 到期时间向下取整到天，已过期和没有到期时间的卡片今天到期
+        due = np.floor_divide(arrays['due_date'] - start, ONE_DAY)
+        due = np.where(np.isnat(arrays['due_date']), 0, np.maximum(due, 0)).astype(np.int32)
+
+        last_review = np.zeros(len(viewed))
+        for index, card in enumerate(viewed):
+            logs = getattr(card, 'review_logs', None)
+            if logs:
+                last = max(log.timestamp for log in logs)
+                last_review[index] = (np.datetime64(last, 'us') - start) / ONE_DAY
+        return {
+            'stability': arrays['stability'],
+            'difficulty': arrays['difficulty'],
+            'last_review': last_review,
+            'due': due,
+            'new_cards': len(cards) - len(viewed)
+        }
+
+    def run(self, stability, difficulty, last_review, due, days: int = 30,
+            new_cards: int = 0, new_cards_per_day: float = 0.0, percentiles=(5, 95),
+            desired_retention=None) -> dict:
+        """逐日模拟
+
+        Args:
+            stability: 每张卡片的稳定性，没有记忆状态的为NaN
+            difficulty: 每张卡片的难度，没有记忆状态的为NaN
+            last_review: 上次复习距今天的天数(今天之前为负数)
+            due: 到期日距今天的天数，不小于0
+            days: 模拟天数
+            new_cards: 待学习的新卡片数
+            new_cards_per_day: 每天引入的新卡片数，可以是小数
+            percentiles: 置信区间的上下百分位
+            desired_retention: 每个副本使用的期望保留率，为None时都使用batch的设置；
+                给出时副本数为其长度
+
+        Returns:
+            {'reviews_mean', 'reviews_low', 'reviews_high', 'new_cards', 'retention', 'total_mean',
+             'review_time', 'memorized'}，
+            每日数据为长度为days的列表；retention为每天开始时已学卡片的平均保留率；
+            review_time和memorized为每个副本的复习总秒数和模拟结束时记住的卡片数(已学卡片保留率之和)
+        """
+        batch = self.batch
+        rng = self.rng
+        if desired_retention is None:
+            replicas = self.replicas
+            interval_factors = np.ones(replicas)
+        else:
+            # 间隔与ln(保留率)成正比，换算成相对batch设置的间隔倍数
+            desired_retention = np.asarray(desired_retention, dtype=float)
+            replicas = desired_retention.size
+            interval_factors = np.log(desired_retention) / np.log(batch.desired_retention)
+
+        # 新卡片作为额外的列，在引入当天第一次复习
+        introduced = 0
+        if new_cards_per_day > 0 and new_cards > 0:
+            introduced = int(min(new_cards, math.floor(new_cards_per_day * days + 1e-9)))
+        intro_days = np.floor(np.arange(introduced) / max(new_cards_per_day, 1e-9) + 1e-9).astype(np.int64)
+
+        # 所有副本的状态展平为一维，下标 = 副本 * 卡片数 + 卡片
+        stability = np.tile(np.concatenate([np.asarray(stability, dtype=float), np.full(introduced, np.nan)]), replicas)
+        difficulty = np.tile(np.concatenate([np.asarray(difficulty, dtype=float), np.full(introduced, np.nan)]), replicas)
+        last_review = np.tile(np.concatenate([np.asarray(last_review, dtype=float), intro_days.astype(float)]), replicas)
+        due = np.tile(np.concatenate([np.asarray(due, dtype=np.int32), intro_days.astype(np.int32)]), replicas)
+        columns = stability.size // max(replicas, 1)
+
+        reviews = np.zeros((replicas, days), dtype=np.int64)
+        review_time = np.zeros(replicas)
+        retention = np.zeros(days)
+        cost_new, cost_forgot, cost_recalled = self.review_costs
+        first_cumulative = np.cumsum(self.first_ratings)[:-1]
+
+        for day in range(days):
+            # 已学卡片的平均保留率只对第一个副本计算
+            sample_stability, sample_last_review = stability[:columns], last_review[:columns]
+            learned = ~np.isnan(sample_stability) & (sample_last_review <= day)
+            if learned.any():
+                retention[day] = float(batch.forgetting_curve(sample_stability[learned], day - sample_last_review[learned]).mean())
+
+            # 一维数组上的比较和flatnonzero很快，只对当天到期的元素做后续计算
+            indices = np.flatnonzero(due == day)
+            if not indices.size:
+                continue
+            rows = indices // columns
+            current_stability = stability[indices]
+            elapsed = day - last_review[indices]
+            is_new = np.isnan(current_stability)
+
+            # 到期时按保留率随机决定是否记住，再按评分分布抽取评分
+            recall = batch.forgetting_curve(np.where(is_new, 1.0, current_stability), elapsed)
+            recalled = rng.random(indices.size) < recall
+            draw = rng.random(indices.size)
+            ratings = np.where(
+                recalled,
+                3 + (draw >= self.recalled_ratings[0]),
+                1 + (draw >= self.forgot_ratings[0])
+            )
+            if is_new.any():
+                ratings[is_new] = 1 + np.searchsorted(first_cumulative, draw[is_new], side='right')
+
+            new_stability, new_difficulty = batch.review(current_stability, difficulty[indices], ratings, elapsed, is_new=is_new)
+            # 与rate_card一致，间隔由稳定性计算并带随机波动
+            stability[indices] = new_stability
+            difficulty[indices] = new_difficulty
+            last_review[indices] = day
+            due[indices] = day + batch.next_intervals(new_stability, interval_factors[rows], rng=rng)
+            reviews[:, day] = np.bincount(rows, minlength=replicas)
+            costs = np.where(is_new, cost_new, np.where(recalled, cost_recalled, cost_forgot))
+            review_time += np.bincount(rows, weights=costs, minlength=replicas)
+
+        # 模拟结束时每个副本记住的卡片数
+        learned = ~np.isnan(stability)
+        recall = np.where(learned, batch.forgetting_curve(np.where(learned, stability, 1.0), days - last_review), 0.0)
+        memorized = recall.reshape(replicas, columns).sum(axis=1) if columns else np.zeros(replicas)
+
+        low, high = np.percentile(reviews, percentiles, axis=0)
+        return {
+            'reviews_mean': reviews.mean(axis=0).tolist(),
+            'reviews_low': low.tolist(),
+            'reviews_high': high.tolist(),
+            'new_cards': np.bincount(intro_days, minlength=days)[:days].tolist(),
+            'retention': retention.tolist(),
+            'total_mean': float(reviews.sum(axis=1).mean()),
+            'review_time': review_time.tolist(),
+            'memorized': memorized.tolist()
+        }
+
+    def retention_curve(self, stability, difficulty, last_review, due, days: int = 365,
+                        new_cards: int = 0, new_cards_per_day: float = 0.0,
+                        grid=DEFAULT_RETENTION_GRID) -> dict:
+        """在一组期望保留率上模拟，寻找每记住一张卡片花费复习时间最少的保留率
+
+        每个保留率使用self.replicas个副本，所有保留率在同一次模拟中完成。
+        参数含义与run相同。
+
+        Returns:
+            {'best': 最优保留率(没有卡片时为None),
+             'curve': [{'retention', 'review_time', 'memorized', 'cost'}]}，
+            review_time为平均每天复习的分钟数，cost为每记住一张卡片花费的秒数
+        """
+        grid = np.asarray(grid, dtype=float)
+        result = self.run(stability, difficulty, last_review, due, days, new_cards=new_cards,
+                          new_cards_per_day=new_cards_per_day, desired_retention=np.repeat(grid, self.replicas))
+        review_time = np.asarray(result['review_time']).reshape(grid.size, self.replicas).mean(axis=1)
+        memorized = np.asarray(result['memorized']).reshape(grid.size, self.replicas).mean(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cost = np.where(memorized > 0, review_time / memorized, np.inf)
+
+        curve = [
+            {
+                'retention': float(target),
+                'review_time': float(seconds / 60 / max(days, 1)),
+                'memorized': float(count),
+                'cost': float(value) if np.isfinite(value) else None
+            }
+            for target, seconds, count, value in zip(grid, review_time, memorized, cost)
+        ]
+        best = float(grid[int(np.argmin(cost))]) if np.isfinite(cost).any() else None
+        return {'best': best, 'curve': curve}
+
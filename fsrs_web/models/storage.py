@@ -7,7 +7,8 @@
 
 import os
 import json
-import pickle
+import heapq
+import threading
 from datetime import datetime
 from dataclasses import asdict
 import sys
@@ -16,7 +17,11 @@ import sys
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 
 # 导入配置
-from fsrs_web.config import CARD_STATES_FILE, USERS_FILE, USE_DATABASE
+from fsrs_web.config import (
+    CARD_STATES_FILE, USERS_FILE, USE_DATABASE,
+    CARD_JOURNAL_FILE, CARD_JOURNAL_COMPACT_BYTES, CARD_JOURNAL_FSYNC
+)
+from fsrs_web.models.journal import CardJournal
 
 # 数据库操作
 database = None
@@ -24,8 +29,14 @@ if USE_DATABASE:
     try:
         from fsrs_web.models.database import (
             initialize_db, get_db_session, 
-            User, SystemCard, UserCardState, UserFSRSParam,
-            migrate_from_files
+            User, SystemCard, UserCardState, UserFSRSParam, ReviewLogEntry,
+            migrate_from_files, upsert_card_states, delete_card_states,
+            append_review_logs, delete_review_logs, query_review_logs, count_reviews_by_day,
+            query_due_card_ids, count_due_cards, get_pool_stats,
+            get_user_version, bump_user_versions, save_user_fsrs_params,
+            get_user_write_state, mark_user_writes_pending, clear_stale_pending_writes,
+            add_optimization_reviews, claim_optimization_job, update_optimization_job, get_optimization_job,
+            create_user, update_user, delete_user, rename_user
         )
         database = True
         # 确保数据库表已创建
@@ -34,6 +45,40 @@ if USE_DATABASE:
         print(f"数据库初始化失败: {e}")
         database = False
 
+# 文件存储模式下读写用户文件的锁
+_users_file_lock = threading.Lock()
+
+# 文件存储模式：快照文件 + 只追加的卡片状态日志
+card_journal = CardJournal(
+    CARD_STATES_FILE, CARD_JOURNAL_FILE,
+    compact_bytes=CARD_JOURNAL_COMPACT_BYTES, fsync=CARD_JOURNAL_FSYNC
+)
+
+def _dedupe_rate_card_review_logs(data):
+    """文件存储模式下的数据迁移：删除旧版评分接口重复追加的复习记录
+    
+    规则与数据库迁移dedupe_rate_card_review_logs相同：同一张卡片中与上一条保留的记录评分相同且间隔不到60秒的记录
+    视为重复，只保留时间较早的一条(评分时的到期时间按这条记录的时间计算)
+    """
+    removed = 0
+    for states in data['user_card_states'].values():
+        for state in states.values():
+            logs = getattr(state, 'review_logs', None)
+            if not logs:
+                continue
+            kept = []
+            for log in sorted(logs, key=lambda log: log.timestamp):
+                if (kept and log.rating == kept[-1].rating
+                        and (log.timestamp - kept[-1].timestamp).total_seconds() < 60):
+                    continue
+                kept.append(log)
+            if len(kept) != len(logs):
+                removed += len(logs) - len(kept)
+                state.review_logs = kept
+    if removed:
+        print(f"已删除 {removed} 条重复的复习记录")
+    return True
+
 class StorageAdapter:
     """存储适配器，处理文件存储和数据库存储"""
     
@@ -46,11 +91,7 @@ class StorageAdapter:
             try:
                 users = {}
                 for user in session.query(User).all():
-                    users[user.username] = {
-                        'password': user.password,
-                        'email': user.email,
-                        'created_at': user.created_at
-                    }
+                    users[user.username] = user.to_record()
                 return users
             except Exception as e:
                 print(f"从数据库加载用户失败: {e}")
@@ -67,6 +108,32 @@ class StorageAdapter:
                     print(f"加载用户数据失败: {e}")
             return {}
     
+    @staticmethod
+    def load_user(username):
+        """按用户名加载单个用户的数据，用户不存在时返回None"""
+        if USE_DATABASE and database:
+            # 按主键查询单行
+            session = get_db_session()
+            try:
+                user = session.get(User, username)
+                return user.to_record() if user is not None else None
+            except Exception as e:
+                print(f"从数据库加载用户 {username} 失败: {e}")
+                return None
+            finally:
+                session.close()
+        return StorageAdapter.load_users().get(username)
+    
+    @staticmethod
+    def users_file_version():
+        """文件存储模式下用户文件的修改时间，用于判断其他进程是否修改过用户数据；数据库模式下返回None"""
+        if USE_DATABASE and database:
+            return None
+        try:
+            return os.stat(USERS_FILE).st_mtime_ns
+        except OSError:
+            return 0
+    
     @staticmethod
     def save_users(users):
         """保存用户数据"""
@@ -82,16 +149,12 @@ class StorageAdapter:
                     if username in existing_users:
                         # 更新现有用户
                         existing_user = existing_users[username]
-                        existing_user.password = user_data.get('password', '')
-                        existing_user.email = user_data.get('email', '')
+                        for field, value in User.column_values(user_data).items():
+                            if field != 'created_at':
+                                setattr(existing_user, field, value)
                     else:
                         # 添加新用户
-                        new_user = User(
-                            username=username,
-                            password=user_data.get('password', ''),
-                            email=user_data.get('email', ''),
-                            created_at=user_data.get('created_at', datetime.now())
-                        )
+                        new_user = User(username=username, **User.column_values(user_data))
                         session.add(new_user)
                 
                 # 删除不在新数据中的用户
@@ -108,12 +171,88 @@ class StorageAdapter:
         else:
             # 使用文件存储
             try:
-                os.makedirs(os.path.dirname(USERS_FILE), exist_ok=True)
-                with open(USERS_FILE, 'w', encoding='utf-8') as f:
-                    json.dump(users, f)
+                StorageAdapter._write_users_file(users)
             except Exception as e:
                 print(f"保存用户数据失败: {e}")
     
+    @staticmethod
+    def _write_users_file(users):
+        """写入临时文件后替换用户文件，写入中途崩溃时旧文件保持完整"""
+        os.makedirs(os.path.dirname(USERS_FILE), exist_ok=True)
+        tmp_path = f"{USERS_FILE}.tmp{os.getpid()}"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(users, f)
+        os.replace(tmp_path, USERS_FILE)
+    
+    @staticmethod
+    def _modify_users_file(modify):
+        """文件存储模式下读取、修改并写回用户文件
+        
+        Args:
+            modify: 参数为用户字典的函数，返回False时不写回
+        """
+        with _users_file_lock:
+            users = StorageAdapter.load_users()
+            if modify(users) is False:
+                return False
+            try:
+                StorageAdapter._write_users_file(users)
+                return True
+            except Exception as e:
+                print(f"保存用户数据失败: {e}")
+                return False
+    
+    @staticmethod
+    def create_user(username, user_data):
+        """创建一个用户，用户名已存在时返回False"""
+        if USE_DATABASE and database:
+            return create_user(username, user_data)
+        
+        def add(users):
+            if username in users:
+                return False
+            users[username] = dict(user_data)
+        return StorageAdapter._modify_users_file(add)
+    
+    @staticmethod
+    def update_user(username, **fields):
+        """只更新一个用户的指定字段(如last_login、study_mode)，用户不存在时返回False"""
+        if USE_DATABASE and database:
+            return update_user(username, fields)
+        
+        def update(users):
+            if username not in users:
+                return False
+            users[username].update(fields)
+        return StorageAdapter._modify_users_file(update)
+    
+    @staticmethod
+    def delete_user(username):
+        """删除一个用户，用户不存在时返回False"""
+        if USE_DATABASE and database:
+            return delete_user(username)
+        
+        def delete(users):
+            if username not in users:
+                return False
+            del users[username]
+        return StorageAdapter._modify_users_file(delete)
+    
+    @staticmethod
+    def rename_user(old_username, new_username):
+        """修改用户名，关联的卡片状态等数据一起转移；新用户名已存在时返回False"""
+        if USE_DATABASE and database:
+            return rename_user(old_username, new_username)
+        
+        def rename(users):
+            if old_username not in users or new_username in users:
+                return False
+            users[new_username] = users.pop(old_username)
+        if not StorageAdapter._modify_users_file(rename):
+            return False
+        # 卡片状态和参数的转移作为一条记录追加到日志
+        return StorageAdapter._append_journal([('rename', old_username, new_username, None)])
+    
     @staticmethod
     def load_cards(system_cards_class, card_state_class, user_fsrs_params_class):
         """加载卡片数据"""
@@ -134,58 +273,30 @@ class StorageAdapter:
                     )
                     system_cards[card.id] = system_card
                 
+                # 加载复习记录，按 (username, card_id) 分组
+                review_log_class = getattr(sys.modules[system_cards_class.__module__], 'ReviewLog')
+                logs_by_card = {}
+                for entry in session.query(ReviewLogEntry).order_by(ReviewLogEntry.timestamp):
+                    logs_by_card.setdefault((entry.username, entry.card_id), []).append(review_log_class(
+                        timestamp=entry.timestamp,
+                        rating=entry.rating,
+                        elapsed_days=entry.elapsed_days,
+                        scheduled_days=entry.scheduled_days
+                    ))
+                
                 # 加载用户卡片状态
+                memory_state_class = getattr(sys.modules[system_cards_class.__module__], 'MemoryState')
                 user_card_states = {}
                 for user_state in session.query(UserCardState).all():
                     username = user_state.username
                     if username not in user_card_states:
                         user_card_states[username] = {}
                     
-                    # 创建记忆状态
-                    memory_state = None
-                    if user_state.memory_stability is not None and user_state.memory_difficulty is not None:
-                        memory_state_class = getattr(sys.modules[system_cards_class.__module__], 'MemoryState')
-                        memory_state = memory_state_class(
-                            stability=user_state.memory_stability,
-                            difficulty=user_state.memory_difficulty
-                        )
-                    
-                    # 获取复习记录
-                    review_logs = []
-                    if user_state.review_logs:
-                        review_log_class = getattr(sys.modules[system_cards_class.__module__], 'ReviewLog')
-                        logs_data = json.loads(user_state.review_logs)
-                        for log_data in logs_data:
-                            # 将字符串时间戳转换为datetime对象
-                            if isinstance(log_data['timestamp'], str):
-                                timestamp = datetime.fromisoformat(log_data['timestamp'])
-                            else:
-                                timestamp = log_data['timestamp']
-                            
-                            log = review_log_class(
-                                timestamp=timestamp,
-                                rating=log_data['rating'],
-                                elapsed_days=log_data['elapsed_days'],
-                                scheduled_days=log_data['scheduled_days']
-                            )
-                            review_logs.append(log)
-                    
-                    # 创建用户卡片状态
-                    card_state = card_state_class(
-                        card_id=user_state.card_id or '',
-                        is_viewed=user_state.is_viewed,
-                        memory_state=memory_state,
-                        review_logs=review_logs,
-                        due_date=user_state.due_date,
-                        learning_factor=user_state.learning_factor,
-                        is_user_card=user_state.is_user_card
+                    card_key = user_state.get_card_key()
+                    user_card_states[username][card_key] = StorageAdapter._card_state_from_row(
+                        user_state, logs_by_card.get((username, card_key), []),
+                        card_state_class, memory_state_class
                     )
-                    
-                    # 设置用户卡片数据
-                    if user_state.is_user_card and user_state.user_card_data:
-                        card_state.user_card_data = user_state.get_user_card_data()
-                    
-                    user_card_states[username][user_state.card_id or user_state.id] = card_state
                 
                 # 加载用户FSRS参数
                 user_fsrs_params = {}
@@ -194,7 +305,9 @@ class StorageAdapter:
                     user_fsrs_params[user_param.username] = user_fsrs_params_class(
                         params=params,
                         last_updated=user_param.last_updated,
-                        optimization_count=user_param.optimization_count
+                        optimization_count=user_param.optimization_count,
+                        desired_retention=user_param.desired_retention,
+                        maximum_interval=user_param.maximum_interval
                     )
                 
                 return system_cards, user_card_states, user_fsrs_params
@@ -206,31 +319,164 @@ class StorageAdapter:
             finally:
                 session.close()
         else:
-            # 使用文件存储
+            # 使用文件存储：读取快照后重放日志；第一次加载时清理旧版评分接口重复追加的复习记录
+            try:
+                card_journal.run_migration('dedupe_rate_card_review_logs', _dedupe_rate_card_review_logs)
+                all_data = card_journal.load()
+                return all_data['system_cards'], all_data['user_card_states'], all_data['user_fsrs_params']
+            except Exception as e:
+                print(f"加载卡片数据失败: {e}")
+                import traceback
+                traceback.print_exc()
+                return {}, {}, {}
+    
+    @staticmethod
+    def _card_state_from_row(user_state, review_logs, card_state_class, memory_state_class):
+        """将数据库中的一行卡片状态转换为内存中的CardState"""
+        # 创建记忆状态
+        memory_state = None
+        if user_state.memory_stability is not None and user_state.memory_difficulty is not None:
+            memory_state = memory_state_class(
+                stability=user_state.memory_stability,
+                difficulty=user_state.memory_difficulty
+            )
+        
+        # 创建用户卡片状态
+        card_state = card_state_class(
+            card_id=user_state.get_card_key(),
+            is_viewed=user_state.is_viewed,
+            memory_state=memory_state,
+            review_logs=review_logs,
+            due_date=user_state.due_date,
+            learning_factor=user_state.learning_factor,
+            is_user_card=user_state.is_user_card
+        )
+        
+        # 设置用户卡片数据
+        if user_state.is_user_card and user_state.user_card_data:
+            card_state.user_card_data = user_state.get_user_card_data()
+        
+        return card_state
+    
+    @staticmethod
+    def supports_incremental_writes():
+        """当前存储是否支持按卡片增量写入(save_card_states等)
+        
+        数据库模式按行写入，文件存储模式追加到卡片状态日志
+        """
+        return True
+    
+    @staticmethod
+    def supports_per_user_loading():
+        """当前存储是否支持按用户单独加载卡片状态(数据库模式)"""
+        return bool(USE_DATABASE and database)
+    
+    @staticmethod
+    def load_system_cards(system_cards_class):
+        """只加载系统卡片"""
+        if not (USE_DATABASE and database):
+            return StorageAdapter.load_cards(system_cards_class, None, None)[0]
+        session = get_db_session()
+        try:
             system_cards = {}
-            user_card_states = {}
-            user_fsrs_params = {}
+            for card in session.query(SystemCard).all():
+                system_cards[card.id] = system_cards_class(
+                    id=card.id,
+                    unit_id=card.unit_id,
+                    front=card.front,
+                    back=card.back,
+                    created_at=card.created_at,
+                    due_date=card.created_at  # 设置默认值
+                )
+            return system_cards
+        except Exception as e:
+            print(f"从数据库加载系统卡片失败: {e}")
+            return {}
+        finally:
+            session.close()
+    
+    @staticmethod
+    def load_user_card_states(username, system_cards_class, card_state_class):
+        """只加载单个用户的卡片状态和复习记录
+        
+        Returns:
+            {card_id: CardState}；用户没有任何卡片状态时返回None
+        """
+        if not (USE_DATABASE and database):
+            return None
+        session = get_db_session()
+        try:
+            model_module = sys.modules[system_cards_class.__module__]
+            review_log_class = getattr(model_module, 'ReviewLog')
+            memory_state_class = getattr(model_module, 'MemoryState')
             
-            if os.path.exists(CARD_STATES_FILE):
-                try:
-                    with open(CARD_STATES_FILE, 'rb') as f:
-                        all_data = pickle.load(f)
-                        
-                        # 检查数据格式
-                        if isinstance(all_data, dict):
-                            # 检查是否是新格式(包含system_cards和user_card_states)
-                            if 'system_cards' in all_data and 'user_card_states' in all_data:
-                                system_cards = all_data['system_cards']
-                                user_card_states = all_data['user_card_states']
-                                # 加载用户FSRS参数
-                                if 'user_fsrs_params' in all_data:
-                                    user_fsrs_params = all_data['user_fsrs_params']
-                except Exception as e:
-                    print(f"加载卡片数据失败: {e}")
-                    import traceback
-                    traceback.print_exc()
+            rows = session.query(UserCardState).filter(UserCardState.username == username).all()
+            if not rows:
+                return None
+            
+            logs_by_card = {}
+            query = (
+                session.query(ReviewLogEntry)
+                .filter(ReviewLogEntry.username == username)
+                .order_by(ReviewLogEntry.timestamp)
+            )
+            for entry in query:
+                logs_by_card.setdefault(entry.card_id, []).append(review_log_class(
+                    timestamp=entry.timestamp,
+                    rating=entry.rating,
+                    elapsed_days=entry.elapsed_days,
+                    scheduled_days=entry.scheduled_days
+                ))
             
-            return system_cards, user_card_states, user_fsrs_params
+            states = {}
+            for user_state in rows:
+                card_key = user_state.get_card_key()
+                states[card_key] = StorageAdapter._card_state_from_row(
+                    user_state, logs_by_card.get(card_key, []), card_state_class, memory_state_class
+                )
+            return states
+        except Exception as e:
+            print(f"加载用户 {username} 的卡片状态失败: {e}")
+            import traceback
+            traceback.print_exc()
+            return None
+        finally:
+            session.close()
+    
+    @staticmethod
+    def load_user_fsrs_params(username, user_fsrs_params_class):
+        """只加载单个用户的FSRS参数，不存在时返回None"""
+        if not (USE_DATABASE and database):
+            return None
+        session = get_db_session()
+        try:
+            user_param = session.get(UserFSRSParam, username)
+            if user_param is None:
+                return None
+            return user_fsrs_params_class(
+                params=user_param.get_params(),
+                last_updated=user_param.last_updated,
+                optimization_count=user_param.optimization_count,
+                desired_retention=user_param.desired_retention,
+                maximum_interval=user_param.maximum_interval
+            )
+        except Exception as e:
+            print(f"加载用户 {username} 的FSRS参数失败: {e}")
+            return None
+        finally:
+            session.close()
+    
+    @staticmethod
+    def save_user_fsrs_params(username, params, optimized=False, settings=None):
+        """只写入单个用户的FSRS参数和调度设置，返回写入后的优化次数；文件存储模式或失败时返回None"""
+        if not (USE_DATABASE and database):
+            return None
+        return save_user_fsrs_params(username, params, optimized=optimized, settings=settings)
+    
+    @staticmethod
+    def append_user_fsrs_params(username, user_params):
+        """文件存储模式：把用户完整的参数对象追加到卡片状态日志，不重写快照，返回是否写入成功"""
+        return StorageAdapter._append_journal([('params', username, None, user_params)])
     
     @staticmethod
     def save_cards(system_cards, user_card_states, user_fsrs_params):
@@ -253,24 +499,219 @@ class StorageAdapter:
                 import traceback
                 traceback.print_exc()
         else:
-            # 使用文件存储
-            try:
-                # 确保目录存在
-                os.makedirs(os.path.dirname(CARD_STATES_FILE), exist_ok=True)
-                
-                # 将数据打包为新格式
-                all_data = {
-                    'system_cards': system_cards,
-                    'user_card_states': user_card_states,
-                    'user_fsrs_params': user_fsrs_params
-                }
-                
-                with open(CARD_STATES_FILE, 'wb') as f:
-                    pickle.dump(all_data, f)
-            except Exception as e:
-                print(f"保存卡片数据失败: {e}")
-                import traceback
-                traceback.print_exc()
+            # 使用文件存储：卡片状态和参数的修改都已追加到日志，只把磁盘上的日志合并进快照，同时写入系统卡片；
+            # 不用内存中的用户数据写快照，否则会丢掉其他进程追加但本进程还没读到的记录
+            card_journal.compact(system_cards=system_cards)
+
+    @staticmethod
+    def save_card_states(username, states):
+        """增量保存单个用户的部分卡片状态
+        
+        Args:
+            username: 用户名
+            states: {card_id: CardState}，只包含本次修改的卡片
+            
+        Returns:
+            是否保存成功
+        """
+        if USE_DATABASE and database:
+            return upsert_card_states(username, states)
+        return StorageAdapter._append_journal(
+            [('put', username, card_id, state) for card_id, state in states.items()]
+        )
+    
+    @staticmethod
+    def delete_card_states(username, card_ids):
+        """增量删除单个用户的卡片状态，返回是否删除成功"""
+        if USE_DATABASE and database:
+            return delete_card_states(username, card_ids)
+        return StorageAdapter._append_journal(
+            [('delete', username, card_id, None) for card_id in card_ids]
+        )
+    
+    @staticmethod
+    def _append_journal(records):
+        """追加卡片状态日志，日志超过阈值时压缩进快照"""
+        try:
+            size = card_journal.append(records)
+        except Exception as e:
+            print(f"写入卡片状态日志失败: {e}")
+            return False
+        if card_journal.needs_compaction(size):
+            card_journal.compact()
+        return True
+
+    @staticmethod
+    def append_review_logs(entries):
+        """追加复习记录
+        
+        Args:
+            entries: [(username, card_id, ReviewLog)]
+            
+        Returns:
+            是否写入成功；文件存储模式下复习记录随卡片状态一起写入日志，无需单独写入
+        """
+        if USE_DATABASE and database:
+            return append_review_logs(entries)
+        return True
+    
+    @staticmethod
+    def delete_review_logs(username, card_id=None, since=None):
+        """删除复习记录，返回值含义同append_review_logs"""
+        if USE_DATABASE and database:
+            return delete_review_logs(username, card_id=card_id, since=since)
+        return True
+    
+    @staticmethod
+    def load_review_logs(username, review_log_class, since=None, until=None):
+        """只查询指定用户在时间范围内的复习记录
+        
+        Returns:
+            {card_id: [ReviewLog]}；文件存储模式下返回None，调用方使用内存中的数据
+        """
+        if not (USE_DATABASE and database):
+            return None
+        try:
+            logs_by_card = {}
+            for entry in query_review_logs(username, since=since, until=until):
+                logs_by_card.setdefault(entry.card_id, []).append(review_log_class(
+                    timestamp=entry.timestamp,
+                    rating=entry.rating,
+                    elapsed_days=entry.elapsed_days,
+                    scheduled_days=entry.scheduled_days
+                ))
+            return logs_by_card
+        except Exception as e:
+            print(f"查询复习记录失败: {e}")
+            return None
+    
+    @staticmethod
+    def count_reviews_by_day(username, since=None, until=None):
+        """按天统计复习次数，返回 {'YYYY-MM-DD': 次数}；文件存储模式下返回None"""
+        if not (USE_DATABASE and database):
+            return None
+        try:
+            return count_reviews_by_day(username, since=since, until=until)
+        except Exception as e:
+            print(f"统计复习次数失败: {e}")
+            return None
+
+    @staticmethod
+    def query_due_card_ids(username, now, pending=None):
+        """在数据库中查询到期卡片ID(按到期时间排序)；文件存储模式下返回None
+        
+        Args:
+            pending: 写后队列中尚未写入的卡片 {card_id: CardState或None}，按到期时间合并进结果，
+                     表中同一张卡片的旧行被替换
+        """
+        if not (USE_DATABASE and database):
+            return None
+        try:
+            rows = query_due_card_ids(username, now)
+        except Exception as e:
+            print(f"查询到期卡片失败: {e}")
+            return None
+        if not pending:
+            return [card_id for _, card_id in rows]
+        pending_due = sorted(
+            (state.due_date, card_id) for card_id, state in pending.items()
+            if state is not None and state.is_viewed and state.due_date is not None and state.due_date <= now
+        )
+        stored_due = [(due_date, card_id) for due_date, card_id in rows if card_id not in pending]
+        return [card_id for _, card_id in heapq.merge(stored_due, pending_due)]
+    
+    @staticmethod
+    def count_due_cards(username, now):
+        """在数据库中统计到期卡片数量；文件存储模式下返回None"""
+        if not (USE_DATABASE and database):
+            return None
+        try:
+            return count_due_cards(username, now)
+        except Exception as e:
+            print(f"统计到期卡片失败: {e}")
+            return None
+
+    @staticmethod
+    def get_user_version(username):
+        """获取数据库中用户数据的版本号；文件存储模式或查询失败时返回None"""
+        if not (USE_DATABASE and database):
+            return None
+        try:
+            return get_user_version(username)
+        except Exception as e:
+            print(f"查询用户数据版本失败: {e}")
+            return None
+    
+    @staticmethod
+    def bump_user_versions(usernames, settled=None):
+        """写入用户数据后把版本号加一，返回 {username: 新版本号}；文件存储模式下返回None
+        
+        settled为 {username: 本次写入完成的请求数}，从这些用户的未写入请求数中减去
+        """
+        if not (USE_DATABASE and database):
+            return None
+        return bump_user_versions(usernames, settled)
+    
+    @staticmethod
+    def get_user_write_state(username):
+        """获取数据库中用户数据的 (版本号, 未写入的请求数, 最后更新时间)；文件存储模式或查询失败时返回None"""
+        if not (USE_DATABASE and database):
+            return None
+        try:
+            return get_user_write_state(username)
+        except Exception as e:
+            print(f"查询用户数据版本失败: {e}")
+            return None
+    
+    @staticmethod
+    def mark_user_writes_pending(usernames):
+        """请求结束时登记还在写后队列中的用户修改，版本号加一，返回 {username: 新版本号}；文件存储模式下返回None"""
+        if not (USE_DATABASE and database):
+            return None
+        return mark_user_writes_pending(usernames)
+    
+    @staticmethod
+    def clear_stale_pending_writes(username, stale_before):
+        """清零长时间没有更新的未写入请求数(登记它们的进程已退出)，返回是否清零"""
+        if not (USE_DATABASE and database):
+            return False
+        return clear_stale_pending_writes(username, stale_before)
+    
+    @staticmethod
+    def journal_position():
+        """文件存储模式下本进程已应用到的日志位置，本进程压缩日志后指向新快照；数据库模式下返回None"""
+        if USE_DATABASE and database:
+            return None
+        return card_journal.loaded_position
+    
+    @staticmethod
+    def read_journal_changes(position):
+        """读取其他进程在position之后追加的卡片状态日志
+        
+        Returns:
+            (记录列表, 新位置)；需要重新加载全部数据时返回 (None, None)
+        """
+        try:
+            return card_journal.read_changes(position)
+        except Exception as e:
+            print(f"读取卡片状态日志失败: {e}")
+            return None, None
+    
+    @staticmethod
+    def apply_journal_records(user_card_states, records, user_fsrs_params=None):
+        """把日志记录应用到内存中的用户卡片状态和参数，返回应用的记录数"""
+        return CardJournal.apply(user_card_states, records, user_fsrs_params)
+    
+    @staticmethod
+    def get_pool_stats():
+        """获取数据库连接池统计；文件存储模式下返回None"""
+        if not (USE_DATABASE and database):
+            return None
+        try:
+            return get_pool_stats()
+        except Exception as e:
+            print(f"获取连接池统计失败: {e}")
+            return None
 
     @staticmethod
     def migrate_data():
@@ -285,8 +726,20 @@ class StorageAdapter:
             return False
         
         try:
-            # 加载文件数据
-            from fsrs_web.app import system_cards, user_card_states, user_fsrs_params
+            # 数据库中已有用户数据时不再迁移，避免用旧文件覆盖数据库
+            session = get_db_session()
+            try:
+                if session.query(UserCardState.id).first() is not None:
+                    print("数据库中已有卡片状态，跳过文件数据迁移")
+                    return False
+            finally:
+                session.close()
+            
+            # 直接从快照和日志加载数据(应用内的用户数据只包含按需加载的部分用户)
+            all_data = card_journal.load()
+            system_cards = all_data.get('system_cards', {})
+            user_card_states = all_data.get('user_card_states', {})
+            user_fsrs_params = all_data.get('user_fsrs_params', {})
             with open(USERS_FILE, 'r', encoding='utf-8') as f:
                 users_data = json.load(f)
             
@@ -296,4 +749,28 @@ class StorageAdapter:
             print(f"数据迁移失败: {e}")
             import traceback
             traceback.print_exc()
-            return False 
\ No newline at end of file
+            return False 
+
+
+class DatabaseJobStore:
+    """保存在数据库中的FSRS参数优化任务状态，接口同param_scheduler.MemoryJobStore，所有工作进程共享"""
+    
+    def add_reviews(self, username, count):
+        """增加用户的新增复习数，返回增加后的数量；失败时返回None"""
+        return add_optimization_reviews(username, count)
+    
+    def claim(self, username, stale_before):
+        """为用户登记一个新任务并清零新增复习数；已有未完成的任务时返回False"""
+        return claim_optimization_job(username, stale_before)
+    
+    def update(self, username, **fields):
+        """修改用户任务的状态字段"""
+        update_optimization_job(username, fields)
+    
+    def get(self, username):
+        """用户最近一次任务的状态，没有任务或查询失败时返回None"""
+        try:
+            return get_optimization_job(username)
+        except Exception as e:
+            print(f"查询用户 {username} 的优化任务状态失败: {e}")
+            return None
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+按单元分组的卡片索引
+
+记录每个单元有哪些卡片以及其中已查看的数量，随卡片视图一起增量更新，
+单元页面和单词统计页面不需要再遍历用户的全部卡片。
+"""
+
+from typing import Dict, List
+
+
+class UnitIndex:
+    """{unit_id: 卡片ID(保持卡片视图的顺序)}，以及每个单元已查看的卡片数"""
+
+    def __init__(self):
+        self._cards: Dict[str, Dict[str, None]] = {}
+        self._units: Dict[str, str] = {}
+        self._viewed: Dict[str, bool] = {}
+        self._viewed_counts: Dict[str, int] = {}
+
+    @classmethod
+    def from_views(cls, views) -> 'UnitIndex':
+        """从卡片视图 {card_id: CardView} 构建"""
+        index = cls()
+        for card_id, view in views.items():
+            index.update(card_id, view.unit_id, view.is_viewed)
+        return index
+
+    def update(self, card_id: str, unit_id: str, is_viewed: bool):
+        """登记卡片所属的单元和是否已查看"""
+        is_viewed = bool(is_viewed)
+        if self._units.get(card_id) != unit_id:
+            self.discard(card_id)
+            self._cards.setdefault(unit_id, {})[card_id] = None
+            self._units[card_id] = unit_id
+            self._viewed[card_id] = False
+        if self._viewed[card_id] != is_viewed:
+            self._viewed[card_id] = is_viewed
+            self._viewed_counts[unit_id] = self._viewed_counts.get(unit_id, 0) + (1 if is_viewed else -1)
+
+    def discard(self, card_id: str):
+        """移除卡片"""
+        unit_id = self._units.pop(card_id, None)
+        if unit_id is None:
+            return
+        del self._cards[unit_id][card_id]
+        if self._viewed.pop(card_id):
+            self._viewed_counts[unit_id] -= 1
+
+    def card_ids(self, unit_id: str) -> List[str]:
+        """单元中的卡片ID"""
+        return list(self._cards.get(unit_id, ()))
+
+    def total(self, unit_id: str) -> int:
+        """单元的卡片数"""
+        return len(self._cards.get(unit_id, ()))
+
+    def viewed(self, unit_id: str) -> int:
+        """单元中已查看的卡片数"""
+        return self._viewed_counts.get(unit_id, 0)
+
+    def unviewed(self) -> Dict[str, int]:
+        """每个单元未查看的卡片数，不含已全部查看的单元"""
+        return {
+            unit_id: len(card_ids) - self.viewed(unit_id)
+            for unit_id, card_ids in self._cards.items()
+            if len(card_ids) > self.viewed(unit_id)
+        }
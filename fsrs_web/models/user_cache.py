@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+按用户名缓存用户数据的LRU缓存
+
+用户数据在请求中第一次访问时才从存储加载，
+缓存按用户数量、总权重(如卡片状态数量)和空闲时间淘汰
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+# 缓存loader返回None(用户没有数据)的结果，之后的查找和in判断不再访问存储
+_MISSING = object()
+
+
+class UserStateCache:
+    """按用户名索引的有界LRU缓存
+
+    用法与字典相同：读取不存在的用户时调用loader从存储加载，loader返回None表示该用户没有数据，
+    这个结果同样会被缓存(不计权重)，直到被写入、失效或淘汰。
+    遍历(items/values/keys)只覆盖当前已加载且有数据的用户。
+    """
+
+    def __init__(self, loader=None, max_entries=None, max_weight=None, idle_seconds=None, weigher=None):
+        """初始化缓存
+
+        Args:
+            loader: 加载函数，参数为用户名，返回用户数据或None；为None时缓存只保存显式写入的数据
+            max_entries: 最多缓存的用户数量，None表示不限制
+            max_weight: 所有用户数据的总权重上限，None表示不限制
+            idle_seconds: 超过该时间未访问的用户会被淘汰，None表示不限制
+            weigher: 计算单个用户数据权重的函数，默认为1
+        """
+        self.loader = loader
+        self.max_entries = max_entries
+        self.max_weight = max_weight
+        self.idle_seconds = idle_seconds
+        self.weigher = weigher or (lambda value: 1)
+
+        self._data = OrderedDict()  # {username: (value, weight, last_access)}
+        self._total_weight = 0
+        self._lock = threading.RLock()
+
+        # 统计计数
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # ------------------------------------------------------------------
+    # 字典接口
+    # ------------------------------------------------------------------
+
+    def __getitem__(self, username):
+        value = self._lookup(username)
+        if value is None:
+            raise KeyError(username)
+        return value
+
+    def __setitem__(self, username, value):
+        with self._lock:
+            self._remove(username)
+            self._insert(username, value)
+            self._evict(keep=username)
+
+    def __delitem__(self, username):
+        with self._lock:
+            entry = self._data.get(username)
+            if entry is None or entry[0] is _MISSING:
+                raise KeyError(username)
+            self._remove(username)
+
+    def __contains__(self, username):
+        return self._lookup(username) is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, username, default=None):
+        value = self._lookup(username)
+        return default if value is None else value
+
+    def keys(self):
+        with self._lock:
+            return [username for username, entry in self._data.items() if entry[0] is not _MISSING]
+
+    def values(self):
+        with self._lock:
+            return [entry[0] for entry in self._data.values() if entry[0] is not _MISSING]
+
+    def items(self):
+        with self._lock:
+            return [(username, entry[0]) for username, entry in self._data.items() if entry[0] is not _MISSING]
+
+    def clear(self):
+        """清空缓存(不计入淘汰次数)"""
+        with self._lock:
+            self._data.clear()
+            self._total_weight = 0
+
+    # ------------------------------------------------------------------
+    # 缓存管理
+    # ------------------------------------------------------------------
+
+    def invalidate(self, username):
+        """移除指定用户，下次访问时重新加载"""
+        with self._lock:
+            self._remove(username)
+
+    def reweigh(self, username):
+        """用户数据大小变化后重新计算权重"""
+        with self._lock:
+            entry = self._data.get(username)
+            if entry is None or entry[0] is _MISSING:
+                return
+            value, weight, last_access = entry
+            new_weight = self.weigher(value)
+            self._data[username] = (value, new_weight, last_access)
+            self._total_weight += new_weight - weight
+            self._evict()
+
+    def stats(self):
+        """获取缓存统计数据"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._data),
+                'missing': sum(1 for entry in self._data.values() if entry[0] is _MISSING),
+                'weight': self._total_weight,
+                'max_entries': self.max_entries,
+                'max_weight': self.max_weight,
+                'idle_seconds': self.idle_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+    # ------------------------------------------------------------------
+    # 内部实现
+    # ------------------------------------------------------------------
+
+    def _lookup(self, username):
+        """查找用户数据，未缓存时通过loader加载"""
+        with self._lock:
+            self._expire_idle()
+            entry = self._data.get(username)
+            if entry is not None:
+                self.hits += 1
+                value, weight, _ = entry
+                self._data[username] = (value, weight, time.monotonic())
+                self._data.move_to_end(username)
+                return None if value is _MISSING else value
+            self.misses += 1
+
+        if self.loader is None:
+            return None
+        value = self.loader(username)
+
+        with self._lock:
+            # 加载期间其他线程可能已经写入，以已有数据为准
+            entry = self._data.get(username)
+            if entry is not None:
+                return None if entry[0] is _MISSING else entry[0]
+            self._insert(username, _MISSING if value is None else value)
+            self._evict(keep=username)
+            return value
+
+    def _insert(self, username, value):
+        weight = 0 if value is _MISSING else self.weigher(value)
+        self._data[username] = (value, weight, time.monotonic())
+        self._total_weight += weight
+
+    def _remove(self, username):
+        entry = self._data.pop(username, None)
+        if entry is not None:
+            self._total_weight -= entry[1]
+
+    def _evict(self, keep=None):
+        """按数量和权重上限从最久未访问的用户开始淘汰"""
+        while self._data:
+            over_entries = self.max_entries is not None and len(self._data) > self.max_entries
+            over_weight = self.max_weight is not None and self._total_weight > self.max_weight
+            if not over_entries and not over_weight:
+                break
+            username = next(iter(self._data))
+            if username == keep:
+                if len(self._data) == 1:
+                    break
+                self._data.move_to_end(username)
+                continue
+            self._remove(username)
+            self.evictions += 1
+
+    def _expire_idle(self):
+        """淘汰空闲超时的用户(按访问顺序，只检查最旧的几项)"""
+        if self.idle_seconds is None:
+            return
+        deadline = time.monotonic() - self.idle_seconds
+        while self._data:
+            username, (_, _, last_access) = next(iter(self._data.items()))
+            if last_access > deadline:
+                break
+            self._remove(username)
+            self.evictions += 1
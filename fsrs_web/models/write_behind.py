@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+卡片状态写后缓冲队列(write-behind)
+
+请求线程只把修改过的卡片状态放入队列，由后台线程批量写入存储，
+同一张卡片在两次刷新之间的多次修改会被合并为一次写入；
+复习记录等只追加的操作不合并，按登记顺序写入
+"""
+
+import threading
+import time
+
+
+class WriteBehindQueue:
+    """写后缓冲队列
+
+    队列以 (username, card_id) 为键保存登记时卡片状态的副本，值为None表示删除；
+    只追加的操作保存在有序列表中。
+    达到批量大小或刷新间隔时由后台线程调用writer写入，writer返回实际写入的行数。
+    """
+
+    def __init__(self, writer, batch_size=50, flush_interval=2.0, snapshot=None):
+        """初始化写后队列
+
+        Args:
+            writer: 写入函数，参数为 ({(username, card_id): CardState或None}, [追加操作])，返回写入行数
+            batch_size: 待写入条目达到该数量时立即刷新
+            flush_interval: 最长刷新间隔(秒)
+            snapshot: 复制卡片状态的函数，登记时调用；请求线程之后继续修改原对象也不会写入改到一半的状态
+        """
+        self.writer = writer
+        self.snapshot = snapshot
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._pending = {}
+        self._appends = []
+        self._inflight = {}  # 正在写入的批次，写入完成前仍视为未落库
+        self._inflight_appends = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+        # 刷新统计
+        self.last_flush = None  # {'rows': 写入行数, 'seconds': 耗时, 'at': 时间}
+        self.total_rows = 0
+        self.total_flushes = 0
+
+    def start(self):
+        """启动后台刷新线程"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='card-write-behind', daemon=True)
+        self._thread.start()
+
+    def put(self, username, card_id, state):
+        """登记一张需要写入的卡片，重复登记只保留最新状态"""
+        if state is not None and self.snapshot is not None:
+            state = self.snapshot(state)
+        with self._lock:
+            self._pending[(username, card_id)] = state
+            pending_count = len(self._pending) + len(self._appends)
+        if pending_count >= self.batch_size:
+            self._wakeup.set()
+
+    def append(self, operation):
+        """登记一条只追加的操作(如新增复习记录)，不参与合并"""
+        with self._lock:
+            self._appends.append(operation)
+            pending_count = len(self._pending) + len(self._appends)
+        if pending_count >= self.batch_size:
+            self._wakeup.set()
+
+    def delete(self, username, card_id):
+        """登记一张需要删除的卡片"""
+        self.put(username, card_id, None)
+
+    def pending_count(self):
+        """当前待写入的条目数"""
+        with self._lock:
+            return len(self._pending) + len(self._appends)
+
+    def pending_for(self, username):
+        """获取指定用户尚未写入的卡片 {card_id: CardState或None}"""
+        with self._lock:
+            result = {card_id: state for (user, card_id), state in self._inflight.items() if user == username}
+            result.update({card_id: state for (user, card_id), state in self._pending.items() if user == username})
+            return result
+
+    def pending_appends_for(self, username):
+        """获取指定用户尚未写入的只追加操作，按登记顺序排列"""
+        with self._lock:
+            return [operation for operation in self._inflight_appends + self._appends if operation[1] == username]
+
+    def discard(self):
+        """丢弃所有待写入条目(调用方已经整体保存了全部数据)"""
+        with self._lock:
+            self._pending = {}
+            self._appends = []
+
+    def flush(self, username=None):
+        """立即写入待写入条目
+
+        Args:
+            username: 只写入该用户的条目，为None时写入全部
+
+        Returns:
+            (写入行数, 耗时秒数)
+        """
+        with self._flush_lock:
+            with self._lock:
+                if username is None:
+                    batch = self._pending
+                    appends = self._appends
+                    self._pending = {}
+                    self._appends = []
+                else:
+                    batch = {key: state for key, state in self._pending.items() if key[0] == username}
+                    appends = [operation for operation in self._appends if operation[1] == username]
+                    for key in batch:
+                        del self._pending[key]
+                    self._appends = [operation for operation in self._appends if operation[1] != username]
+                self._inflight = batch
+                self._inflight_appends = appends
+            if not batch and not appends:
+                return 0, 0.0
+
+            start = time.perf_counter()
+            try:
+                rows = self.writer(batch, appends)
+            except Exception as e:
+                # 写入失败时放回队列，但不覆盖期间产生的更新状态
+                with self._lock:
+                    for key, state in batch.items():
+                        self._pending.setdefault(key, state)
+                    self._appends = appends + self._appends
+                    self._inflight = {}
+                    self._inflight_appends = []
+                print(f"写后队列刷新失败: {e}")
+                return 0, time.perf_counter() - start
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._inflight = {}
+                self._inflight_appends = []
+
+            self.total_rows += rows
+            self.total_flushes += 1
+            self.last_flush = {'rows': rows, 'seconds': elapsed, 'at': time.time()}
+            return rows, elapsed
+
+    def stop(self):
+        """停止后台线程并写入剩余条目"""
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=max(1.0, self.flush_interval * 2))
+        return self.flush()
+
+    def _run(self):
+        """后台线程：按时间间隔或批量大小刷新"""
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if self._stopped:
+                break
+            self.flush()
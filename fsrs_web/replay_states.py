@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+按每个用户当前的FSRS参数重放复习记录，重新计算所有卡片的记忆状态和下次复习时间。
+
+用法：
+    python replay_states.py [--user USERNAME] [--workers N] [--dry-run]
+
+修改算法或批量调整参数后，用它把已有的卡片状态统一修正为与参数一致的结果。
+文件存储模式下请在应用停止时运行，避免与正在运行的工作进程同时写入。
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# 项目内导入（确保脚本可单独运行）
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from models.replay import replay_logs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="按当前FSRS参数重放复习记录，重新计算卡片状态")
+    parser.add_argument("--user", help="只处理指定用户，默认处理所有用户")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="并行计算的进程数")
+    parser.add_argument("--dry-run", action="store_true", help="只计算并统计，不写回存储")
+    args = parser.parse_args()
+
+    # 在main中导入应用，工作进程按spawn/forkserver的规则导入本脚本时不会加载应用数据
+    import app as fsrs_app
+
+    usernames = [args.user] if args.user else sorted(fsrs_app.load_users())
+    if not usernames:
+        print("没有需要处理的用户")
+        return
+
+    start = time.perf_counter()
+    total_rows = total_cards = total_changed = 0
+
+    def apply(username, results, rows):
+        nonlocal total_rows, total_cards, total_changed
+        total_rows += rows
+        total_cards += len(results)
+        # 与应用内重放相同：应用结果、负载均衡到期日、重建到期索引，再写回存储
+        changed = fsrs_app.replay_user_card_states(username, results=results, save=not args.dry_run)
+        total_changed += changed
+        print(f"  {username}: {len(results)} 张卡片，{rows} 条复习记录，更新 {changed} 张")
+
+    if args.workers <= 1:
+        for username in usernames:
+            results, rows = replay_logs(*fsrs_app.collect_replay_input(username))
+            apply(username, results, rows)
+    else:
+        # 应用已经启动了写后队列和优化调度线程，不能直接fork；replay_logs只做计算，用干净的进程运行
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        context = multiprocessing.get_context(method)
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=context) as executor:
+            futures = {
+                executor.submit(replay_logs, *fsrs_app.collect_replay_input(username)): username
+                for username in usernames
+            }
+            for future in as_completed(futures):
+                results, rows = future.result()
+                apply(futures[future], results, rows)
+
+    if not args.dry_run:
+        fsrs_app.card_write_queue.flush()
+    fsrs_app.param_scheduler.stop()
+
+    elapsed = time.perf_counter() - start
+    print("-" * 60)
+    print(f"重放 {len(usernames)} 个用户、{total_cards} 张卡片、{total_rows} 条复习记录，"
+          f"耗时 {elapsed:.2f} 秒({total_rows / max(elapsed, 1e-9):.0f} 条/秒)")
+    print(f"{'需要' if args.dry_run else '已'}更新 {total_changed} 张卡片的状态")
+
+
+if __name__ == "__main__":
+    main()